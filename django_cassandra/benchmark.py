@@ -0,0 +1,219 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Benchmarks of the common operations of the backend. They're normally run
+with the cassandra_benchmark management command (against the in-process
+fake server from fake_server.py, or against a real cluster), which saves
+the results as JSON so that runs can be compared to catch regressions.
+"""
+
+import random
+import resource
+import sys
+import time
+from datetime import datetime
+
+from django.core.management.color import no_style
+from django.db import models
+
+DEFAULT_BENCHMARK_KEYSPACE = 'DjangoBenchmark'
+
+DEFAULT_SCENARIOS = ('insert', 'get_pk', 'get_indexed', 'filtered_scan',
+                     'ordered_slice', 'count', 'update', 'delete')
+
+# Number of operations that are timed for the scenarios that perform a
+# single-row operation per model instance (the rest perform a full scan
+# per operation and are only repeated a few times).
+DEFAULT_SAMPLE_SIZE = 1000
+DEFAULT_SCAN_REPEAT = 3
+
+class BenchmarkRecord(models.Model):
+    name = models.CharField(max_length=64)
+    code = models.CharField(max_length=32, db_index=True)
+    category = models.CharField(max_length=32, db_index=True)
+    value = models.IntegerField()
+    created = models.DateTimeField()
+
+    class Meta:
+        app_label = 'django_cassandra'
+        db_table = 'BenchmarkRecord'
+
+CATEGORY_COUNT = 10
+
+def _make_record(index, created):
+    return BenchmarkRecord(id='%010d' % index, name='record-%d' % index,
+                           code='code-%d' % index, category='category-%d' % (index % CATEGORY_COUNT),
+                           value=(index * 7919) % 100003, created=created)
+
+def get_peak_rss():
+    """
+    Returns the peak resident set size of the process (since it started) in
+    kilobytes.
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Reported in bytes on OS X
+        peak_rss /= 1024
+    return peak_rss
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = int(round((len(sorted_values) - 1) * percent / 100.0))
+    return sorted_values[index]
+
+def summarize_durations(durations, total_time, start_peak_rss=None):
+    """
+    Summarizes the durations of the operations of a scenario. The peak RSS is
+    a high-water mark of the whole process, so the growth of the peak while
+    the scenario ran is reported too (it's 0 if the scenario stayed within the
+    memory that earlier scenarios had already used).
+    """
+    durations = sorted(durations)
+    peak_rss = get_peak_rss()
+    operation_count = len(durations)
+    return {
+        'operations': operation_count,
+        'total_time': total_time,
+        'ops_per_second': (operation_count / total_time) if total_time > 0 else 0.0,
+        'p50_ms': _percentile(durations, 50) * 1000.0,
+        'p99_ms': _percentile(durations, 99) * 1000.0,
+        'process_peak_rss_kb': peak_rss,
+        'peak_rss_growth_kb': (peak_rss - start_peak_rss) if start_peak_rss is not None else 0,
+    }
+
+def _time_operations(operation, arguments):
+    durations = []
+    start_peak_rss = get_peak_rss()
+    start_time = time.time()
+    for argument in arguments:
+        operation_start_time = time.time()
+        operation(argument)
+        durations.append(time.time() - operation_start_time)
+    return summarize_durations(durations, time.time() - start_time, start_peak_rss)
+
+class BenchmarkRunner(object):
+    """
+    Runs the benchmark scenarios for a number of rows. The benchmark model's
+    column family is created (from scratch) in the keyspace of the connection
+    before the rows are inserted.
+    """
+
+    def __init__(self, connection, sample_size=DEFAULT_SAMPLE_SIZE,
+                 scan_repeat=DEFAULT_SCAN_REPEAT, scenarios=DEFAULT_SCENARIOS, seed=0):
+        self.connection = connection
+        self.sample_size = sample_size
+        self.scan_repeat = scan_repeat
+        self.scenarios = scenarios
+        self.random = random.Random(seed)
+
+    def reset_column_family(self):
+        connection = self.connection
+        keyspace = connection.settings_dict['NAME']
+        connection.creation.drop_keyspace(keyspace)
+        # The keyspace is recreated when the connection is configured again
+        if connection._db_connection is not None:
+            connection._db_connection.close()
+            connection._db_connection = None
+        connection.creation.sql_create_model(BenchmarkRecord, no_style())
+
+    def _sample_indexes(self, row_count):
+        return self.random.sample(xrange(row_count), min(self.sample_size, row_count))
+
+    def run(self, row_count):
+        self.reset_column_family()
+        results = {}
+        created = datetime(2011, 1, 1, 12, 0, 0)
+
+        def insert(index):
+            _make_record(index, created).save()
+
+        def get_pk(index):
+            BenchmarkRecord.objects.get(pk='%010d' % index)
+
+        def get_indexed(index):
+            BenchmarkRecord.objects.get(code='code-%d' % index)
+
+        def filtered_scan(index):
+            len(BenchmarkRecord.objects.filter(name__endswith='7'))
+
+        def ordered_slice(index):
+            list(BenchmarkRecord.objects.order_by('-value')[:10])
+
+        def count(index):
+            BenchmarkRecord.objects.count()
+
+        def update(index):
+            BenchmarkRecord.objects.filter(pk='%010d' % index).update(value=index)
+
+        def delete(index):
+            BenchmarkRecord.objects.filter(pk='%010d' % index).delete()
+
+        operations = {
+            'get_pk': get_pk,
+            'get_indexed': get_indexed,
+            'filtered_scan': filtered_scan,
+            'ordered_slice': ordered_slice,
+            'count': count,
+            'update': update,
+            'delete': delete,
+        }
+
+        # The rows are always inserted, since the other scenarios need them
+        insert_result = _time_operations(insert, xrange(row_count))
+        if 'insert' in self.scenarios:
+            results['insert'] = insert_result
+
+        for scenario in DEFAULT_SCENARIOS:
+            if (scenario == 'insert') or (scenario not in self.scenarios):
+                continue
+            if scenario in ('filtered_scan', 'ordered_slice', 'count'):
+                arguments = xrange(self.scan_repeat)
+            else:
+                arguments = self._sample_indexes(row_count)
+            results[scenario] = _time_operations(operations[scenario], arguments)
+
+        return results
+
+def compare_results(baseline, current, threshold=0.1):
+    """
+    Compares two sets of benchmark results (as saved by the benchmark
+    command). Returns a list of (size, scenario, metric, baseline_value,
+    current_value, is_regression) tuples for the scenarios that are in both.
+    A scenario regressed if its throughput dropped, or its p99 latency grew,
+    by more than the threshold fraction.
+    """
+    comparisons = []
+    baseline_results = baseline.get('results', {})
+    current_results = current.get('results', {})
+    for size in sorted(current_results.keys(), key=int):
+        if size not in baseline_results:
+            continue
+        for scenario in DEFAULT_SCENARIOS:
+            baseline_result = baseline_results[size].get(scenario)
+            current_result = current_results[size].get(scenario)
+            if (baseline_result is None) or (current_result is None):
+                continue
+            baseline_value = baseline_result['ops_per_second']
+            current_value = current_result['ops_per_second']
+            is_regression = current_value < baseline_value * (1.0 - threshold)
+            comparisons.append((size, scenario, 'ops_per_second', baseline_value,
+                                current_value, is_regression))
+            baseline_value = baseline_result['p99_ms']
+            current_value = current_result['p99_ms']
+            is_regression = current_value > baseline_value * (1.0 + threshold)
+            comparisons.append((size, scenario, 'p99_ms', baseline_value,
+                                current_value, is_regression))
+    return comparisons
@@ -0,0 +1,101 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Django cache backend that stores the cache entries in a Cassandra column
+family. Configure it in the CACHES setting:
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_cassandra.cache.CassandraCache',
+            'LOCATION': 'DjangoCache',
+            'OPTIONS': {'DATABASE': 'default'},
+        }
+    }
+
+LOCATION is the name of the column family (created if it doesn't exist) and
+DATABASE is the alias of the Cassandra database whose keyspace it's in. The
+READ_CONSISTENCY_LEVEL and WRITE_CONSISTENCY_LEVEL options override the
+consistency levels of the database. The entries expire with Cassandra TTLs.
+"""
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.core.cache.backends.base import BaseCache
+from django.db import DEFAULT_DB_ALIAS
+
+from .kvstore import KeyValueStore
+
+DEFAULT_CACHE_COLUMN_FAMILY = 'DjangoCache'
+
+class CassandraCache(BaseCache):
+
+    def __init__(self, location, params):
+        super(CassandraCache, self).__init__(params)
+        options = params.get('OPTIONS', {})
+        self._store = KeyValueStore(location or DEFAULT_CACHE_COLUMN_FAMILY,
+                                    options.get('DATABASE', DEFAULT_DB_ALIAS),
+                                    options.get('READ_CONSISTENCY_LEVEL'),
+                                    options.get('WRITE_CONSISTENCY_LEVEL'))
+
+    def _make_key(self, key, version):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    def _get_ttl(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        # A timeout of 0 means that the entry never expires
+        return int(timeout) if timeout > 0 else None
+
+    def add(self, key, value, timeout=None, version=None):
+        # Note that this isn't atomic: two concurrent adds can both succeed
+        key = self._make_key(key, version)
+        if self._store.get(key) is not None:
+            return False
+        self._store.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self._get_ttl(timeout))
+        return True
+
+    def get(self, key, default=None, version=None):
+        value = self._store.get(self._make_key(key, version))
+        if value is None:
+            return default
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=None, version=None):
+        self._store.set(self._make_key(key, version),
+                        pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self._get_ttl(timeout))
+
+    def delete(self, key, version=None):
+        self._store.delete(self._make_key(key, version))
+
+    def get_many(self, keys, version=None):
+        key_map = dict((self._make_key(key, version), key) for key in keys)
+        values = self._store.get_many(key_map.keys())
+        return dict((key_map[key], pickle.loads(value)) for key, value in values.iteritems())
+
+    def set_many(self, data, timeout=None, version=None):
+        items = dict((self._make_key(key, version), pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+                     for key, value in data.iteritems())
+        self._store.set_many(items, self._get_ttl(timeout))
+
+    def delete_many(self, keys, version=None):
+        self._store.delete_many([self._make_key(key, version) for key in keys])
+
+    def clear(self):
+        self._store.clear()
@@ -0,0 +1,186 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Streaming evaluation of the aggregates of a query (Count, Sum, Avg, Min, Max,
+StdDev and Variance), either over all of the matching rows (aggregate) or
+per group of rows (values(...).annotate(...)). The compiler fetches the rows
+a page at a time and folds the stored value of each row into a running
+aggregate of its group, so the memory that's used is proportional to the
+number of groups (and to the number of distinct values for a distinct Count)
+rather than to the number of rows.
+
+The stored values are only decoded where the aggregate needs them: numeric
+values are converted to numbers, but the minimum and maximum of the other
+types are found by comparing the stored strings (the date/time formats sort
+chronologically) and only the result is decoded.
+"""
+
+import decimal
+import math
+
+from django.db.utils import DatabaseError
+
+class CountAggregator(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+
+    def result(self):
+        return self.count
+
+class DistinctCountAggregator(object):
+
+    def __init__(self):
+        self.values = set()
+
+    def add(self, value):
+        self.values.add(value)
+
+    def result(self):
+        return len(self.values)
+
+class SumAggregator(object):
+
+    def __init__(self):
+        self.total = None
+
+    def add(self, value):
+        self.total = value if self.total is None else self.total + value
+
+    def result(self):
+        return self.total
+
+class AvgAggregator(object):
+
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+
+    def add(self, value):
+        self.total += value
+        self.count += 1
+
+    def result(self):
+        return float(self.total) / self.count if self.count else None
+
+class MinAggregator(object):
+
+    def __init__(self):
+        self.value = None
+
+    def add(self, value):
+        if (self.value is None) or (value < self.value):
+            self.value = value
+
+    def result(self):
+        return self.value
+
+class MaxAggregator(MinAggregator):
+
+    def add(self, value):
+        if (self.value is None) or (value > self.value):
+            self.value = value
+
+class VarianceAggregator(object):
+    """
+    Computes the variance (or the standard deviation) in a single pass, with
+    Welford's algorithm.
+    """
+
+    def __init__(self, sample=False, stddev=False):
+        self.sample = sample
+        self.stddev = stddev
+        self.count = 0
+        self.mean = 0.0
+        self.sum_of_squares = 0.0
+
+    def add(self, value):
+        value = float(value)
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.sum_of_squares += delta * (value - self.mean)
+
+    def result(self):
+        count = self.count - 1 if self.sample else self.count
+        if count <= 0:
+            return None
+        variance = self.sum_of_squares / count
+        return math.sqrt(variance) if self.stddev else variance
+
+_NUMERIC_CONVERTERS = {
+    'int': int,
+    'long': long,
+    'counter': long,
+    'float': float,
+}
+
+def _get_numeric_converter(db_type):
+    if db_type.startswith('decimal'):
+        return decimal.Decimal
+    return _NUMERIC_CONVERTERS.get(db_type)
+
+def _identity(value):
+    return value
+
+class AggregateSpec(object):
+    """
+    How an aggregate is evaluated: the column it reads (None for Count('*')),
+    the factory of the aggregator of each group, the converter of the stored
+    values that are added to the aggregator and the converter of its result.
+    """
+
+    def __init__(self, column, create_aggregator, convert_value=_identity, convert_result=_identity):
+        self.column = column
+        self.create_aggregator = create_aggregator
+        self.convert_value = convert_value
+        self.convert_result = convert_result
+
+def get_aggregate_spec(aggregate, column, db_type, convert_value_from_db):
+    """
+    Returns the AggregateSpec of a Django SQL aggregate over the column with
+    the db_type (both are None for Count('*')). convert_value_from_db is the
+    converter of the compiler.
+    """
+    function = aggregate.sql_function
+    if function == 'COUNT':
+        if aggregate.extra.get('distinct'):
+            return AggregateSpec(column, DistinctCountAggregator)
+        return AggregateSpec(column, CountAggregator)
+    if column is None:
+        raise DatabaseError('The %s aggregate needs a field' % function)
+
+    convert_number = _get_numeric_converter(db_type)
+    if function in ('MIN', 'MAX'):
+        aggregator_class = MinAggregator if function == 'MIN' else MaxAggregator
+        if convert_number is not None:
+            return AggregateSpec(column, aggregator_class, convert_number)
+        return AggregateSpec(column, aggregator_class,
+                             convert_result=lambda value: None if value is None else
+                                convert_value_from_db(db_type, value))
+    if convert_number is None:
+        raise DatabaseError('The %s aggregate is only supported for numeric fields' % function)
+    if function == 'SUM':
+        return AggregateSpec(column, SumAggregator, convert_number)
+    if function == 'AVG':
+        return AggregateSpec(column, AvgAggregator, convert_number)
+    if function in ('VAR_POP', 'VAR_SAMP', 'STDDEV_POP', 'STDDEV_SAMP'):
+        sample = function.endswith('SAMP')
+        stddev = function.startswith('STDDEV')
+        return AggregateSpec(column, lambda: VarianceAggregator(sample, stddev), convert_number)
+    raise DatabaseError('The %s aggregate is not supported' % function)
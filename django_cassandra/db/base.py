@@ -23,8 +23,17 @@ import re
 import time
 from .creation import DatabaseCreation
 from .introspection import DatabaseIntrospection
-from .utils import CassandraConnection, CassandraConnectionError, CassandraAccessError
+from .instrumentation import Instrumentation
+from .metadata import invalidate_keyspace_metadata
+from .concurrent import get_query_executor, wait_for_all
+# Connects the signal handlers for dirty field tracking
+from . import tracking
+from .pool import ServerCapabilities, get_server_capabilities, set_server_capabilities, \
+    get_warm_connection_pool, prewarm_connections_once
+from .utils import CassandraConnection, CassandraConnectionError, CassandraAccessError, \
+    call_cassandra, get_cassandra_hosts
 from thrift.transport import TTransport
+from cassandra import Cassandra
 from cassandra.ttypes import *
 
 
@@ -52,8 +61,16 @@ class DatabaseOperations(NonrelDatabaseOperations):
         return None
     
     def sql_flush(self, style, tables, sequence_list):
-        for table_name in tables:
-            self.connection.creation.flush_table(table_name)
+        # The tables are flushed in parallel, with the threads (and their
+        # connections) of the query executor.
+        if len(tables) > 1:
+            executor = get_query_executor(self.connection)
+            futures = [executor.submit(self.connection.creation.flush_table, table_name)
+                       for table_name in tables]
+            wait_for_all(futures)
+        else:
+            for table_name in tables:
+                self.connection.creation.flush_table(table_name)
         return ""
     
 class DatabaseClient(NonrelDatabaseClient):
@@ -76,13 +93,28 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
 
         self.read_consistency_level = self.settings_dict.get('CASSANDRA_READ_CONSISTENCY_LEVEL', ConsistencyLevel.ONE)
         self.write_consistency_level = self.settings_dict.get('CASSANDRA_WRITE_CONSISTENCY_LEVEL', ConsistencyLevel.ONE)
+        # Default socket timeout (in seconds) for the calls to Cassandra
+        self.timeout = self.settings_dict.get('CASSANDRA_TIMEOUT')
         self.max_key_count = self.settings_dict.get('CASSANDRA_MAX_KEY_COUNT', 1000000)
         self.max_column_count = self.settings_dict.get('CASSANDRA_MAX_COLUMN_COUNT', 10000)
+        # Rows are fetched from Cassandra in pages of this many rows. The
+        # page size can never be less than 2, since consecutive pages overlap
+        # by one row.
+        self.fetch_page_size = max(2, min(self.settings_dict.get('CASSANDRA_FETCH_PAGE_SIZE', 1000),
+                                          self.max_key_count))
         self.column_family_def_defaults = self.settings_dict.get('CASSANDRA_COLUMN_FAMILY_DEF_DEFAULT_SETTINGS', {})
+        # How tables are flushed: 'truncate', 'delete' or 'auto'
+        self.flush_strategy = self.settings_dict.get('CASSANDRA_FLUSH_STRATEGY', 'auto')
 
+        self.instrumentation = Instrumentation(self)
         self._db_connection = None
         self.determined_version = False
         
+        # Open the connections in the warm connection pool in the background
+        # the first time the database is used in the process
+        if self.settings_dict.get('CASSANDRA_PREWARM_CONNECTIONS'):
+            prewarm_connections_once(self)
+        
     def configure_connection(self, set_keyspace=False, login=False):
         
         if not self._db_connection.is_connected():
@@ -90,21 +122,34 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
             self.determined_version = False
             
         if not self.determined_version:
-            # Determine which version of Cassandra we're connected to
-            version_string = self._db_connection.get_client().describe_version()
-            try:
-                # FIXME: Should do some version check here to make sure that we're
-                # talking to a cassandra daemon that supports the operations we require
-                m = re.match('^([0-9]+)\.([0-9]+)\.([0-9]+)$', version_string)
-                major_version = int(m.group(1))
-                minor_version = int(m.group(2))
-                patch_version = int(m.group(3))
-                self.determined_version = True
-            except Exception, e:
-                raise DatabaseError('Invalid Thrift version string', e)
+            # The capabilities of the server are only determined by the first
+            # connection to it in the process
+            host = self._db_connection.host
+            port = self._db_connection.port
+            capabilities = get_server_capabilities(host, port)
+            if capabilities is None:
+                # Determine which version of Cassandra we're connected to
+                version_string = call_cassandra(self._db_connection, Cassandra.Client.describe_version)
+                try:
+                    # FIXME: Should do some version check here to make sure that we're
+                    # talking to a cassandra daemon that supports the operations we require
+                    m = re.match('^([0-9]+)\.([0-9]+)\.([0-9]+)$', version_string)
+                    major_version = int(m.group(1))
+                    minor_version = int(m.group(2))
+                    patch_version = int(m.group(3))
+                except Exception, e:
+                    raise DatabaseError('Invalid Thrift version string', e)
+                partitioner = call_cassandra(self._db_connection, Cassandra.Client.describe_partitioner)
+                capabilities = ServerCapabilities(major_version, minor_version, patch_version, partitioner)
+                set_server_capabilities(host, port, capabilities)
             
             # Determine supported features based on the API version
-            self.supports_replication_factor_as_strategy_option = major_version >= 19 and minor_version >= 10
+            self.supports_replication_factor_as_strategy_option = \
+                capabilities.supports_replication_factor_as_strategy_option
+            self.supports_truncate = capabilities.supports_truncate
+            # Key ranges can only be queried with an order preserving partitioner
+            self.preserves_key_order = capabilities.preserves_key_order
+            self.determined_version = True
         
         if login:
             self._db_connection.login()
@@ -113,60 +158,71 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
             try:
                 self._db_connection.set_keyspace()
             except Exception, e:
-                # Set up the default settings for the keyspace
-                keyspace_def_settings = {
-                    'name': self._db_connection.keyspace,
-                    'strategy_class': 'org.apache.cassandra.locator.SimpleStrategy',
-                    'strategy_options': {},
-                    'cf_defs': []}
-            
-                # Apply any overrides for the keyspace settings
-                custom_keyspace_def_settings = self.settings_dict.get('CASSANDRA_KEYSPACE_DEF_SETTINGS')
-                if custom_keyspace_def_settings:
-                    keyspace_def_settings.update(custom_keyspace_def_settings)
-                
-                # Apply any overrides for the replication strategy
-                # Note: This could be done by the user using the 
-                # CASSANDRA_KEYSPACE_DEF_SETTINGS, but the following customizations are
-                # still supported for backwards compatibility with older versions of the backend
-                strategy_class = self.settings_dict.get('CASSANDRA_REPLICATION_STRATEGY')
-                if strategy_class:
-                    keyspace_def_settings['strategy_class'] = strategy_class
-                
-                # Apply an override of the strategy options
-                strategy_options = self.settings_dict.get('CASSANDRA_REPLICATION_STRATEGY_OPTIONS')
-                if strategy_options:
-                    if type(strategy_options) != dict:
-                        raise DatabaseError('CASSANDRA_REPLICATION_STRATEGY_OPTIONS must be a dictionary')
-                    keyspace_def_settings['strategy_options'].update(strategy_options)
-                
-                # Apply an override of the replication factor. Depending on the version of
-                # Cassandra this may be applied to either the strategy options or the top-level
-                # keyspace def settings
-                replication_factor = self.settings_dict.get('CASSANDRA_REPLICATION_FACTOR')
-                replication_factor_parent = keyspace_def_settings['strategy_options'] \
-                    if self.supports_replication_factor_as_strategy_option else keyspace_def_settings
-                if replication_factor:
-                    replication_factor_parent['replication_factor'] = str(replication_factor)
-                elif 'replication_factor' not in replication_factor_parent:
-                    replication_factor_parent['replication_factor'] = '1'
-                
-                keyspace_def = KsDef(**keyspace_def_settings)
-                self._db_connection.get_client().system_add_keyspace(keyspace_def)
+                keyspace_def = KsDef(**self.get_keyspace_def_settings(self._db_connection.keyspace))
+                call_cassandra(self._db_connection, Cassandra.Client.system_add_keyspace, keyspace_def)
+                invalidate_keyspace_metadata(self, keyspace_def.name)
                 self._db_connection.set_keyspace()
                 
     
+    def get_keyspace_def_settings(self, keyspace_name):
+        """
+        Returns the settings of the KsDef that's used to create the keyspace,
+        without any column families.
+        """
+        # Set up the default settings for the keyspace
+        keyspace_def_settings = {
+            'name': keyspace_name,
+            'strategy_class': 'org.apache.cassandra.locator.SimpleStrategy',
+            'strategy_options': {},
+            'cf_defs': []}
+    
+        # Apply any overrides for the keyspace settings
+        custom_keyspace_def_settings = self.settings_dict.get('CASSANDRA_KEYSPACE_DEF_SETTINGS')
+        if custom_keyspace_def_settings:
+            keyspace_def_settings.update(custom_keyspace_def_settings)
+        
+        # Apply any overrides for the replication strategy
+        # Note: This could be done by the user using the 
+        # CASSANDRA_KEYSPACE_DEF_SETTINGS, but the following customizations are
+        # still supported for backwards compatibility with older versions of the backend
+        strategy_class = self.settings_dict.get('CASSANDRA_REPLICATION_STRATEGY')
+        if strategy_class:
+            keyspace_def_settings['strategy_class'] = strategy_class
+        
+        # Apply an override of the strategy options
+        strategy_options = self.settings_dict.get('CASSANDRA_REPLICATION_STRATEGY_OPTIONS')
+        if strategy_options:
+            if type(strategy_options) != dict:
+                raise DatabaseError('CASSANDRA_REPLICATION_STRATEGY_OPTIONS must be a dictionary')
+            keyspace_def_settings['strategy_options'].update(strategy_options)
+        
+        # Apply an override of the replication factor. Depending on the version of
+        # Cassandra this may be applied to either the strategy options or the top-level
+        # keyspace def settings
+        replication_factor = self.settings_dict.get('CASSANDRA_REPLICATION_FACTOR')
+        replication_factor_parent = keyspace_def_settings['strategy_options'] \
+            if self.supports_replication_factor_as_strategy_option else keyspace_def_settings
+        if replication_factor:
+            replication_factor_parent['replication_factor'] = str(replication_factor)
+        elif 'replication_factor' not in replication_factor_parent:
+            replication_factor_parent['replication_factor'] = '1'
+        
+        return keyspace_def_settings
+    
     def get_db_connection(self, set_keyspace=False, login=False):
+        if not self._db_connection:
+            # Use a connection that was opened in the background if there is one
+            keyspace = self.settings_dict.get('NAME') or 'django'
+            self._db_connection = get_warm_connection_pool(self.alias, keyspace).get()
+            if self._db_connection:
+                self._db_connection.instrumentation = self.instrumentation
+            
         if not self._db_connection:
             # Get the host and port specified in the database backend settings.
-            # Default to the standard Cassandra settings.
-            host = self.settings_dict.get('HOST')
-            if not host or host == '':
-                host = 'localhost'
-                
-            port = self.settings_dict.get('PORT')
-            if not port or port == '':
-                port = 9160
+            # Default to the standard Cassandra settings. If several hosts
+            # are configured, the first one is used for this connection (the
+            # others are used for hedged reads).
+            host, port = get_cassandra_hosts(self.settings_dict)[0]
                 
             keyspace = self.settings_dict.get('NAME')
             if keyspace == None:
@@ -176,7 +232,8 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
             password = self.settings_dict.get('PASSWORD')
             
             # Create our connection wrapper
-            self._db_connection = CassandraConnection(host, port, keyspace, user, password)
+            self._db_connection = CassandraConnection(host, port, keyspace, user, password, self.timeout)
+            self._db_connection.instrumentation = self.instrumentation
             
         try:
             self.configure_connection(set_keyspace, login)
@@ -17,19 +17,34 @@ import sys
 import traceback
 import datetime
 import decimal
+import time
 
+from itertools import islice
 from django.db.models import ForeignKey
+from django.db.models.expressions import ExpressionNode, F
 from django.db.models.sql.where import AND, OR, WhereNode
-from django.db.models.sql.constants import MULTI
+from django.db.models.sql.constants import MULTI, SINGLE
 from django.db.utils import DatabaseError
+from django.utils.encoding import smart_str
 
-from functools import wraps
+from functools import partial, wraps
 
 from djangotoolbox.db.basecompiler import NonrelQuery, NonrelCompiler, \
     NonrelInsertCompiler, NonrelUpdateCompiler, NonrelDeleteCompiler
 
 from .utils import *
 from .predicate import *
+from .profiling import start_query_profile, finish_query_profile
+from .options import get_operation_options
+from .hedging import get_hedged_reader, call_cassandra_hedged
+from .metadata import get_keyspace_metadata
+from .storage import get_storage_format
+from .widerow import get_wide_row_layout
+from .views import get_materialized_views, get_source_columns, add_mutations
+from .aggregation import get_aggregate_spec
+from .tracking import is_tracking_enabled, record_loaded_row, get_loaded_values, \
+    set_loaded_values, get_saved_instance
+from ..fields import CounterField, is_counter_model
 
 from uuid import uuid4
 from cassandra import Cassandra
@@ -59,21 +74,91 @@ class CassandraQuery(NonrelQuery):
         self.root_predicate = None
         self.ordering_spec = None
         self.cached_results = None
+        # All of the rows fetched by the query share this table of column names
+        self.column_table = ColumnTable()
+        # Set by the compiler when the query is profiled
+        self.profile = None
+        self.options = get_operation_options(self.connection, self.query.model)
+        self.hedged_reader = get_hedged_reader(self.connection, self.query.model)
+        self.is_counter_column_family = is_counter_model(self.query.model)
+        self.storage_format = get_storage_format(self.connection, self.query.model)
+        # The row key is set as the value of the primary key column of the
+        # rows that don't store it as a column
+        self.key_column = None if self.storage_format.stores_pk_column else self.pk_column
         
+        # The filters and the ordering refer to the columns the fields are
+        # stored in
         self.indexed_columns = []
         self.field_name_to_column_name = {}
         for field in fields:
-            column_name = field.db_column if field.db_column else field.column
+            column_name = self.storage_format.get_storage_column(field.column)
             if field.db_index:
                 self.indexed_columns.append(column_name)
             self.field_name_to_column_name[field.name] = column_name
+        
+        # Use the secondary indexes that really exist in the column family
+        # (e.g. db_index may have been added to a field after the column
+        # family was created), if its metadata is available.
+        metadata = get_keyspace_metadata(self.connection)
+        if metadata:
+            indexed_columns = metadata.get_indexed_columns(self.column_family)
+            if indexed_columns is not None:
+                self.indexed_columns = list(indexed_columns)
+        
+        # The instances of a wide row model with the same partition key are
+        # fetched with a slice of its row, which is planned like a lookup on
+        # a secondary index of the partition key column.
+        self.wide_row_layout = get_wide_row_layout(self.connection, self.query.model)
+        if self.wide_row_layout is not None:
+            self.indexed_columns = [self.wide_row_layout.partition_column]
+        # The number of rows the query is limited to, if it's known when the
+        # rows are fetched
+        self.limit_hint = None
+        # The columns that are fetched for each row (None for all of them)
+        self.fetch_columns = None
                 
     # This is needed for debugging
     def __repr__(self):
         # TODO: add some meaningful query string for debugging
         return '<CassandraQuery: ...>'
 
+    def _call_cassandra(self, fn, *args):
+        return call_cassandra_with_timeout(self.connection.db_connection,
+            self.options.timeout, fn, *args)
+    
+    def _read_cassandra(self, fn, *args):
+        if self.hedged_reader is None:
+            return self._call_cassandra(fn, *args)
+        return call_cassandra_hedged(self.connection.db_connection,
+            self.hedged_reader, self.options.timeout, fn, *args)
+    
+    def set_fetch_columns(self, columns):
+        """
+        Restricts the columns that are fetched for each row to the given ones
+        and the ones the filters test. An empty row is a deleted row, so this
+        is only done if the key column is stored in every row.
+        """
+        if not self.storage_format.stores_pk_column:
+            return
+        columns = set(columns)
+        columns.add(self.pk_column)
+        if self.root_predicate is not None:
+            columns.update(get_predicate_columns(self.root_predicate))
+        self.fetch_columns = sorted(columns)
+    
+    def _get_slice_predicate(self):
+        if self.fetch_columns is not None:
+            return SlicePredicate(column_names=self.fetch_columns)
+        return SlicePredicate(slice_range=SliceRange(start='', finish='',
+                                                     count=self.connection.max_column_count))
+    
+    def record_stage(self, stage, start_time, rows_in, rows_out):
+        if self.profile is not None:
+            self.profile.record(stage, time.time() - start_time, rows_in, rows_out)
+    
     def _convert_key_slice_to_rows(self, key_slice):
+        if self.wide_row_layout is not None:
+            return self._convert_wide_row_key_slice_to_rows(key_slice)
         rows = []
         for element in key_slice:
             if element.columns:
@@ -82,31 +167,57 @@ class CassandraQuery(NonrelQuery):
         return rows
     
     def _convert_column_list_to_row(self, column_list, pk_column_name, pk_value):
-        row = {}
-        # FIXME: When we add code to allow primary keys that also are indexed,
-        # then we can change this to not set the primary key column in that case.
-        # row[pk_column_name] = pk_value
-        for column in column_list:
-            row[column.column.name] = column.column.value
-        return row
+        return convert_column_list_to_row(self.column_table, column_list,
+                                          self.key_column, pk_value)
 
+    def _get_key_range_slice_pages(self, column_parent, slice_predicate, start_key, end_key):
+        """
+        Pages through the rows in the given key range, yielding one list of
+        converted rows for each get_range_slices call. Only a single page of
+        rows (and the Thrift objects it was built from) is alive at a time.
+        """
+        page_size = self.connection.fetch_page_size
+        skip_key = None
+        while True:
+            start_time = time.time()
+            key_range = KeyRange(start_key=start_key, end_key=end_key, count=page_size)
+            key_slice = self._read_cassandra(Cassandra.Client.get_range_slices,
+                column_parent, slice_predicate, key_range,
+                self.options.read_consistency_level)
+            fetch_count = len(key_slice)
+            if fetch_count == 0:
+                break
+            last_key = key_slice[-1].key
+            # The start key of a key range is inclusive, so every page after
+            # the first one begins with the last row of the previous page.
+            if key_slice[0].key == skip_key:
+                key_slice = key_slice[1:]
+            rows = self._convert_key_slice_to_rows(key_slice)
+            key_slice = None
+            self.record_stage('fetch', start_time, fetch_count, len(rows))
+            if rows:
+                yield rows
+            if fetch_count < page_size or last_key == end_key:
+                break
+            start_key = skip_key = last_key
+    
+    def _get_rows_by_pk_pages(self, range_predicate):
 
-    def _get_rows_by_pk(self, range_predicate):
-
-        db_connection = self.connection.db_connection
         column_parent = ColumnParent(column_family=self.column_family)
-        slice_predicate = SlicePredicate(slice_range=SliceRange(start='',
-            finish='', count=self.connection.max_column_count))
+        slice_predicate = self._get_slice_predicate()
         
         if range_predicate._is_exact():
-            column_list = call_cassandra_with_reconnect(db_connection,
-               Cassandra.Client.get_slice, range_predicate.start,
-                column_parent, slice_predicate, self.connection.read_consistency_level)
+            start_time = time.time()
+            column_list = self._read_cassandra(Cassandra.Client.get_slice,
+                range_predicate.start, column_parent, slice_predicate,
+                self.options.read_consistency_level)
+            row_count = 1 if column_list else 0
             if column_list:
                 row = self._convert_column_list_to_row(column_list, self.pk_column, range_predicate.start)
-                rows = [row]
-            else:
-                rows = []
+            column_list = None
+            self.record_stage('fetch', start_time, row_count, row_count)
+            if row_count:
+                yield [row]
         else:
             if range_predicate.start != None:
                 key_start = range_predicate.start
@@ -122,17 +233,11 @@ class CassandraQuery(NonrelQuery):
             else:
                 key_end = ''
             
-            key_range = KeyRange(start_key=key_start, end_key=key_end,
-                count=self.connection.max_key_count)
-            key_slice = call_cassandra_with_reconnect(db_connection,
-                Cassandra.Client.get_range_slices, column_parent,
-                slice_predicate, key_range, self.connection.read_consistency_level)
-            
-            rows = self._convert_key_slice_to_rows(key_slice)
-                
-        return rows
+            for rows in self._get_key_range_slice_pages(column_parent,
+                    slice_predicate, key_start, key_end):
+                yield rows
     
-    def _get_rows_by_indexed_column(self, range_predicate):
+    def _get_rows_by_indexed_column_pages(self, range_predicate):
         # Construct the index expression for the range predicate
         index_expressions = []
         if ((range_predicate.start != None) and
@@ -159,51 +264,280 @@ class CassandraQuery(NonrelQuery):
                 
         assert(len(index_expressions) > 0)
                
-        # Now make the call to cassandra to get the key slice
-        db_connection = self.connection.db_connection
+        # Now make the calls to cassandra to get the key slices, a page at a time
         column_parent = ColumnParent(column_family=self.column_family)
-        index_clause = IndexClause(index_expressions, '', self.connection.max_key_count)
-        slice_predicate = SlicePredicate(slice_range=SliceRange(start='', finish='', count=self.connection.max_column_count))
-        
-        key_slice = call_cassandra_with_reconnect(db_connection,
-            Cassandra.Client.get_indexed_slices,
-            column_parent, index_clause, slice_predicate,
-            self.connection.read_consistency_level)
-        rows = self._convert_key_slice_to_rows(key_slice)
-        
+        slice_predicate = self._get_slice_predicate()
+        page_size = self.connection.fetch_page_size
+        start_key = ''
+        skip_key = None
+        while True:
+            start_time = time.time()
+            index_clause = IndexClause(index_expressions, start_key, page_size)
+            key_slice = self._read_cassandra(Cassandra.Client.get_indexed_slices,
+                column_parent, index_clause, slice_predicate,
+                self.options.read_consistency_level)
+            fetch_count = len(key_slice)
+            if fetch_count == 0:
+                break
+            last_key = key_slice[-1].key
+            if key_slice[0].key == skip_key:
+                key_slice = key_slice[1:]
+            rows = self._convert_key_slice_to_rows(key_slice)
+            key_slice = None
+            self.record_stage('fetch', start_time, fetch_count, len(rows))
+            if rows:
+                yield rows
+            if fetch_count < page_size:
+                break
+            start_key = skip_key = last_key
+    
+    def _convert_wide_row_key_slice_to_rows(self, key_slice):
+        rows = []
+        for element in key_slice:
+            if len(element.columns) >= self.connection.max_column_count:
+                # The range slice only returned the first columns of the row
+                for page in self._get_wide_row_pages(element.key, None, False):
+                    rows.extend(page)
+            elif element.columns:
+                columns = [column.column for column in element.columns]
+                rows.extend(self.wide_row_layout.convert_columns_to_rows(self.column_table,
+                                                                         element.key, columns))
         return rows
     
-    def get_row_range(self, range_predicate):
-        pk_column = self.query.get_meta().pk.column
-        if range_predicate.column == pk_column:
-            rows = self._get_rows_by_pk(range_predicate)
+    def _get_wide_row_pages(self, key, clustering_range, reversed):
+        """
+        Pages through the instances in the wide row with the key whose
+        clustering values are in the range (a RangePredicate or None), in the
+        order of the clustering values, with get_slice calls. The columns of
+        the last instance of a page may continue in the next page, so they're
+        held back until the next page is fetched.
+        """
+        layout = self.wide_row_layout
+        column_parent = ColumnParent(column_family=self.column_family)
+        start, finish = layout.get_slice_bounds(clustering_range, reversed)
+        page_size = self.connection.fetch_page_size
+        if self.limit_hint:
+            page_size = min(page_size, self.limit_hint)
+        # One more column than the columns of the instances of the page, so
+        # that a page that ends with a complete instance is known to
+        column_count = page_size * layout.columns_per_instance + 1
+        pending_columns = []
+        skip_name = None
+        while True:
+            start_time = time.time()
+            slice_predicate = SlicePredicate(slice_range=SliceRange(start=start,
+                finish=finish, reversed=reversed, count=column_count))
+            column_list = self._read_cassandra(Cassandra.Client.get_slice,
+                key, column_parent, slice_predicate, self.options.read_consistency_level)
+            fetch_count = len(column_list)
+            columns = [column.column for column in column_list]
+            column_list = None
+            # The start of a slice is inclusive, so every page after the first
+            # one begins with the last column of the previous page.
+            if columns and (columns[0].name == skip_name):
+                columns = columns[1:]
+            done = fetch_count < column_count
+            if not done:
+                start = skip_name = columns[-1].name
+            columns = pending_columns + columns
+            pending_columns = []
+            if not done and columns:
+                last_value = layout.get_encoded_value(columns[-1].name)
+                split_index = len(columns)
+                while (split_index > 0) and \
+                    (layout.get_encoded_value(columns[split_index - 1].name) == last_value):
+                    split_index -= 1
+                pending_columns = columns[split_index:]
+                columns = columns[:split_index]
+            rows = layout.convert_columns_to_rows(self.column_table, key, columns)
+            self.record_stage('fetch', start_time, fetch_count, len(rows))
+            if rows:
+                yield rows
+            if done:
+                break
+    
+    def _get_wide_row_range_pages(self, range_predicate):
+        layout = self.wide_row_layout
+        if range_predicate._is_exact():
+            if range_predicate.column == layout.partition_column:
+                return self._get_wide_row_pages(range_predicate.start,
+                    self._get_clustering_range(), self._is_clustering_order_reversed())
+            if range_predicate.column == self.pk_column:
+                key_parts = layout.split_key(range_predicate.start)
+                if key_parts is None:
+                    return iter([])
+                partition_value, clustering_value = key_parts
+                clustering_range = RangePredicate(layout.clustering_column,
+                    clustering_value, True, clustering_value, True)
+                return self._get_wide_row_pages(partition_value, clustering_range, False)
+        # The instances aren't stored in the order of their keys, so any
+        # other range of keys is found by scanning all of the instances
+        return self._filter_row_pages(self.get_all_row_pages(), range_predicate)
+    
+    def _filter_row_pages(self, pages, predicate):
+        for rows in pages:
+            start_time = time.time()
+            row_count = len(rows)
+            rows = [row for row in rows if predicate.row_matches(row)]
+            self.record_stage('filter', start_time, row_count, len(rows))
+            if rows:
+                yield rows
+    
+    def _get_and_children(self):
+        if isinstance(self.root_predicate, CompoundPredicate) and \
+            (self.root_predicate.op == COMPOUND_OP_AND) and not self.root_predicate.negated:
+            return self.root_predicate.children
+        return []
+    
+    def _get_clustering_range(self):
+        """
+        Returns the range of the clustering values of the instances that match
+        the query, or None if it's not restricted.
+        """
+        for child in self._get_and_children():
+            if isinstance(child, RangePredicate) and \
+                (child.column == self.wide_row_layout.clustering_column):
+                return child
+        return None
+    
+    def _is_clustering_order_reversed(self):
+        return bool(self.ordering_spec) and \
+            (self.ordering_spec[0][0] == self.wide_row_layout.clustering_column) and \
+            self.ordering_spec[0][1]
+    
+    def _is_ordered_by_wide_row_slice(self):
+        """
+        Returns True if the query is ordered by the clustering field and the
+        rows are fetched with a slice of a single wide row (or by their key),
+        so they're already in the right order.
+        """
+        layout = self.wide_row_layout
+        if (layout is None) or (len(self.ordering_spec) != 1) or \
+            (self.ordering_spec[0][0] != layout.clustering_column):
+            return False
+        is_single_row = False
+        for child in self._get_and_children():
+            if isinstance(child, RangePredicate):
+                if child.column == self.pk_column:
+                    # Ranges of keys are scanned, and take precedence over the
+                    # partition key lookup
+                    if not child._is_exact():
+                        return False
+                    is_single_row = True
+                elif (child.column == layout.partition_column) and child._is_exact():
+                    is_single_row = True
+        return is_single_row
+    
+    def get_row_range_pages(self, range_predicate):
+        if self.wide_row_layout is not None:
+            return self._get_wide_row_range_pages(range_predicate)
+        if range_predicate.column == self.pk_column:
+            return self._get_rows_by_pk_pages(range_predicate)
         else:
             assert(range_predicate.column in self.indexed_columns)
-            rows = self._get_rows_by_indexed_column(range_predicate)
+            return self._get_rows_by_indexed_column_pages(range_predicate)
+    
+    def get_row_range(self, range_predicate):
+        rows = []
+        for page in self.get_row_range_pages(range_predicate):
+            rows.extend(page)
         return rows
     
-    def get_all_rows(self):
-        # TODO: Could factor this code better
-        db_connection = self.connection.db_connection
+    def get_all_row_pages(self):
         column_parent = ColumnParent(column_family=self.column_family)
-        slice_predicate = SlicePredicate(slice_range=SliceRange(start='', finish='', count=self.connection.max_column_count))
-        key_range = KeyRange(start_token = '0', end_token = '0', count=self.connection.max_key_count)
-        #end_key = u'\U0010ffff'.encode('utf-8')
-        #key_range = KeyRange(start_key='\x01', end_key=end_key, count=self.connection.max_key_count)
-        
-        key_slice = call_cassandra_with_reconnect(db_connection,
-            Cassandra.Client.get_range_slices, column_parent,
-            slice_predicate, key_range, self.connection.read_consistency_level)
-        rows = self._convert_key_slice_to_rows(key_slice)
-        
+        slice_predicate = self._get_slice_predicate()
+        return self._get_key_range_slice_pages(column_parent, slice_predicate, '', '')
+    
+    def get_all_rows(self):
+        rows = []
+        for page in self.get_all_row_pages():
+            rows.extend(page)
         return rows
     
+    def _get_rows_by_key_values_pages(self, key_values, filter_predicates):
+        """
+        Fetches the rows with the given keys with multiget_slice, a page of
+        keys per call, and evaluates the other predicates of the query over
+        each page.
+        """
+        column_parent = ColumnParent(column_family=self.column_family)
+        slice_predicate = self._get_slice_predicate()
+        page_size = self.connection.fetch_page_size
+        unique_key_values = []
+        seen_key_values = set()
+        for key in key_values:
+            if key not in seen_key_values:
+                seen_key_values.add(key)
+                unique_key_values.append(key)
+        for index in range(0, len(unique_key_values), page_size):
+            keys = unique_key_values[index:index + page_size]
+            start_time = time.time()
+            results = self._read_cassandra(Cassandra.Client.multiget_slice, keys,
+                column_parent, slice_predicate, self.options.read_consistency_level)
+            rows = [self._convert_column_list_to_row(results[key], self.pk_column, key)
+                    for key in keys if results.get(key)]
+            results = None
+            self.record_stage('fetch', start_time, len(keys), len(rows))
+            if rows and filter_predicates:
+                start_time = time.time()
+                row_count = len(rows)
+                rows = self.root_predicate.filter_rows(rows, filter_predicates)
+                self.record_stage('filter', start_time, row_count, len(rows))
+            if rows:
+                yield rows
+    
+    def _get_key_values_lookup(self):
+        """
+        Returns a tuple of the keys of the rows that can match the query and
+        the predicates that still have to be evaluated for them if the query
+        looks up several keys (e.g. pk__in=[...]), or None otherwise.
+        """
+        if self.wide_row_layout is not None:
+            return None
+        key_values = get_exact_key_values(self.root_predicate, self.pk_column)
+        filter_predicates = []
+        if (key_values is None) and isinstance(self.root_predicate, CompoundPredicate) and \
+            (self.root_predicate.op == COMPOUND_OP_AND) and not self.root_predicate.negated:
+            for child in self.root_predicate.children:
+                key_values = get_exact_key_values(child, self.pk_column)
+                if key_values is not None:
+                    filter_predicates = [predicate for predicate in self.root_predicate.children
+                                         if predicate is not child]
+                    break
+        # A single key is looked up with get_slice by the predicate itself
+        if (key_values is None) or (len(key_values) == 1):
+            return None
+        return key_values, filter_predicates
+    
+    def _get_query_result_pages(self):
+        assert(self.root_predicate != None)
+        key_values_lookup = self._get_key_values_lookup()
+        if key_values_lookup is not None:
+            return self._get_rows_by_key_values_pages(*key_values_lookup)
+        return self.root_predicate.get_matching_row_pages(self)
+    
+    def _iter_query_results(self):
+        # Generator pipeline used when the results don't need to be sorted:
+        # the rows are fetched, filtered and yielded a page at a time, and
+        # nothing is retained once a page has been consumed.
+        if self.cached_results != None:
+            for row in self.cached_results:
+                yield row
+        else:
+            for page in self._get_query_result_pages():
+                for row in page:
+                    yield row
+    
     def _get_query_results(self):
         if self.cached_results == None:
-            assert(self.root_predicate != None)
-            self.cached_results = self.root_predicate.get_matching_rows(self)
+            results = []
+            for page in self._get_query_result_pages():
+                results.extend(page)
             if self.ordering_spec:
-                sort_rows(self.cached_results, self.ordering_spec)
+                start_time = time.time()
+                sort_rows(results, self.ordering_spec)
+                self.record_stage('sort', start_time, len(results), len(results))
+            self.cached_results = results
         return self.cached_results
     
     @safe_call
@@ -216,9 +550,17 @@ class CassandraQuery(NonrelQuery):
             if high_mark is not None and high_mark <= low_mark:
                 return
             
-            results = self._get_query_results()
-            if low_mark is not None or high_mark is not None:
-                results = results[low_mark:high_mark]
+            if self.ordering_spec and not self._is_ordered_by_wide_row_slice():
+                # Sorting requires all of the matching rows, so in this
+                # case the results are fetched all at once and cached.
+                results = self._get_query_results()
+                if low_mark is not None or high_mark is not None:
+                    results = results[low_mark:high_mark]
+            else:
+                self.limit_hint = high_mark
+                results = self._iter_query_results()
+                if low_mark is not None or high_mark is not None:
+                    results = islice(results, low_mark or 0, high_mark)
         except Exception, e:
             # FIXME: Can get rid of this exception handling code eventually,
             # but it's useful for debugging for now.
@@ -233,21 +575,44 @@ class CassandraQuery(NonrelQuery):
         # TODO: This could be implemented more efficiently for simple predicates
         # where we could call the count method in the Cassandra Thrift API.
         # We can optimize for that later
-        results = self._get_query_results()
-        return len(results)
+        if self.cached_results != None:
+            return len(self.cached_results)
+        count = 0
+        for page in self._get_query_result_pages():
+            count += len(page)
+            if limit is not None and count >= limit:
+                return limit
+        return count
     
     @safe_call
     def delete(self):
-        results = self._get_query_results()
         timestamp = get_next_timestamp()
         column_family = self.query.get_meta().db_table
-        mutation_map = {}
-        for item in results:
-            mutation_map[item[self.pk_column]] = {column_family: [Mutation(deletion=Deletion(timestamp=timestamp))]}
-        db_connection = self.connection.db_connection
-        call_cassandra_with_reconnect(db_connection,
-            Cassandra.Client.batch_mutate, mutation_map,
-            self.connection.write_consistency_level)
+        layout = self.wide_row_layout
+        views = get_materialized_views(self.query.model)
+        none_value = self.compiler.SPECIAL_NONE_VALUE
+        for page in self._get_query_result_pages():
+            mutation_map = {}
+            for item in page:
+                # The entries of the row are deleted from the materialized views
+                for view in views:
+                    old_values = dict((column, item.get(self.storage_format.get_storage_column(column)))
+                                      for column in view.source_columns)
+                    view.add_mutations(mutation_map, item[self.pk_column], old_values, None,
+                                       none_value, timestamp)
+                if layout is not None:
+                    # Only the columns of the instance are deleted from its row
+                    encoded_value = layout.encode_clustering_value(item[layout.clustering_column])
+                    predicate = SlicePredicate(column_names=layout.get_instance_column_names(encoded_value))
+                    mutation = Mutation(deletion=Deletion(timestamp=timestamp, predicate=predicate))
+                    partition_mutations = mutation_map.setdefault(item[layout.partition_column],
+                                                                  {column_family: []})
+                    partition_mutations[column_family].append(mutation)
+                else:
+                    add_mutations(mutation_map, item[self.pk_column], column_family,
+                                  [Mutation(deletion=Deletion(timestamp=timestamp))])
+            self._call_cassandra(Cassandra.Client.batch_mutate, mutation_map,
+                self.options.write_consistency_level)
         
 
     @safe_call
@@ -282,6 +647,7 @@ class CassandraQuery(NonrelQuery):
             column, lookup_type, db_type, value = self._decode_child(node)
             db_value = self.convert_value_for_db(db_type, value)
             assert parent_predicate
+            column = self.storage_format.get_storage_column(column)
             parent_predicate.add_filter(column, lookup_type, db_value)
             predicate = None
             
@@ -310,70 +676,442 @@ class CassandraQuery(NonrelQuery):
         assert isinstance(filters,WhereNode)
         self.remove_unnecessary_nodes(filters, True)
         self.root_predicate = self.init_predicate(None, filters)
+        self._add_compound_key_ranges()
+        
+    def _add_compound_key_ranges(self):
+        """
+        With an order preserving partitioner the lookups on a leading prefix
+        of the fields of a compound key select a range of keys, so they're
+        turned into a key range predicate.
+        """
+        if not getattr(self.connection, 'preserves_key_order', False) or \
+            (self.wide_row_layout is not None):
+            return
+        try:
+            compound_key_fields, separator = get_compound_key_spec(self.connection, self.query.model)
+        except DatabaseError:
+            return
+        if compound_key_fields:
+            fields = dict((field.attname, field) for field in self.query.model._meta.local_fields)
+            key_columns = []
+            string_columns = []
+            for field_name in compound_key_fields:
+                column = self.storage_format.get_storage_column(fields[field_name].column)
+                key_columns.append(column)
+                if fields[field_name].db_type(connection=self.connection) in ('text', 'id'):
+                    string_columns.append(column)
+            add_compound_key_ranges(self.root_predicate, self.pk_column, key_columns,
+                                    str(separator), string_columns)
+        
+def _identity(value):
+    return value
+
+def _convert_value_from_db(db_type, value):
+    # Converts a value from its storage format in Cassandra, for
+    # SQLCompiler.convert_value_from_db and the lazily decoded values
+    if value == SQLCompiler.SPECIAL_NONE_VALUE or value is None:
+        return None
+    
+    if  db_type.startswith('ListField:'):
+        db_sub_type = db_type.split(':', 1)[1]
+        value = convert_string_to_list(value)
+        if isinstance(value, (list, tuple)) and len(value):
+            value = [_convert_value_from_db(db_sub_type, subvalue)
+                     for subvalue in value]
+    elif db_type == 'date':
+        dt = datetime.datetime.strptime(value, '%Y-%m-%d')
+        value = dt.date()
+    elif db_type == 'datetime':
+        value = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+    elif db_type == 'time':
+        dt = datetime.datetime.strptime(value, '%H:%M:%S.%f')
+        value = dt.time()
+    elif db_type == 'bool':
+        value = value.lower() == 'true'
+    elif (db_type == 'int') or (db_type == 'counter'):
+        value = int(value)
+    elif db_type == 'long':
+        value = long(value)
+    elif db_type == 'float':
+        value = float(value)
+    #elif db_type == 'id':
+    #    value = unicode(value).decode('utf-8')
+    elif db_type.startswith('decimal'):
+        value = decimal.Decimal(value)
+    elif isinstance(value, str):
+        # always retrieve strings as unicode (it is possible that old datasets
+        # contain non unicode strings, nevertheless work with unicode ones)
+        value = value.decode('utf-8')
+        
+    return value
+
+def _convert_field_value(db_type, field, value):
+    if value is not None:
+        value = _convert_value_from_db(db_type, value)
+    else:
+        value = field.get_default()
+    if not field.null and value is None:
+        raise DatabaseError("Non-nullable field %s can't be None!" % field.name)
+    return value
+
+def _get_counter_value(value, none_value):
+    # A counter that's None (or isn't stored) is 0
+    if (value is None) or (value == none_value):
+        return 0
+    return value
+
+class LazyFieldValue(object):
+    """
+    Placeholder for a field value that's stored in the model instance in
+    place of the decoded value when lazy field decoding is enabled. It keeps
+    the raw value from Cassandra and is decoded with converter (and replaced
+    with the decoded value) by LazyFieldDescriptor the first time the
+    attribute is accessed.
+    """
+    
+    __slots__ = ('field', 'converter', 'raw_value')
+    
+    def __init__(self, field, converter, raw_value):
+        self.field = field
+        self.converter = converter
+        self.raw_value = raw_value
+        
+    def decode(self):
+        return self.converter(self.field, self.raw_value)
+    
+    def __reduce__(self):
+        # Model instances that are pickled get the decoded value
+        return (_identity, (self.decode(),))
+
+class LazyFieldDescriptor(object):
+    """
+    Descriptor installed on the models that use lazy field decoding for
+    each of their (non-relation) field attributes.
+    """
+    
+    def __init__(self, attname):
+        self.attname = attname
         
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        try:
+            value = instance.__dict__[self.attname]
+        except KeyError:
+            raise AttributeError(self.attname)
+        if type(value) is LazyFieldValue:
+            value = value.decode()
+            instance.__dict__[self.attname] = value
+        return value
+    
+    def __set__(self, instance, value):
+        instance.__dict__[self.attname] = value
+
+def get_lazy_field_attnames(model):
+    """
+    Returns the set of the field attribute names of the model that are decoded
+    lazily, installing the descriptors for them the first time it's called
+    for the model. Fields that already have a descriptor of their own
+    (e.g. FileField) are always decoded eagerly.
+    """
+    lazy_attnames = model.__dict__.get('_cassandra_lazy_attnames')
+    if lazy_attnames is None:
+        lazy_attnames = set()
+        for field in model._meta.fields:
+            class_attribute = getattr(model, field.attname, None)
+            if isinstance(class_attribute, LazyFieldDescriptor) or \
+                not hasattr(class_attribute, '__get__'):
+                setattr(model, field.attname, LazyFieldDescriptor(field.attname))
+                lazy_attnames.add(field.attname)
+        model._cassandra_lazy_attnames = lazy_attnames
+    return lazy_attnames
+
+def get_compound_key_spec(connection, model):
+    """
+    Returns a tuple of the list of the columns of the fields that form the
+    compound key of the model (defined by COMPOUND_KEY_FIELDS in its
+    CassandraSettings), or None if it doesn't have a compound key, and the
+    separator of the values of the fields in the key.
+    """
+    compound_key_fields = None
+    separator = None
+    if hasattr(model, 'CassandraSettings'):
+        if hasattr(model.CassandraSettings, 'ADJUSTED_COMPOUND_KEY_FIELDS'):
+            compound_key_fields = model.CassandraSettings.ADJUSTED_COMPOUND_KEY_FIELDS
+        elif hasattr(model.CassandraSettings, 'COMPOUND_KEY_FIELDS'):
+            compound_key_fields = []
+            for field_name in model.CassandraSettings.COMPOUND_KEY_FIELDS:
+                field_class = None
+                for lf in model._meta.local_fields:
+                    if lf.name == field_name:
+                        field_class = lf
+                        break
+                if field_class is None:
+                    raise DatabaseError('Invalid compound key field')
+                if type(field_class) is ForeignKey:
+                    field_name += '_id'
+                compound_key_fields.append(field_name)
+            model.CassandraSettings.ADJUSTED_COMPOUND_KEY_FIELDS = compound_key_fields
+        separator = model.CassandraSettings.COMPOUND_KEY_SEPARATOR \
+            if hasattr(model.CassandraSettings, 'COMPOUND_KEY_SEPARATOR') \
+            else connection.settings_dict.get('CASSANDRA_COMPOUND_KEY_SEPARATOR', '|')
+    return compound_key_fields, separator
+
 class SQLCompiler(NonrelCompiler):
     query_class = CassandraQuery
 
     SPECIAL_NONE_VALUE = "\b"
+    
+    # The results of the update/insert/delete compilers are consumed by the
+    # backend itself, so they're never decoded lazily.
+    supports_lazy_field_decoding = True
 
+    def _get_lazy_field_attnames(self):
+        """
+        Returns the field attributes that should be decoded lazily for this
+        query. Lazy decoding is enabled with the LAZY_FIELD_DECODING setting in
+        the CassandraSettings of the model (or CASSANDRA_LAZY_FIELD_DECODING in
+        the database settings) and only applies to queries that construct
+        model instances, not values()/values_list() queries.
+        """
+        if not self.supports_lazy_field_decoding or not self.query.default_cols:
+            return None
+        model = self.query.model
+        default = self.connection.settings_dict.get('CASSANDRA_LAZY_FIELD_DECODING', False)
+        if not get_cassandra_setting(model, 'LAZY_FIELD_DECODING', default):
+            return None
+        return get_lazy_field_attnames(model)
+    
+    def _is_tracking_changes(self):
+        # Only the queries that construct model instances record the values
+        # of the rows, for dirty field tracking and for the increments that
+        # saving an instance of a counter model makes
+        if not self.supports_lazy_field_decoding or not self.query.default_cols:
+            return False
+        model = self.query.model
+        return is_tracking_enabled(self.connection, model) or is_counter_model(model)
+    
+    def _get_storage_format(self):
+        return get_storage_format(self.connection, self.query.model)
+    
+    def _get_storage_columns(self, fields):
+        # Returns the list of the names of the columns the fields are stored
+        # in, which is computed once per query
+        if getattr(self, '_storage_fields', None) is not fields:
+            storage_format = self._get_storage_format()
+            self._storage_columns = [storage_format.get_storage_column(field.column)
+                                     for field in fields]
+            self._storage_fields = fields
+        return self._storage_columns
+    
+    def _get_field_db_type(self, field):
+        try:
+            db_types = self._field_db_types
+        except AttributeError:
+            db_types = self._field_db_types = {}
+        db_type = db_types.get(field)
+        if db_type is None:
+            db_type = db_types[field] = field.db_type(connection=self.connection)
+        return db_type
+        
+    def _convert_field_value(self, field, value):
+        return _convert_field_value(self._get_field_db_type(field), field, value)
+    
+    def _get_lazy_converter(self, field):
+        # The function that LazyFieldValue decodes the values of the field
+        # with; it doesn't reference the compiler, so the model instances
+        # don't keep the query alive
+        try:
+            converters = self._lazy_converters
+        except AttributeError:
+            converters = self._lazy_converters = {}
+        converter = converters.get(field)
+        if converter is None:
+            converter = converters[field] = partial(_convert_field_value,
+                                                    self._get_field_db_type(field))
+        return converter
+    
+    def build_query(self, fields=None):
+        query = super(SQLCompiler, self).build_query(fields)
+        query.profile = self._profile = start_query_profile(self.connection, self.query)
+        return query
+    
+    def _is_count_query(self):
+        # A count() (which djangotoolbox evaluates with get_count)
+        if self.query.group_by is not None:
+            return False
+        pk_column = self.query.get_meta().pk.column
+        for aggregate in self.query.aggregate_select.values():
+            if (aggregate.sql_function != 'COUNT') or aggregate.extra.get('distinct') or \
+                ((aggregate.col != '*') and (aggregate.col[1] != pk_column)):
+                return False
+        return True
+    
+    def _get_aggregate_specs(self):
+        opts = self.query.get_meta()
+        storage_format = self._get_storage_format()
+        fields = dict((field.column, field) for field in opts.local_fields)
+        specs = []
+        for aggregate in self.query.aggregate_select.values():
+            if aggregate.col == '*':
+                column = db_type = None
+            else:
+                table, column = aggregate.col
+                if (table != opts.db_table) or (column not in fields):
+                    raise DatabaseError('Aggregates across relations are not supported '
+                                        'by non-relational backends')
+                db_type = self._get_field_db_type(fields[column])
+                column = storage_format.get_storage_column(column)
+            specs.append(get_aggregate_spec(aggregate, column, db_type, self.convert_value_from_db))
+        return specs
+    
+    def _aggregate(self, group_fields):
+        """
+        Evaluates the aggregates of the query over the matching rows, which
+        are streamed a page at a time, grouped by the stored values of the
+        group fields. Returns a list of the tuples of the stored values of the
+        group fields and the list of the values of the aggregates of each
+        group. Without group fields there's a single group, even if no rows
+        match.
+        """
+        specs = self._get_aggregate_specs()
+        group_columns = self._get_storage_columns(group_fields)
+        groups = {}
+        if not group_columns:
+            groups[()] = [spec.create_aggregator() for spec in specs]
+        
+        self._profile = None
+        try:
+            query = self.build_query(self.query.get_meta().local_fields)
+            query.set_fetch_columns(list(group_columns) +
+                                    [spec.column for spec in specs if spec.column is not None])
+            for page in query._get_query_result_pages():
+                start_time = time.time()
+                for row in page:
+                    key = tuple([row.get(column) for column in group_columns])
+                    aggregators = groups.get(key)
+                    if aggregators is None:
+                        aggregators = groups[key] = [spec.create_aggregator() for spec in specs]
+                    for spec, aggregator in zip(specs, aggregators):
+                        if spec.column is None:
+                            aggregator.add(None)
+                        else:
+                            value = row.get(spec.column)
+                            if (value is not None) and (value != self.SPECIAL_NONE_VALUE):
+                                aggregator.add(spec.convert_value(value))
+                query.record_stage('aggregate', start_time, len(page), len(groups))
+        finally:
+            finish_query_profile(self._profile)
+        
+        return [(key, [spec.convert_result(aggregator.result())
+                       for spec, aggregator in zip(specs, aggregators)])
+                for key, aggregators in groups.iteritems()]
+    
+    def execute_sql(self, result_type=MULTI):
+        """
+        Evaluates the aggregates of an aggregate() query (count() is left to
+        djangotoolbox, which uses get_count).
+        """
+        if (not self.query.aggregate_select) or self._is_count_query():
+            return super(SQLCompiler, self).execute_sql(result_type)
+        [(key, values)] = self._aggregate([])
+        if result_type is SINGLE:
+            return values
+        elif result_type is MULTI:
+            return [values]
+    
+    def _iter_grouped_results(self):
+        # The results of values(...).annotate(...): the values of the group
+        # fields followed by the aggregates of the group
+        if self.query.having:
+            raise DatabaseError('Filters on aggregates are not supported by '
+                                'non-relational backends')
+        fields = self.get_fields()
+        missing_is_none = not self._get_storage_format().stores_none_values
+        aggregates = self.query.aggregate_select.values()
+        results = []
+        for key, values in self._aggregate(fields):
+            result = []
+            for field, value in zip(fields, key):
+                if (value is None) and missing_is_none and field.null:
+                    result.append(None)
+                else:
+                    result.append(self._convert_field_value(field, value))
+            for aggregate, value in zip(aggregates, values):
+                result.append(self.query.resolve_aggregate(value, aggregate, self.connection))
+            results.append(tuple(result))
+        
+        # The groups can be ordered by the group fields and the aggregates
+        indexes = {}
+        for index, field in enumerate(fields):
+            indexes[field.name] = indexes[field.attname] = index
+        for index, alias in enumerate(self.query.aggregate_select.keys()):
+            indexes[alias] = len(fields) + index
+        for order in reversed(self._get_ordering()):
+            index = indexes.get(order.lstrip('-'))
+            if index is not None:
+                results.sort(key=lambda result: result[index], reverse=order.startswith('-'))
+        
+        return results[self.query.low_mark:self.query.high_mark]
+    
+    def results_iter(self):
+        if self.query.aggregate_select:
+            for result in self._iter_grouped_results():
+                yield result
+            return
+        self._lazy_field_attnames = self._get_lazy_field_attnames()
+        self._track_changes = self._is_tracking_changes()
+        self._profile = None
+        try:
+            for result in super(SQLCompiler, self).results_iter():
+                yield result
+        finally:
+            finish_query_profile(self._profile)
+    
+    def get_count(self, check_exists=False):
+        self._profile = None
+        try:
+            return super(SQLCompiler, self).get_count(check_exists)
+        finally:
+            finish_query_profile(self._profile)
+    
     # Override this method from NonrelCompiler to get around problem with
     # mixing the field default values with the field format as its stored
     # in the database (i.e. convert_value_from_db should only be passed
     # the database-specific storage format not the field default value.
     def _make_result(self, entity, fields):
+        lazy_attnames = getattr(self, '_lazy_field_attnames', None)
+        profile = getattr(self, '_profile', None)
+        if profile is not None:
+            start_time = time.time()
+        # The compact storage format doesn't store the fields that are None
+        missing_is_none = not self._get_storage_format().stores_none_values
+        loaded_values = {} if getattr(self, '_track_changes', False) else None
         result = []
-        for field in fields:
-            value = entity.get(field.column)
-            if value is not None:
-                value = self.convert_value_from_db(
-                    field.db_type(connection=self.connection), value)
+        for field, column in zip(fields, self._get_storage_columns(fields)):
+            value = entity.get(column)
+            if loaded_values is not None:
+                loaded_values[field.column] = self.SPECIAL_NONE_VALUE if value is None else value
+            if (value is None) and missing_is_none and field.null:
+                pass
+            elif lazy_attnames and (value is not None) and (field.attname in lazy_attnames):
+                # Keep the raw value; it's decoded on first attribute access
+                value = LazyFieldValue(field, self._get_lazy_converter(field), value)
             else:
-                value = field.get_default()
-            if not field.null and value is None:
-                raise DatabaseError("Non-nullable field %s can't be None!" % field.name)
+                value = self._convert_field_value(field, value)
             result.append(value)
-            
+        
+        if loaded_values is not None:
+            record_loaded_row(self.query.model, entity.get(self.query.get_meta().pk.column),
+                              loaded_values)
+        if profile is not None:
+            profile.record('convert', time.time() - start_time, 1, 1)
         return result
     
     # This gets called for each field type when you fetch() an entity.
     # db_type is the string that you used in the DatabaseCreation mapping
     def convert_value_from_db(self, db_type, value):
-        
-        if value == self.SPECIAL_NONE_VALUE or value is None:
-            return None
-        
-        if  db_type.startswith('ListField:'):
-            db_sub_type = db_type.split(':', 1)[1]
-            value = convert_string_to_list(value)
-            if isinstance(value, (list, tuple)) and len(value):
-                value = [self.convert_value_from_db(db_sub_type, subvalue)
-                         for subvalue in value]
-        elif db_type == 'date':
-            dt = datetime.datetime.strptime(value, '%Y-%m-%d')
-            value = dt.date()
-        elif db_type == 'datetime':
-            value = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
-        elif db_type == 'time':
-            dt = datetime.datetime.strptime(value, '%H:%M:%S.%f')
-            value = dt.time()
-        elif db_type == 'bool':
-            value = value.lower() == 'true'
-        elif db_type == 'int':
-            value = int(value)
-        elif db_type == 'long':
-            value = long(value)
-        elif db_type == 'float':
-            value = float(value)
-        #elif db_type == 'id':
-        #    value = unicode(value).decode('utf-8')
-        elif db_type.startswith('decimal'):
-            value = decimal.Decimal(value)
-        elif isinstance(value, str):
-            # always retrieve strings as unicode (it is possible that old datasets
-            # contain non unicode strings, nevertheless work with unicode ones)
-            value = value.decode('utf-8')
-            
-        return value
+        return _convert_value_from_db(db_type, value)
 
     # This gets called for each field type when you insert() an entity.
     # db_type is the string that you used in the DatabaseCreation mapping
@@ -396,6 +1134,9 @@ class SQLCompiler(NonrelCompiler):
             value = str(value).lower()
         elif (db_type == 'int') or (db_type == 'long') or (db_type == 'float'):
             value = str(value)
+        elif db_type == 'counter':
+            # Counter values are 64-bit integers in the Thrift API
+            value = int(value)
         elif db_type == 'id':
             value = unicode(value)
         elif (type(value) is not unicode) and (type(value) is not str):
@@ -410,45 +1151,25 @@ class SQLCompiler(NonrelCompiler):
 # This handles both inserts and updates of individual entities
 class SQLInsertCompiler(NonrelInsertCompiler, SQLCompiler):
     
+    supports_lazy_field_decoding = False
+    
     @safe_call
     def insert(self, data, return_id=False):
         pk_column = self.query.get_meta().pk.column
         model = self.query.model
-        compound_key_fields = None
-        if hasattr(model, 'CassandraSettings'):
-            if hasattr(model.CassandraSettings, 'ADJUSTED_COMPOUND_KEY_FIELDS'):
-                compound_key_fields = model.CassandraSettings.ADJUSTED_COMPOUND_KEY_FIELDS
-            elif hasattr(model.CassandraSettings, 'COMPOUND_KEY_FIELDS'):
-                compound_key_fields = []
-                for field_name in model.CassandraSettings.COMPOUND_KEY_FIELDS:
-                    field_class = None
-                    for lf in model._meta.local_fields:
-                        if lf.name == field_name:
-                            field_class = lf
-                            break
-                    if field_class is None:
-                        raise DatabaseError('Invalid compound key field')
-                    if type(field_class) is ForeignKey:
-                        field_name += '_id'
-                    compound_key_fields.append(field_name)
-                model.CassandraSettings.ADJUSTED_COMPOUND_KEY_FIELDS = compound_key_fields
-            separator = model.CassandraSettings.COMPOUND_KEY_SEPARATOR \
-                if hasattr(model.CassandraSettings, 'COMPOUND_KEY_SEPARATOR') \
-                else self.connection.settings_dict.get('CASSANDRA_COMPOUND_KEY_SEPARATOR', '|')
+        layout = get_wide_row_layout(self.connection, model)
+        if layout is not None:
+            return self._insert_wide_row(layout, data, return_id)
+        compound_key_fields, separator = get_compound_key_spec(self.connection, model)
         # See if the data arguments contain a value for the primary key.
-        # FIXME: For now we leave the key data as a column too. This is
-        # suboptimal, since the data is duplicated, but there are a couple of cases
-        # where you need to keep the column. First, if you have a model with only
-        # a single field that's the primary key (admittedly a semi-pathological case,
-        # but I can imagine valid use cases where you have this), then it doesn't
-        # work if the column is removed, because then there are no columns and that's
-        # interpreted as a deleted row (i.e. the usual Cassandra tombstone issue).
-        # Second, if there's a secondary index configured for the primary key field
-        # (not particularly useful with the current Cassandra, but would be valid when
-        # you can do a range query on indexed column) then you'd want to keep the
-        # column. So for now, we just leave the column in there so these cases work.
-        # Eventually we can optimize this and remove the column where it makes sense.
+        # With the standard storage format the key is stored as a column too.
+        # The compact storage format only keeps the key column where it's
+        # needed: if the model has only a single field that's the primary key
+        # (then there would be no columns, which is interpreted as a deleted
+        # row, i.e. the usual Cassandra tombstone issue), or if there's a
+        # secondary index configured for the primary key field.
         key = data.get(pk_column)
+        is_new_row = False
         if key:
             if compound_key_fields is not None:
                 compound_key_values = key.split(separator)
@@ -464,38 +1185,271 @@ class SQLInsertCompiler(NonrelInsertCompiler, SQLCompiler):
                     raise DatabaseError('The values of the fields used to form a compound key must be specified and cannot be null')
             else:
                 key = str(uuid4())
-            # Insert the key as column data too
-            # FIXME. See the above comment. When the primary key handling is optimized,
-            # then we would not always add the key to the data here.
+                is_new_row = True
             data[pk_column] = key
         
         timestamp = get_next_timestamp()
+        options = get_operation_options(self.connection, model)
+        storage_format = self._get_storage_format()
+        
+        # With dirty field tracking only the columns whose values changed
+        # since the instance was loaded (or last saved) are written, unless
+        # a full write is requested with cassandra_options(full_write=True)
+        instance = loaded_values = None
+        if is_tracking_enabled(self.connection, model):
+            instance = get_saved_instance(model, key)
+            if (instance is not None) and not options.full_write:
+                loaded_values = get_loaded_values(instance)
         
         mutation_list = []
+        if is_counter_model(model):
+            mutation_list = self._get_counter_mutations(key, data, is_new_row)
+        else:
+            # Cassandra expires the columns after the TTL (a TTL of 0 means
+            # that they never expire)
+            ttl = options.ttl or None
+            # Saving an existing row goes through here too, so the columns of
+            # the fields that are None are deleted, unless the row is new
+            deleted_columns = []
+            for name, value in data.items():
+                if (name == pk_column) and not storage_format.stores_pk_column:
+                    continue
+                if (loaded_values is not None) and (loaded_values.get(name) == value):
+                    continue
+                name = storage_format.get_storage_column(name)
+                # FIXME: Do we need this check here? Or is the name always already a str instead of unicode.
+                if type(name) is unicode:
+                    name = name.decode('utf-8')
+                if (value == self.SPECIAL_NONE_VALUE) and not storage_format.stores_none_values:
+                    if not is_new_row:
+                        deleted_columns.append(name)
+                    continue
+                mutation = Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=Column(name=name, value=value, timestamp=timestamp, ttl=ttl)))
+                mutation_list.append(mutation)
+            if (not mutation_list) and (deleted_columns or (loaded_values is None)):
+                # All of the fields are None, so the key is stored as a column
+                # to keep the row from being interpreted as deleted
+                mutation = Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=Column(name=pk_column, value=key, timestamp=timestamp, ttl=ttl)))
+                mutation_list.append(mutation)
+            if deleted_columns:
+                mutation_list.append(Mutation(deletion=Deletion(timestamp=timestamp,
+                    predicate=SlicePredicate(column_names=deleted_columns))))
+        
+        column_family = self.query.get_meta().db_table
+        mutation_map = {}
+        if mutation_list:
+            mutation_map[key] = {column_family: mutation_list}
+        
+        # The materialized views are updated in the same batch. Their entries
+        # for the previous values of the row are found from the tracked values
+        # if they're available, and otherwise by reading them.
+        views = get_materialized_views(model)
+        if views:
+            if is_new_row:
+                old_values = None
+            elif loaded_values is not None:
+                old_values = loaded_values
+            else:
+                old_values = self._get_stored_values(key, get_source_columns(views))
+            for view in views:
+                view.add_mutations(mutation_map, key, old_values, data,
+                    self.SPECIAL_NONE_VALUE, timestamp, options.ttl or None)
+        
+        # Nothing is written if none of the tracked fields changed
+        if mutation_map:
+            call_cassandra_with_timeout(self.connection.db_connection, options.timeout,
+                Cassandra.Client.batch_mutate, mutation_map,
+                options.write_consistency_level)
+        
+        if instance is not None:
+            saved_values = dict(loaded_values or {})
+            saved_values.update(data)
+            set_loaded_values(instance, saved_values)
+        
+        if return_id:
+            return key
+    
+    def _get_stored_values(self, key, columns):
+        """
+        Reads the stored values of the field columns of the row with the key.
+        Returns a dictionary of the values, or None if the row doesn't have any
+        of the columns.
+        """
+        storage_format = self._get_storage_format()
+        options = get_operation_options(self.connection, self.query.model)
+        column_list = call_cassandra_with_timeout(self.connection.db_connection,
+            options.timeout, Cassandra.Client.get_slice, key,
+            ColumnParent(column_family=self.query.get_meta().db_table),
+            SlicePredicate(column_names=[storage_format.get_storage_column(column)
+                                         for column in columns]),
+            options.read_consistency_level)
+        if not column_list:
+            return None
+        values = {}
+        for column in column_list:
+            column = column.column or column.counter_column
+            values[storage_format.get_field_column(column.name)] = column.value
+        return values
+    
+    def _get_counter_mutations(self, key, data, is_new_row):
+        """
+        Returns the mutations of a save() of an instance of a counter model.
+        Every save() is an insert, so for an instance that was loaded (or
+        saved before) the differences from the values it was loaded with are
+        added to the counters; saving an unchanged instance doesn't change
+        them, and concurrent increments aren't lost. Otherwise the values are
+        added to the counters of a new row (which are 0). The counters of an
+        existing row can't be set to the values of another instance.
+        """
+        pk_column = self.query.get_meta().pk.column
+        storage_format = self._get_storage_format()
+        values = dict((name, value) for name, value in data.items() if name != pk_column)
+        instance = get_saved_instance(self.query.model, key)
+        loaded_values = get_loaded_values(instance) if instance is not None else None
+        if loaded_values is not None:
+            increments = dict((name, _get_counter_value(value, self.SPECIAL_NONE_VALUE) -
+                               _get_counter_value(loaded_values.get(name), self.SPECIAL_NONE_VALUE))
+                              for name, value in values.items())
+            # The counters that didn't change aren't written
+            increments = dict((name, increment) for name, increment in increments.items()
+                              if increment)
+        else:
+            if (not is_new_row) and (self._get_stored_values(key, values.keys()) is not None):
+                raise DatabaseError("The counters of an existing row can't be set by saving "
+                                    "an instance that wasn't loaded from the database; "
+                                    "use update() with F() expressions instead")
+            # The counters that are 0 are written too (adding 0 creates the
+            # column), so that the new row exists even if all of them are 0
+            increments = dict((name, _get_counter_value(value, self.SPECIAL_NONE_VALUE))
+                              for name, value in values.items())
+        if instance is not None:
+            saved_values = dict(loaded_values or {})
+            saved_values.update(data)
+            set_loaded_values(instance, saved_values)
+        
+        return [Mutation(column_or_supercolumn=ColumnOrSuperColumn(counter_column=CounterColumn(
+                    name=storage_format.get_storage_column(name), value=increment)))
+                for name, increment in increments.items()]
+    
+    def _insert_wide_row(self, layout, data, return_id):
+        # The instance is stored as columns of the row of its partition, and
+        # its key is formed from the partition key and the clustering value
+        partition_value = data.get(layout.partition_column)
+        clustering_value = data.get(layout.clustering_column)
+        if (partition_value in (None, self.SPECIAL_NONE_VALUE)) or \
+            (clustering_value in (None, self.SPECIAL_NONE_VALUE)):
+            raise DatabaseError('The partition key and clustering fields of a wide row '
+                                'model must be specified and cannot be null')
+        key = layout.get_key(partition_value, clustering_value)
+        if data.get(layout.pk_column) and (data[layout.pk_column] != key):
+            raise DatabaseError("The value of the primary key doesn't match the values "
+                                "of the partition key and clustering fields")
+        
+        timestamp = get_next_timestamp()
+        options = get_operation_options(self.connection, self.query.model)
+        ttl = options.ttl or None
+        storage_format = self._get_storage_format()
+        encoded_value = layout.encode_clustering_value(clustering_value)
+        key_columns = (layout.pk_column, layout.partition_column, layout.clustering_column)
+        columns = [(layout.get_column_name(encoded_value, ''), '')]
         for name, value in data.items():
-            # FIXME: Do we need this check here? Or is the name always already a str instead of unicode.
-            if type(name) is unicode:
-                name = name.decode('utf-8')
-            mutation = Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=Column(name=name, value=value, timestamp=timestamp)))
-            mutation_list.append(mutation)
+            if name not in key_columns:
+                name = layout.get_column_name(encoded_value, storage_format.get_storage_column(name))
+                columns.append((name, value))
+        mutation_list = [Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=Column(
+                            name=name, value=value, timestamp=timestamp, ttl=ttl)))
+                         for name, value in columns]
         
-        db_connection = self.connection.db_connection
         column_family = self.query.get_meta().db_table
-        call_cassandra_with_reconnect(db_connection,
-            Cassandra.Client.batch_mutate, {key: {column_family: mutation_list}},
-            self.connection.write_consistency_level)
+        call_cassandra_with_timeout(self.connection.db_connection, options.timeout,
+            Cassandra.Client.batch_mutate, {partition_value: {column_family: mutation_list}},
+            options.write_consistency_level)
         
         if return_id:
             return key
 
 class SQLUpdateCompiler(NonrelUpdateCompiler, SQLCompiler):
+    
+    supports_lazy_field_decoding = False
+    
     def __init__(self, *args, **kwargs):
         super(SQLUpdateCompiler, self).__init__(*args, **kwargs)
         
+    def _get_pk_index(self):
+        pk_column = self.query.get_meta().pk.column
+        
+        pk_index = -1
+        fields = self.get_fields()
+        for index in range(len(fields)):
+            if fields[index].column == pk_column:
+                pk_index = index;
+                break
+        if pk_index == -1:
+            raise DatabaseError('Invalid primary key column')
+        return pk_index
+    
+    def _get_counter_increment(self, field, value):
+        # Returns the increment of an update of a counter field, which has to
+        # be of the form F('field') + n or F('field') - n
+        if isinstance(value, ExpressionNode) and (len(value.children) == 2):
+            first, second = value.children
+            if value.connector == ExpressionNode.ADD:
+                if isinstance(first, F) and (first.name == field.name) and isinstance(second, (int, long)):
+                    return second
+                if isinstance(second, F) and (second.name == field.name) and isinstance(first, (int, long)):
+                    return first
+            elif value.connector == ExpressionNode.SUB:
+                if isinstance(first, F) and (first.name == field.name) and isinstance(second, (int, long)):
+                    return -second
+        raise DatabaseError("Counter field %s can only be updated with an increment, "
+                            "e.g. F('%s') + 1" % (field.name, field.name))
+    
+    def _get_key_values(self):
+        # Returns the keys of the rows to update if they're given by the
+        # filters of the query, so that the rows don't have to be read.
+        query = super(SQLCompiler, self).build_query(self.get_fields())
+        if query.root_predicate is None:
+            return None
+        return get_exact_key_values(query.root_predicate, query.pk_column)
+    
+    def execute_counter_sql(self, counter_increments):
+        """
+        Applies the increments of the counters of the matching rows. The
+        increments are sent as counter mutations; if the query selects the
+        rows by key they're sent without reading the rows first (adding to
+        the counters of a row that doesn't exist yet creates it).
+        """
+        column_family = self.query.get_meta().db_table
+        key_values = self._get_key_values()
+        if key_values is None:
+            pk_index = self._get_pk_index()
+            key_values = [result[pk_index] for result in self.results_iter()]
+        
+        storage_format = self._get_storage_format()
+        mutation_list = [Mutation(column_or_supercolumn=ColumnOrSuperColumn(counter_column=CounterColumn(
+                            name=storage_format.get_storage_column(name), value=increment)))
+                         for name, increment in counter_increments.items() if increment]
+        batch_mutate_data = {}
+        for key in key_values:
+            batch_mutate_data[key] = {column_family: mutation_list}
+        
+        if mutation_list and batch_mutate_data:
+            db_connection = self.connection.db_connection
+            options = get_operation_options(self.connection, self.query.model)
+            call_cassandra_with_timeout(db_connection, options.timeout,
+                Cassandra.Client.batch_mutate, batch_mutate_data,
+                options.write_consistency_level)
+        
+        return len(key_values)
+    
     def execute_sql(self, result_type=MULTI):
         data = {}
+        counter_increments = {}
         for field, model, value in self.query.values:
             assert field is not None
+            if isinstance(field, CounterField):
+                counter_increments[field.column] = self._get_counter_increment(field, value)
+                continue
             if not field.null and value is None:
                 raise DatabaseError("You can't set %s (a non-nullable "
                                     "field) to None!" % field.name)
@@ -503,6 +1457,9 @@ class SQLUpdateCompiler(NonrelUpdateCompiler, SQLCompiler):
             value = self.convert_value_for_db(db_type, value)
             data[field.column] = value
         
+        if counter_increments:
+            return self.execute_counter_sql(counter_increments)
+        
         # TODO: Add compound key check here -- ensure that we're not updating
         # any of the fields that are components in the compound key.
         
@@ -512,39 +1469,89 @@ class SQLUpdateCompiler(NonrelUpdateCompiler, SQLCompiler):
         # the CassandraQuery class to support custom slice predicates.
         
         #model = self.query.model
-        pk_column = self.query.get_meta().pk.column
-        
-        pk_index = -1
-        fields = self.get_fields()
-        for index in range(len(fields)):
-            if fields[index].column == pk_column:
-                pk_index = index;
-                break
-        if pk_index == -1:
-            raise DatabaseError('Invalid primary key column')
+        pk_index = self._get_pk_index()
         
         row_count = 0
         column_family = self.query.get_meta().db_table
         timestamp = get_next_timestamp()
+        options = get_operation_options(self.connection, self.query.model)
+        # Only the columns that are updated get the TTL
+        ttl = options.ttl or None
+        storage_format = self._get_storage_format()
+        pk_column = self.query.get_meta().pk.column
+        layout = get_wide_row_layout(self.connection, self.query.model)
+        if layout is not None:
+            for name in (layout.partition_column, layout.clustering_column):
+                if name in data:
+                    raise DatabaseError("The partition key and clustering fields of a wide "
+                                        "row model can't be updated")
+        
+        # With the compact storage format the fields that are set to None are
+        # deleted instead of being written. The key column is written in case
+        # they were the last columns of the row.
+        column_values = []
+        deleted_columns = []
+        for name, value in data.items():
+            name = storage_format.get_storage_column(name)
+            # FIXME: Do we need this check here? Or is the name always already a str instead of unicode.
+            if type(name) is unicode:
+                name = name.decode('utf-8')
+            if (value == self.SPECIAL_NONE_VALUE) and not storage_format.stores_none_values:
+                deleted_columns.append(name)
+            elif (name != pk_column) or storage_format.stores_pk_column:
+                column_values.append((name, value))
+        
+        # The entries of the rows in the materialized views are updated from
+        # the values of the rows that are read by the query
+        views = get_materialized_views(self.query.model)
+        if views:
+            source_columns = get_source_columns(views)
+            view_fields = [(index, field) for index, field in enumerate(self.get_fields())
+                           if field.column in source_columns]
+        
         batch_mutate_data = {}
         for result in self.results_iter():
             row_count += 1
             mutation_list = []
             key = result[pk_index]
-            for name, value in data.items():
-                # FIXME: Do we need this check here? Or is the name always already a str instead of unicode.
-                if type(name) is unicode:
-                    name = name.decode('utf-8')
-                mutation = Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=Column(name=name, value=value, timestamp=timestamp)))
+            for name, value in column_values:
+                mutation = Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=Column(name=name, value=value, timestamp=timestamp, ttl=ttl)))
                 mutation_list.append(mutation)
-            batch_mutate_data[key] = {column_family: mutation_list}
+            if deleted_columns:
+                mutation_list.append(Mutation(deletion=Deletion(timestamp=timestamp,
+                    predicate=SlicePredicate(column_names=deleted_columns))))
+            if deleted_columns and not storage_format.stores_pk_column:
+                mutation = Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=Column(name=pk_column, value=key, timestamp=timestamp)))
+                mutation_list.append(mutation)
+            if layout is not None:
+                # The columns of the instance are in the row of its partition
+                partition_value, clustering_value = layout.split_key(smart_str(key))
+                encoded_value = layout.encode_clustering_value(clustering_value)
+                for mutation in mutation_list:
+                    column = mutation.column_or_supercolumn.column
+                    column.name = layout.get_column_name(encoded_value, column.name)
+                partition_mutations = batch_mutate_data.setdefault(partition_value,
+                                                                   {column_family: []})
+                partition_mutations[column_family].extend(mutation_list)
+            else:
+                add_mutations(batch_mutate_data, key, column_family, mutation_list)
+            if views:
+                old_values = dict((field.column, self.convert_value_for_db(
+                                    self._get_field_db_type(field), result[index]))
+                                  for index, field in view_fields)
+                new_values = dict(old_values)
+                new_values.update(data)
+                for view in views:
+                    view.add_mutations(batch_mutate_data, smart_str(key), old_values, new_values,
+                                       self.SPECIAL_NONE_VALUE, timestamp, ttl)
         
         db_connection = self.connection.db_connection
-        call_cassandra_with_reconnect(db_connection,
+        call_cassandra_with_timeout(db_connection, options.timeout,
             Cassandra.Client.batch_mutate, batch_mutate_data,
-            self.connection.write_consistency_level)
+            options.write_consistency_level)
         
         return row_count
     
 class SQLDeleteCompiler(NonrelDeleteCompiler, SQLCompiler):
-    pass
+    
+    supports_lazy_field_decoding = False
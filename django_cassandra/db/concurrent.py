@@ -0,0 +1,199 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Thread pool used to run queries concurrently. The Thrift client is blocking,
+so each query runs in a worker thread. The database wrapper is thread-local,
+so each worker thread has its own Cassandra connection, which is kept open
+for the next query the thread runs.
+"""
+
+import sys
+import threading
+import Queue
+
+from django.db.utils import DatabaseError
+
+DEFAULT_QUERY_THREADS = 10
+
+class QueryFuture(object):
+    """
+    The pending result of a call submitted to a QueryExecutor.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def _wait(self, timeout):
+        self._condition.acquire()
+        try:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise DatabaseError('Timed out waiting for the result of a concurrent query')
+        finally:
+            self._condition.release()
+
+    def result(self, timeout=None):
+        """
+        Returns the result of the call, waiting up to timeout seconds (or
+        for as long as it takes if timeout is None) for it to complete. If the
+        call raised an exception, it's raised again here.
+        """
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exc_info[1] if self._exc_info is not None else None
+
+    def add_done_callback(self, fn):
+        """
+        Calls fn with the future when it completes (immediately if it's
+        already done). The callback runs in the thread that completed the call.
+        """
+        self._condition.acquire()
+        try:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._condition.release()
+        fn(self)
+
+    def _complete(self, result, exc_info):
+        self._condition.acquire()
+        try:
+            self._result = result
+            self._exc_info = exc_info
+            self._done = True
+            self._condition.notifyAll()
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._condition.release()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                pass
+
+class QueryExecutor(object):
+    """
+    Runs the submitted calls in a pool of up to max_threads daemon threads.
+    Threads are started as needed. A call shouldn't wait on the result of
+    another call submitted to the same executor, since that can deadlock
+    once all of the threads are busy.
+    """
+
+    def __init__(self, max_threads=DEFAULT_QUERY_THREADS):
+        if max_threads < 1:
+            raise ValueError('The executor needs at least one thread')
+        self.max_threads = max_threads
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._idle_thread_count = 0
+        self._shutdown = False
+
+    def submit(self, fn, *args, **kwargs):
+        future = QueryFuture()
+        self._lock.acquire()
+        try:
+            if self._shutdown:
+                raise DatabaseError('The query executor has been shut down')
+            self._queue.put((future, fn, args, kwargs))
+            # Start another thread if there aren't enough idle threads
+            # to pick up the pending calls
+            if (self._queue.qsize() > self._idle_thread_count) and \
+                (len(self._threads) < self.max_threads):
+                thread = threading.Thread(target=self._work)
+                thread.setDaemon(True)
+                self._threads.append(thread)
+                thread.start()
+        finally:
+            self._lock.release()
+        return future
+
+    def _work(self):
+        while True:
+            self._set_idle(1)
+            item = self._queue.get()
+            self._set_idle(-1)
+            if item is None:
+                break
+            future, fn, args, kwargs = item
+            try:
+                result = fn(*args, **kwargs)
+                exc_info = None
+            except BaseException:
+                result = None
+                exc_info = sys.exc_info()
+            future._complete(result, exc_info)
+            item = future = result = exc_info = None
+
+    def _set_idle(self, delta):
+        self._lock.acquire()
+        self._idle_thread_count += delta
+        self._lock.release()
+
+    def shutdown(self, wait=True):
+        self._lock.acquire()
+        try:
+            self._shutdown = True
+            threads = list(self._threads)
+        finally:
+            self._lock.release()
+        for thread in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+def get_query_executor(connection):
+    """
+    Returns the executor for concurrent queries on the given database. The
+    number of threads is set with CASSANDRA_CONCURRENT_QUERY_THREADS in the
+    database settings.
+    """
+    executor = _executors.get(connection.alias)
+    if executor is None:
+        _executors_lock.acquire()
+        try:
+            executor = _executors.get(connection.alias)
+            if executor is None:
+                max_threads = connection.settings_dict.get('CASSANDRA_CONCURRENT_QUERY_THREADS',
+                                                           DEFAULT_QUERY_THREADS)
+                executor = _executors[connection.alias] = QueryExecutor(max_threads)
+        finally:
+            _executors_lock.release()
+    return executor
+
+def wait_for_all(futures, timeout=None):
+    """
+    Returns the results of all of the futures, in order.
+    """
+    return [future.result(timeout) for future in futures]
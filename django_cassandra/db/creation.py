@@ -18,7 +18,35 @@ from djangotoolbox.db.creation import NonrelDatabaseCreation
 from cassandra import Cassandra
 from cassandra.ttypes import *
 from django.core.management import call_command
-from .utils import get_next_timestamp
+from django.db import router
+from django.db.models import get_apps, get_models
+import hashlib
+import time
+from ..fields import CounterField, is_counter_model
+from .metadata import get_keyspace_metadata, invalidate_keyspace_metadata
+from .storage import get_storage_format
+from .utils import get_next_timestamp, call_cassandra, call_cassandra_with_reconnect, \
+    is_wide_row_model, CassandraAccessError
+
+# Column family in the test keyspace that stores the fingerprint of the schema
+# that the keyspace was created with
+SCHEMA_FINGERPRINT_COLUMN_FAMILY = 'DjangoSchemaFingerprint'
+SCHEMA_FINGERPRINT_KEY = 'schema'
+
+DEFAULT_SCHEMA_AGREEMENT_TIMEOUT = 30.0
+
+def _get_def_values(value):
+    # Converts a Thrift definition object to nested tuples of its field
+    # names and values, in a well-defined order
+    thrift_spec = getattr(value, 'thrift_spec', None)
+    if thrift_spec is not None:
+        return tuple((spec[2], _get_def_values(getattr(value, spec[2], None)))
+                     for spec in thrift_spec if spec)
+    if isinstance(value, (list, tuple)):
+        return tuple(_get_def_values(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _get_def_values(item)) for key, item in value.iteritems()))
+    return value
 
 class DatabaseCreation(NonrelDatabaseCreation):
 
@@ -48,24 +76,39 @@ class DatabaseCreation(NonrelDatabaseCreation):
         'TimeField':         'time',
         'URLField':          'text',
         'XMLField':          'text',
+        'CounterField':      'counter',
         'GenericAutoField':  'id',
         'StringForeignKey':  'id',
         'AutoField':         'id',
         'RelatedAutoField':  'id',
     }
     
-    def sql_create_model(self, model, style, known_models=set()):
-        
-        db_connection = self.connection.db_connection
+    def get_column_family_def(self, model):
+        """
+        Returns the CfDef of the column family for the model.
+        """
         keyspace = self.connection.settings_dict['NAME']
         
         opts = model._meta
         column_metadata = []
+        is_counter = is_counter_model(model)
+        
+        if is_counter:
+            # Counter column families can only contain counter columns (and
+            # can't have secondary indexes)
+            for field in opts.local_fields:
+                if not field.primary_key and not isinstance(field, CounterField):
+                    raise DatabaseError('All of the fields of a model with counter fields '
+                        'must be counter fields; %s.%s is not.' % (opts.object_name, field.name))
 
-        # Browsing through fields to find indexed fields
+        # Browsing through fields to find indexed fields (the columns of a
+        # wide row model are named after the instances, so it can't have
+        # secondary indexes)
+        is_wide_row = is_wide_row_model(model)
+        storage_format = get_storage_format(self.connection, model)
         for field in opts.local_fields:
-            if field.db_index:
-                column_name = str(field.db_column if field.db_column else field.column)
+            if field.db_index and not is_counter and not is_wide_row:
+                column_name = storage_format.get_storage_column(str(field.column))
                 column_def = ColumnDef(name=column_name, validation_class='BytesType',
                                        index_type=IndexType.KEYS)
                 column_metadata.append(column_def)
@@ -84,13 +127,61 @@ class DatabaseCreation(NonrelDatabaseCreation):
         cfdef_settings['keyspace'] = keyspace
         if not cfdef_settings.get('name'):
             cfdef_settings['name'] = opts.db_table
-        if not cfdef_settings.get('comparator_type'):
+        if is_wide_row:
+            # The column names of the instances start with their encoded
+            # clustering values, which are ordered bytewise
+            cfdef_settings['comparator_type'] = 'BytesType'
+        elif not cfdef_settings.get('comparator_type'):
             cfdef_settings['comparator_type'] = 'UTF8Type'
+        if is_counter:
+            cfdef_settings['default_validation_class'] = 'CounterColumnType'
+            cfdef_settings.setdefault('replicate_on_write', True)
         cfdef_settings['column_metadata'] = column_metadata
         
-        column_family_def = CfDef(**cfdef_settings)
+        return CfDef(**cfdef_settings)
+    
+    def create_column_family(self, name, **cfdef_overrides):
+        """
+        Creates a column family that isn't used by a model (e.g. for the cache
+        and session backends) if it doesn't exist yet, and waits until the
+        schema change has propagated to the cluster.
+        """
+        db_connection = self.connection.db_connection
+        metadata = get_keyspace_metadata(self.connection)
+        if metadata and metadata.get_column_family(name):
+            return
+        
+        cfdef_settings = self.connection.column_family_def_defaults.copy()
+        cfdef_settings.update(cfdef_overrides)
+        cfdef_settings['keyspace'] = db_connection.keyspace
+        cfdef_settings['name'] = name
+        if not cfdef_settings.get('comparator_type'):
+            cfdef_settings['comparator_type'] = 'UTF8Type'
+        try:
+            call_cassandra_with_reconnect(db_connection,
+                Cassandra.Client.system_add_column_family, CfDef(**cfdef_settings))
+        except CassandraAccessError:
+            # Another process may have created it in the meantime
+            invalidate_keyspace_metadata(self.connection)
+            metadata = get_keyspace_metadata(self.connection)
+            if not (metadata and metadata.get_column_family(name)):
+                raise
+        invalidate_keyspace_metadata(self.connection)
+        self.wait_for_schema_agreement(db_connection)
+    
+    def sql_create_model(self, model, style, known_models=set()):
+        
+        db_connection = self.connection.db_connection
+        column_family_def = self.get_column_family_def(model)
         
-        db_connection.get_client().system_add_column_family(column_family_def)
+        # Several models can share a column family (e.g. proxy models)
+        metadata = get_keyspace_metadata(self.connection)
+        if metadata and metadata.get_column_family(column_family_def.name):
+            return [], {}
+        
+        call_cassandra_with_reconnect(db_connection,
+            Cassandra.Client.system_add_column_family, column_family_def)
+        invalidate_keyspace_metadata(self.connection)
         
         return [], {}
 
@@ -102,7 +193,7 @@ class DatabaseCreation(NonrelDatabaseCreation):
         db_connection = self.connection.get_db_connection(False, False)
         
         try:
-            db_connection.get_client().system_drop_keyspace(keyspace_name)
+            call_cassandra(db_connection, Cassandra.Client.system_drop_keyspace, keyspace_name)
         except Exception, e:
             # We want to succeed without complaining if the test db doesn't
             # exist yet, so we just assume that any exception that's raised
@@ -113,10 +204,134 @@ class DatabaseCreation(NonrelDatabaseCreation):
             #if verbosity >= 1:
             #    print "Exception thrown while trying to drop the test database/keyspace: ", e
             pass
+        invalidate_keyspace_metadata(self.connection, keyspace_name)
+        
+    def wait_for_schema_agreement(self, db_connection, timeout=None):
+        """
+        Waits until all of the reachable nodes of the cluster have the same
+        schema version, i.e. until the last schema change has propagated.
+        """
+        if timeout is None:
+            timeout = self.connection.settings_dict.get('CASSANDRA_SCHEMA_AGREEMENT_TIMEOUT',
+                                                        DEFAULT_SCHEMA_AGREEMENT_TIMEOUT)
+        end_time = time.time() + timeout
+        while True:
+            schema_versions = call_cassandra_with_reconnect(db_connection,
+                Cassandra.Client.describe_schema_versions)
+            versions = [version for version in schema_versions if version != 'UNREACHABLE']
+            if len(versions) <= 1:
+                return
+            if time.time() >= end_time:
+                raise DatabaseError('Timed out waiting for the nodes to agree on the '
+                    'schema; schema versions: %s' % ', '.join(versions))
+            time.sleep(0.1)
+    
+    def get_syncdb_models(self):
+        """
+        Returns the list of the models whose column families are created by
+        syncdb for the database.
+        """
+        model_list = []
+        table_names = set()
+        for app in get_apps():
+            for model in get_models(app, include_auto_created=True):
+                opts = model._meta
+                if not opts.managed or opts.proxy or (opts.db_table in table_names) or \
+                    not router.allow_syncdb(self.connection.alias, model):
+                    continue
+                table_names.add(opts.db_table)
+                model_list.append(model)
+        return model_list
+    
+    def get_keyspace_def(self):
+        """
+        Returns the KsDef of the keyspace, including the column families for
+        all of the models.
+        """
+        # The settings depend on the version of Cassandra, which is only known
+        # once the connection has been configured (create_test_db closes it)
+        self.connection.get_db_connection(False, False)
+        keyspace_name = self.connection.settings_dict['NAME']
+        keyspace_def_settings = self.connection.get_keyspace_def_settings(keyspace_name)
+        keyspace_def_settings['cf_defs'] = [self.get_column_family_def(model)
+                                            for model in self.get_syncdb_models()]
+        return KsDef(**keyspace_def_settings)
+    
+    def get_schema_fingerprint(self, keyspace_def):
+        return hashlib.md5(repr(_get_def_values(keyspace_def))).hexdigest()
+    
+    def get_keyspace_schema_fingerprint(self):
+        """
+        Returns the schema fingerprint that was stored in the keyspace when it
+        was created, or None if the keyspace doesn't exist or doesn't have one.
+        """
+        db_connection = self.connection.get_db_connection(False, False)
+        try:
+            keyspace_def = call_cassandra_with_reconnect(db_connection,
+                Cassandra.Client.describe_keyspace, db_connection.keyspace)
+        except CassandraAccessError:
+            return None
+        if SCHEMA_FINGERPRINT_COLUMN_FAMILY not in [cf_def.name for cf_def in keyspace_def.cf_defs]:
+            return None
+        
+        db_connection = self.connection.db_connection
+        column_list = call_cassandra_with_reconnect(db_connection,
+            Cassandra.Client.get_slice, SCHEMA_FINGERPRINT_KEY,
+            ColumnParent(column_family=SCHEMA_FINGERPRINT_COLUMN_FAMILY),
+            SlicePredicate(column_names=['fingerprint']),
+            self.connection.read_consistency_level)
+        return column_list[0].column.value if column_list else None
+    
+    def create_keyspace(self, reuse=False, verbosity=1):
+        """
+        Creates the keyspace of the database with the column families of all of the models
+        with a single system_add_keyspace call and waits for the schema to
+        propagate to the cluster, which is much faster than creating the
+        column families one at a time. If reuse is True and the keyspace
+        already exists with the same schema it's left as it is. Returns True
+        if the existing keyspace was reused.
+        """
+        keyspace_def = self.get_keyspace_def()
+        fingerprint = self.get_schema_fingerprint(keyspace_def)
+        if reuse and (self.get_keyspace_schema_fingerprint() == fingerprint):
+            return True
+        
+        self.drop_keyspace(keyspace_def.name, verbosity)
+        self._close_db_connection()
         
+        keyspace_def.cf_defs.append(CfDef(keyspace=keyspace_def.name,
+            name=SCHEMA_FINGERPRINT_COLUMN_FAMILY, comparator_type='UTF8Type'))
+        db_connection = self.connection.get_db_connection(False, False)
+        call_cassandra_with_reconnect(db_connection,
+            Cassandra.Client.system_add_keyspace, keyspace_def)
+        invalidate_keyspace_metadata(self.connection, keyspace_def.name)
+        self.wait_for_schema_agreement(db_connection)
+        
+        # The fingerprint is stored last, so a keyspace whose creation was
+        # interrupted is never reused
+        db_connection = self.connection.db_connection
+        column = Column(name='fingerprint', value=fingerprint, timestamp=get_next_timestamp())
+        call_cassandra_with_reconnect(db_connection, Cassandra.Client.insert,
+            SCHEMA_FINGERPRINT_KEY, ColumnParent(column_family=SCHEMA_FINGERPRINT_COLUMN_FAMILY),
+            column, self.connection.write_consistency_level)
+        return False
+    
+    def _close_db_connection(self):
+        # The connection uses the keyspace that was set when it was opened,
+        # so it has to be reopened when NAME changes.
+        if self.connection._db_connection:
+            self.connection._db_connection.close()
+            self.connection._db_connection = None
+    
     def create_test_db(self, verbosity, autoclobber):
         """
         Create a new test database/keyspace.
+        
+        By default (CASSANDRA_TEST_SETUP_MODE = 'syncdb') the keyspace is
+        dropped and then created by syncdb, which adds the column families
+        one model at a time. With 'batch' the keyspace is created with all of
+        the column families at once and with 'reuse' an existing test keyspace
+        with the same schema is flushed instead of being recreated.
         """
         
         if verbosity >= 1:
@@ -130,20 +345,30 @@ class DatabaseCreation(NonrelDatabaseCreation):
             test_keyspace_name = TEST_DATABASE_PREFIX + settings_dict['NAME']
 
         settings_dict['NAME'] = test_keyspace_name
+        self._close_db_connection()
         
-        # First make sure we've destroyed an existing test keyspace
-        # FIXME: Should probably do something with autoclobber here, but why
-        # would you ever not want to autoclobber when running the tests?
-        self.drop_keyspace(test_keyspace_name, verbosity)
+        setup_mode = settings_dict.get('CASSANDRA_TEST_SETUP_MODE', 'syncdb')
+        if setup_mode in ('batch', 'reuse'):
+            if self.create_keyspace(setup_mode == 'reuse', verbosity):
+                # Flushing the tables also reloads the initial data
+                call_command('flush', verbosity=0, interactive=False, database=self.connection.alias)
+                return test_keyspace_name
+        else:
+            # First make sure we've destroyed an existing test keyspace
+            # FIXME: Should probably do something with autoclobber here, but why
+            # would you ever not want to autoclobber when running the tests?
+            self.drop_keyspace(test_keyspace_name, verbosity)
         
-        # Call syncdb to create the necessary tables/column families
+        # Call syncdb to create the necessary tables/column families (the
+        # ones that already exist are skipped) and load the initial data
         call_command('syncdb', verbosity=False, interactive=False, database=self.connection.alias)
     
         return test_keyspace_name
     
     def destroy_test_db(self, old_database_name, verbosity=1):
         """
-        Destroy the test database/keyspace.
+        Destroy the test database/keyspace. With the 'reuse' test setup mode
+        the keyspace is kept for the next test run.
         """
 
         if verbosity >= 1:
@@ -153,32 +378,71 @@ class DatabaseCreation(NonrelDatabaseCreation):
         test_keyspace_name = settings_dict.get('NAME')
         settings_dict['NAME'] = old_database_name
         
-        self.drop_keyspace(test_keyspace_name, verbosity)
+        if settings_dict.get('CASSANDRA_TEST_SETUP_MODE', 'syncdb') != 'reuse':
+            self.drop_keyspace(test_keyspace_name, verbosity)
+        self._close_db_connection()
         
+    def _delete_rows(self, db_connection, table_name, keys, timestamp):
+        deletion = Deletion(timestamp=timestamp)
+        mutation_map = {}
+        for key in keys:
+            mutation_map[key] = {table_name: [Mutation(deletion=deletion)]}
+        call_cassandra_with_reconnect(db_connection, Cassandra.Client.batch_mutate,
+            mutation_map, self.connection.write_consistency_level)
+    
+    def _truncate_table(self, db_connection, table_name):
+        try:
+            call_cassandra_with_reconnect(db_connection, Cassandra.Client.truncate, table_name)
+            return True
+        except CassandraAccessError:
+            # Truncate fails if any of the nodes are down, in which case
+            # we fall back to deleting the rows.
+            return False
+    
     def flush_table(self, table_name):
-        
+        """
+        Removes all of the rows of the column family. Depending on the
+        CASSANDRA_FLUSH_STRATEGY setting this either calls truncate or pages
+        through all of the keys and deletes them with one batch_mutate call
+        per page. The default ('auto') deletes the rows when there's at most
+        a page of them and truncates bigger column families (truncate has a
+        fixed cost, so it's slower for the small tables of most unit tests).
+        """
         db_connection = self.connection.db_connection
-
-        # FIXME: Calling truncate here seems to corrupt the secondary indexes,
-        # so for now the truncate call has been replaced with removing the
-        # row one by one. When the truncate bug has been fixed in Cassandra
-        # this should be switched back to use truncate.
-        # NOTE: This should be fixed as of the 0.7.0-rc2 build, so we should
-        # try this out again to see if it works now.
-        # UPDATE: Tried it with rc2 and it worked calling truncate but it was
-        # slower than using remove (at least for the unit tests), so for now
-        # I'm leaving it alone pending further investigation.
-        #db_connection.get_client().truncate(table_name)
+        strategy = self.connection.flush_strategy
+        can_truncate = (strategy != 'delete') and getattr(self.connection, 'supports_truncate', False)
+        if can_truncate and (strategy == 'auto'):
+            # Counters that are deleted can't be reliably incremented again,
+            # so counter column families are always truncated if possible
+            metadata = get_keyspace_metadata(self.connection)
+            cf_def = metadata.get_column_family(table_name) if metadata else None
+            if cf_def and (cf_def.default_validation_class or '').endswith('CounterColumnType'):
+                strategy = 'truncate'
+        if (strategy == 'truncate') and can_truncate:
+            if self._truncate_table(db_connection, table_name):
+                return
         
         column_parent = ColumnParent(column_family=table_name)
         slice_predicate = SlicePredicate(column_names=[])
-        key_range = KeyRange(start_token = '0', end_token = '0', count = 1000)
-        key_slice_list = db_connection.get_client().get_range_slices(column_parent, slice_predicate, key_range, ConsistencyLevel.ONE)
-        column_path = ColumnPath(column_family=table_name)
+        page_size = self.connection.fetch_page_size
         timestamp = get_next_timestamp()
-        for key_slice in key_slice_list:
-            db_connection.get_client().remove(key_slice.key, column_path, timestamp, ConsistencyLevel.ONE)
-
+        start_key = ''
+        skip_key = None
+        while True:
+            key_range = KeyRange(start_key=start_key, end_key='', count=page_size)
+            key_slice_list = call_cassandra_with_reconnect(db_connection,
+                Cassandra.Client.get_range_slices, column_parent, slice_predicate,
+                key_range, self.connection.read_consistency_level)
+            fetch_count = len(key_slice_list)
+            if (fetch_count >= page_size) and (skip_key is None) and can_truncate:
+                if self._truncate_table(db_connection, table_name):
+                    return
+            keys = [key_slice.key for key_slice in key_slice_list if key_slice.key != skip_key]
+            if keys:
+                self._delete_rows(db_connection, table_name, keys, timestamp)
+            if fetch_count < page_size:
+                break
+            start_key = skip_key = key_slice_list[-1].key
         
     def sql_indexes_for_model(self, model, style):
         """
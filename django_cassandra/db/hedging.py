@@ -0,0 +1,372 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Hedged reads: if a read hasn't completed after a delay that's based on the
+recent read latencies, the same read is sent to a second coordinator node and
+the first successful response is used. This cuts the tail latency caused by a
+single slow coordinator, at the cost of some extra load, which is limited by
+a budget on the fraction of reads that can be hedged.
+
+The read is made by the calling thread; only the hedges run in the threads of
+the reader's executor, so a slow host can't tie up the threads that the other
+reads need. If the hedge completes first, the socket of the read is shut down
+to interrupt it, and the read returns the results of the hedge.
+"""
+
+import heapq
+import socket
+import threading
+import time
+from collections import deque
+
+from .concurrent import QueryExecutor
+from .pool import HostConnectionPool
+from .utils import CassandraConnectionError, call_cassandra, call_cassandra_with_reconnect, \
+    get_cassandra_hosts, get_cassandra_setting, record_cassandra_call
+
+DEFAULT_HEDGE_PERCENTILE = 95
+DEFAULT_HEDGE_MIN_DELAY = 0.005
+DEFAULT_HEDGE_BUDGET = 0.05
+# Maximum number of hedges that can be saved up from the budget
+MAX_HEDGE_TOKENS = 10.0
+# Number of recent read latencies that the hedge delay is computed from
+LATENCY_SAMPLE_COUNT = 1000
+# The hedge delay is recomputed after this many new latency samples
+LATENCY_RECOMPUTE_INTERVAL = 50
+
+class LatencyTracker(object):
+    """
+    Keeps the most recent read latencies and computes a percentile of them.
+    """
+
+    def __init__(self, percentile, min_delay, sample_count=LATENCY_SAMPLE_COUNT):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.samples = deque(maxlen=sample_count)
+        self._lock = threading.Lock()
+        self._new_sample_count = 0
+        self._delay = min_delay
+
+    def add(self, latency):
+        self._lock.acquire()
+        try:
+            self.samples.append(latency)
+            self._new_sample_count += 1
+            if self._new_sample_count >= LATENCY_RECOMPUTE_INTERVAL:
+                self._new_sample_count = 0
+                samples = sorted(self.samples)
+                index = min(len(samples) - 1, int(len(samples) * self.percentile / 100.0))
+                self._delay = max(self.min_delay, samples[index])
+        finally:
+            self._lock.release()
+
+    def get_delay(self):
+        return self._delay
+
+class HedgeBudget(object):
+    """
+    Token bucket that limits the hedged reads to a fraction of all reads.
+    Every read adds the budget fraction of a token and each hedge uses up a
+    whole token.
+    """
+
+    def __init__(self, budget, max_tokens=MAX_HEDGE_TOKENS):
+        self.budget = budget
+        self.max_tokens = max_tokens
+        self.tokens = 1.0
+        self._lock = threading.Lock()
+
+    def add_read(self):
+        self._lock.acquire()
+        self.tokens = min(self.max_tokens, self.tokens + self.budget)
+        self._lock.release()
+
+    def take_hedge(self):
+        self._lock.acquire()
+        try:
+            if self.tokens < 1.0:
+                return False
+            self.tokens -= 1.0
+            return True
+        finally:
+            self._lock.release()
+
+class HedgeScheduler(object):
+    """
+    Thread that calls the functions scheduled with a delay, i.e. that starts
+    the hedges of the reads that are still running after the hedge delay.
+    The functions must return quickly.
+    """
+
+    def __init__(self):
+        self._entries = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, delay, fn):
+        """
+        Schedules the call of fn after delay seconds. Returns an entry that
+        can be passed to cancel.
+        """
+        self._condition.acquire()
+        try:
+            self._sequence += 1
+            entry = [time.time() + delay, self._sequence, fn]
+            heapq.heappush(self._entries, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._condition.notify()
+            return entry
+        finally:
+            self._condition.release()
+
+    def cancel(self, entry):
+        self._condition.acquire()
+        entry[2] = None
+        self._condition.release()
+
+    def _run(self):
+        while True:
+            self._condition.acquire()
+            try:
+                while True:
+                    if not self._entries:
+                        self._condition.wait()
+                        continue
+                    remaining_time = self._entries[0][0] - time.time()
+                    if remaining_time <= 0:
+                        break
+                    self._condition.wait(remaining_time)
+                fn = heapq.heappop(self._entries)[2]
+            finally:
+                self._condition.release()
+            if fn is not None:
+                try:
+                    fn()
+                except Exception:
+                    pass
+
+class _HedgedRead(object):
+    # The state of a read that's shared with its hedge
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.hedge_future = None
+        self.finished = False
+        self.aborted = False
+        self.lock = threading.Lock()
+
+class HedgedReader(object):
+    """
+    Sends reads to the configured hosts, hedging the ones that are slow.
+    The primary host of the reads is rotated through the hosts.
+    """
+
+    def __init__(self, hosts, keyspace, user=None, password=None,
+                 percentile=DEFAULT_HEDGE_PERCENTILE, min_delay=DEFAULT_HEDGE_MIN_DELAY,
+                 budget=DEFAULT_HEDGE_BUDGET):
+        self.pools = [HostConnectionPool(host, port, keyspace, user, password)
+                      for host, port in hosts]
+        self.latency_tracker = LatencyTracker(percentile, min_delay)
+        self.budget = HedgeBudget(budget)
+        # Only the hedges run in the executor, and the budget limits them
+        self.executor = QueryExecutor(max(2, len(self.pools)))
+        self.scheduler = HedgeScheduler()
+        self.read_count = 0
+        self.hedged_count = 0
+        self._next_host_index = 0
+        self._lock = threading.Lock()
+
+    def _get_primary_host_index(self):
+        self._lock.acquire()
+        try:
+            index = self._next_host_index
+            self._next_host_index = (index + 1) % len(self.pools)
+            self.read_count += 1
+            return index
+        finally:
+            self._lock.release()
+
+    def _call_host(self, host_index, timeout, fn, args):
+        pool = self.pools[host_index]
+        connection = pool.get()
+        try:
+            connection.set_timeout(timeout)
+            return call_cassandra_with_reconnect(connection, fn, *args)
+        finally:
+            pool.put(connection)
+
+    def _start_hedge(self, read, host_index, timeout, fn, args):
+        # Called by the scheduler when the read is still running after the
+        # hedge delay
+        read.lock.acquire()
+        try:
+            if read.finished or not self.budget.take_hedge():
+                return
+            self.hedged_count += 1
+            read.hedge_future = self.executor.submit(self._call_host, host_index,
+                                                     timeout, fn, args)
+        finally:
+            read.lock.release()
+        read.hedge_future.add_done_callback(lambda future: self._abort_read(read, future))
+
+    def _abort_read(self, read, hedge_future):
+        # The hedge completed, so the read is interrupted if it's still
+        # running and the hedge succeeded
+        if hedge_future.exception() is not None:
+            return
+        read.lock.acquire()
+        try:
+            if read.finished:
+                return
+            read.aborted = True
+            thrift_socket = read.connection.socket
+            if thrift_socket is not None:
+                try:
+                    thrift_socket.handle.shutdown(socket.SHUT_RDWR)
+                except (socket.error, AttributeError):
+                    pass
+        finally:
+            read.lock.release()
+
+    def _call_primary(self, read, fn, args):
+        # Like call_cassandra_with_reconnect, except that the connection
+        # isn't reopened if the read was aborted
+        connection = read.connection
+        try:
+            return call_cassandra(connection, fn, *args)
+        except CassandraConnectionError:
+            if read.aborted:
+                raise
+        try:
+            connection.reopen()
+        except Exception, e:
+            raise CassandraConnectionError(e)
+        return call_cassandra(connection, fn, *args)
+
+    def call(self, fn, args, timeout=None):
+        """
+        Makes the read call, hedging it with a call to another host if it's
+        slow (and the budget allows it). The results of the first call that
+        succeeds are returned; if both of them fail, the error of the read is
+        raised.
+        """
+        start_time = time.time()
+        self.budget.add_read()
+        primary_host_index = self._get_primary_host_index()
+        pool = self.pools[primary_host_index]
+        read = _HedgedRead(pool.get())
+        read.connection.set_timeout(timeout)
+
+        scheduled_hedge = None
+        if len(self.pools) > 1:
+            hedge_host_index = (primary_host_index + 1) % len(self.pools)
+            scheduled_hedge = self.scheduler.schedule(self.latency_tracker.get_delay(),
+                lambda: self._start_hedge(read, hedge_host_index, timeout, fn, args))
+
+        results = error = None
+        try:
+            results = self._call_primary(read, fn, args)
+        except Exception, e:
+            error = e
+        if scheduled_hedge is not None:
+            self.scheduler.cancel(scheduled_hedge)
+        read.lock.acquire()
+        read.finished = True
+        read.lock.release()
+        if read.aborted:
+            # The socket was shut down, so the connection has to be reopened
+            read.connection.close()
+        pool.put(read.connection)
+
+        if (error is not None) and (read.hedge_future is not None):
+            remaining_time = None
+            if timeout is not None:
+                remaining_time = max(0.0, timeout - (time.time() - start_time))
+            try:
+                results = read.hedge_future.result(remaining_time)
+                error = None
+            except Exception:
+                pass
+        if error is not None:
+            raise error
+        self.latency_tracker.add(time.time() - start_time)
+        return results
+
+    def close(self):
+        self.executor.shutdown(False)
+
+_readers = {}
+_readers_lock = threading.Lock()
+
+def get_hedged_reader(connection, model):
+    """
+    Returns the hedged reader to use for reads of the model, or None if
+    hedged reads aren't enabled for it. Hedged reads are enabled with
+    CASSANDRA_HEDGED_READS in the database settings or HEDGED_READS in the
+    CassandraSettings of the model, and need more than one host in HOST.
+    The hedge delay is the CASSANDRA_HEDGED_READ_PERCENTILE percentile of the
+    recent read latencies (but at least CASSANDRA_HEDGED_READ_MIN_DELAY
+    seconds) and CASSANDRA_HEDGED_READ_BUDGET is the maximum fraction of the
+    reads that are hedged.
+    """
+    settings_dict = connection.settings_dict
+    default = settings_dict.get('CASSANDRA_HEDGED_READS', False)
+    if not get_cassandra_setting(model, 'HEDGED_READS', default):
+        return None
+    hosts = get_cassandra_hosts(settings_dict)
+    if len(hosts) < 2:
+        return None
+
+    keyspace = settings_dict.get('NAME') or 'django'
+    key = (connection.alias, keyspace)
+    reader = _readers.get(key)
+    if reader is None:
+        _readers_lock.acquire()
+        try:
+            reader = _readers.get(key)
+            if reader is None:
+                reader = HedgedReader(hosts, keyspace,
+                    settings_dict.get('USER'), settings_dict.get('PASSWORD'),
+                    settings_dict.get('CASSANDRA_HEDGED_READ_PERCENTILE', DEFAULT_HEDGE_PERCENTILE),
+                    settings_dict.get('CASSANDRA_HEDGED_READ_MIN_DELAY', DEFAULT_HEDGE_MIN_DELAY),
+                    settings_dict.get('CASSANDRA_HEDGED_READ_BUDGET', DEFAULT_HEDGE_BUDGET))
+                _readers[key] = reader
+        finally:
+            _readers_lock.release()
+    return reader
+
+def call_cassandra_hedged(connection, reader, timeout, fn, *args):
+    """
+    Makes a read call with the hedged reader. The call is recorded with the
+    instrumentation of the given connection, as a single call.
+    """
+    instrumentation = connection.instrumentation
+    if (instrumentation is None) or not instrumentation.is_active():
+        return reader.call(fn, args, timeout)
+
+    results = error = None
+    start_time = time.time()
+    try:
+        results = reader.call(fn, args, timeout)
+        return results
+    except Exception, e:
+        error = e
+        raise
+    finally:
+        record_cassandra_call(instrumentation, fn, args, results, time.time() - start_time, 0, error)
@@ -0,0 +1,343 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import bisect
+import socket
+import threading
+from django.conf import settings
+from django.dispatch import Signal
+from django.utils.importlib import import_module
+from cassandra.ttypes import *
+
+# Sent after every call to Cassandra that goes through the backend, with the
+# DatabaseWrapper as the connection argument and a CallRecord describing the call.
+cassandra_call_completed = Signal(providing_args=['connection', 'record'])
+
+class CallRecord(object):
+    """
+    Describes a single call to the Cassandra Thrift API: the method, the column
+    family and a summary of the arguments, how long it took, how much data was
+    returned (or written for batch_mutate) and how many times the connection
+    had to be reopened.
+    """
+
+    __slots__ = ('method', 'column_family', 'predicate', 'duration', 'rows',
+                 'columns', 'bytes', 'reconnects', 'error')
+
+    def __init__(self, method, column_family, predicate, duration, rows, columns,
+                 bytes, reconnects, error):
+        self.method = method
+        self.column_family = column_family
+        self.predicate = predicate
+        self.duration = duration
+        self.rows = rows
+        self.columns = columns
+        self.bytes = bytes
+        self.reconnects = reconnects
+        self.error = error
+
+    def __repr__(self):
+        s = self.method
+        if self.column_family:
+            s += ' ' + self.column_family
+        if self.predicate:
+            s += ' ' + self.predicate
+        return s
+
+def _consistency_level_name(consistency_level):
+    return ConsistencyLevel._VALUES_TO_NAMES.get(consistency_level, str(consistency_level))
+
+def _summarize_argument(arg):
+    """
+    Returns a (column_family, summary) tuple for an argument of a Thrift call.
+    The summaries are kept short, so e.g. the contents of a batch_mutate
+    mutation map are never included.
+    """
+    if isinstance(arg, (ColumnParent, ColumnPath)):
+        return arg.column_family, None
+    elif isinstance(arg, KeyRange):
+        if arg.start_token is not None or arg.end_token is not None:
+            return None, 'tokens (%s, %s] count=%s' % (arg.start_token, arg.end_token, arg.count)
+        return None, 'keys [%r, %r] count=%s' % (arg.start_key, arg.end_key, arg.count)
+    elif isinstance(arg, IndexClause):
+        expressions = ' AND '.join(['%s %s %r' % (expression.column_name,
+            IndexOperator._VALUES_TO_NAMES.get(expression.op, expression.op), expression.value)
+            for expression in arg.expressions])
+        return None, 'index (%s) start=%r count=%s' % (expressions, arg.start_key, arg.count)
+    elif isinstance(arg, SlicePredicate):
+        if arg.column_names is not None:
+            return None, 'columns %r' % (arg.column_names,)
+        slice_range = arg.slice_range
+        if slice_range is not None:
+            return None, 'slice [%r:%r]%s count=%s' % (slice_range.start, slice_range.finish,
+                ' reversed' if slice_range.reversed else '', slice_range.count)
+    elif isinstance(arg, dict):
+        # batch_mutate mutation map
+        column_families = set()
+        mutation_count = 0
+        for column_family_mutations in arg.itervalues():
+            for column_family, mutations in column_family_mutations.iteritems():
+                column_families.add(column_family)
+                mutation_count += len(mutations)
+        return ','.join(sorted(column_families)), '%d rows %d mutations' % (len(arg), mutation_count)
+    elif isinstance(arg, (list, tuple)):
+        return None, '%d keys' % len(arg)
+    elif isinstance(arg, basestring):
+        return None, repr(arg)
+    return None, None
+
+def summarize_call(args):
+    """
+    Returns the column family and a short summary of the arguments of a call.
+    """
+    column_family = None
+    summaries = []
+    for index, arg in enumerate(args):
+        if (index == len(args) - 1) and isinstance(arg, int):
+            # The consistency level is always the last argument
+            summaries.append('CL=' + _consistency_level_name(arg))
+            continue
+        arg_column_family, summary = _summarize_argument(arg)
+        if arg_column_family and not column_family:
+            column_family = arg_column_family
+        if summary:
+            summaries.append(summary)
+    return column_family, ' '.join(summaries)
+
+def _measure_column(column_or_supercolumn):
+    column = column_or_supercolumn.column
+    if column is not None:
+        return len(column.name) + len(column.value or '')
+    counter_column = column_or_supercolumn.counter_column
+    if counter_column is not None:
+        return len(counter_column.name) + 8
+    return 0
+
+def measure_call(args, results):
+    """
+    Returns the number of rows, columns & bytes returned by a call (or,
+    for batch_mutate, written by the call).
+    """
+    rows = columns = bytes = 0
+    if type(results) is list:
+        if results and isinstance(results[0], KeySlice):
+            rows = len(results)
+            for key_slice in results:
+                bytes += len(key_slice.key)
+                columns += len(key_slice.columns)
+                for column in key_slice.columns:
+                    bytes += _measure_column(column)
+        elif results and isinstance(results[0], ColumnOrSuperColumn):
+            rows = 1
+            columns = len(results)
+            for column in results:
+                bytes += _measure_column(column)
+    elif type(results) is dict:
+        # multiget_slice
+        for key, column_list in results.iteritems():
+            if column_list:
+                rows += 1
+                bytes += len(key)
+                columns += len(column_list)
+                for column in column_list:
+                    bytes += _measure_column(column)
+    elif results is None and args and type(args[0]) is dict:
+        # batch_mutate
+        for key, column_family_mutations in args[0].iteritems():
+            rows += 1
+            bytes += len(key)
+            for mutations in column_family_mutations.itervalues():
+                columns += len(mutations)
+                for mutation in mutations:
+                    if mutation.column_or_supercolumn is not None:
+                        bytes += _measure_column(mutation.column_or_supercolumn)
+    return rows, columns, bytes
+
+
+class MetricsSink(object):
+    """
+    Base class for the sinks that receive a CallRecord for each call to
+    Cassandra. The sink is configured with the CASSANDRA_METRICS_SINK setting
+    (the dotted path of the class) and CASSANDRA_METRICS_SINK_OPTIONS (the
+    keyword arguments for its constructor) in the database settings.
+    The record method may be called concurrently from multiple threads.
+    """
+
+    def record(self, alias, record):
+        raise NotImplementedError()
+
+
+class StatsdMetricsSink(MetricsSink):
+    """
+    Sends a counter and a timer for each call to a statsd daemon over UDP.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='django_cassandra'):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, alias, record):
+        name = '%s.%s.%s' % (self.prefix, alias, record.method)
+        lines = ['%s.calls:1|c' % name,
+                 '%s.time:%.3f|ms' % (name, record.duration * 1000.0),
+                 '%s.rows:%d|c' % (name, record.rows),
+                 '%s.bytes:%d|c' % (name, record.bytes)]
+        if record.reconnects:
+            lines.append('%s.reconnects:%d|c' % (name, record.reconnects))
+        if record.error is not None:
+            lines.append('%s.errors:1|c' % name)
+        try:
+            self.socket.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            pass
+
+
+class PrometheusMetricsSink(MetricsSink):
+    """
+    Accumulates Prometheus-style counters and a latency histogram per
+    database alias, method and column family in memory. The render method
+    returns them in the Prometheus text exposition format, so they can be
+    served from a metrics view.
+    """
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    COUNTERS = ('calls', 'errors', 'rows', 'columns', 'bytes', 'reconnects')
+
+    def __init__(self, prefix='django_cassandra', buckets=None):
+        self.prefix = prefix
+        self.buckets = tuple(buckets) if buckets else self.DEFAULT_BUCKETS
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def record(self, alias, record):
+        labels = (alias, record.method, record.column_family or '')
+        bucket_index = bisect.bisect_left(self.buckets, record.duration)
+        self.lock.acquire()
+        try:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = {
+                    'calls': 0, 'errors': 0, 'rows': 0, 'columns': 0, 'bytes': 0,
+                    'reconnects': 0, 'duration_sum': 0.0,
+                    'duration_buckets': [0] * (len(self.buckets) + 1)}
+            series['calls'] += 1
+            if record.error is not None:
+                series['errors'] += 1
+            series['rows'] += record.rows
+            series['columns'] += record.columns
+            series['bytes'] += record.bytes
+            series['reconnects'] += record.reconnects
+            series['duration_sum'] += record.duration
+            series['duration_buckets'][bucket_index] += 1
+        finally:
+            self.lock.release()
+
+    def render(self):
+        self.lock.acquire()
+        try:
+            lines = []
+            for counter in self.COUNTERS:
+                lines.append('# TYPE %s_%s_total counter' % (self.prefix, counter))
+                for labels, series in sorted(self.series.items()):
+                    lines.append('%s_%s_total{%s} %d' % (self.prefix, counter,
+                        self._format_labels(labels), series[counter]))
+            name = '%s_call_duration_seconds' % self.prefix
+            lines.append('# TYPE %s histogram' % name)
+            for labels, series in sorted(self.series.items()):
+                label_string = self._format_labels(labels)
+                cumulative_count = 0
+                for bucket, count in zip(self.buckets + ('+Inf',), series['duration_buckets']):
+                    cumulative_count += count
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (name, label_string, bucket, cumulative_count))
+                lines.append('%s_sum{%s} %f' % (name, label_string, series['duration_sum']))
+                lines.append('%s_count{%s} %d' % (name, label_string, series['calls']))
+            return '\n'.join(lines) + '\n'
+        finally:
+            self.lock.release()
+
+    def _format_labels(self, labels):
+        alias, method, column_family = labels
+        return 'alias="%s",method="%s",column_family="%s"' % (alias, method, column_family)
+
+
+_metrics_sinks = {}
+_metrics_sinks_lock = threading.Lock()
+
+def get_metrics_sink(alias, settings_dict):
+    """
+    Returns the (process-wide) metrics sink configured for the database, or
+    None if there isn't one.
+    """
+    try:
+        return _metrics_sinks[alias]
+    except KeyError:
+        pass
+    _metrics_sinks_lock.acquire()
+    try:
+        if alias not in _metrics_sinks:
+            sink = settings_dict.get('CASSANDRA_METRICS_SINK')
+            if isinstance(sink, basestring):
+                module_name, class_name = sink.rsplit('.', 1)
+                sink_class = getattr(import_module(module_name), class_name)
+                sink = sink_class(**settings_dict.get('CASSANDRA_METRICS_SINK_OPTIONS', {}))
+            _metrics_sinks[alias] = sink
+        return _metrics_sinks[alias]
+    finally:
+        _metrics_sinks_lock.release()
+
+
+class Instrumentation(object):
+    """
+    Records the calls made through a CassandraConnection. The record is
+    added to connection.queries (when DEBUG is enabled or the debug cursor
+    is forced on), sent with the cassandra_call_completed signal and passed to
+    the configured metrics sink. If none of those would use it, nothing is
+    measured, so the instrumentation can be left enabled in production.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.enabled = connection.settings_dict.get('CASSANDRA_INSTRUMENTATION', True)
+        self.metrics_sink = get_metrics_sink(connection.alias, connection.settings_dict)
+
+    def _records_queries(self):
+        return settings.DEBUG or getattr(self.connection, 'use_debug_cursor', False)
+
+    def is_active(self):
+        return self.enabled and ((self.metrics_sink is not None) or
+            bool(cassandra_call_completed.receivers) or self._records_queries())
+
+    def record_call(self, fn, args, results, duration, reconnects, error):
+        column_family, predicate = summarize_call(args)
+        rows, columns, bytes = measure_call(args, results)
+        record = CallRecord(fn.__name__, column_family, predicate, duration,
+                            rows, columns, bytes, reconnects, error)
+
+        if self._records_queries():
+            self.connection.queries.append({
+                'sql': repr(record),
+                'time': '%.3f' % duration,
+                'rows': rows,
+                'columns': columns,
+                'bytes': bytes,
+                'reconnects': reconnects,
+            })
+        if cassandra_call_completed.receivers:
+            cassandra_call_completed.send(sender=self.connection.__class__,
+                connection=self.connection, record=record)
+        if self.metrics_sink is not None:
+            self.metrics_sink.record(self.connection.alias, record)
+        return record
@@ -14,14 +14,16 @@
 
 from djangotoolbox.db.base import NonrelDatabaseIntrospection
 from django.db.backends import BaseDatabaseIntrospection
+from cassandra import Cassandra
+from .metadata import get_keyspace_metadata
 
 class DatabaseIntrospection(NonrelDatabaseIntrospection):
     def get_table_list(self, cursor):
         "Returns a list of names of all tables that exist in the database."
-        db_connection = self.connection.db_connection
-        ks_def = db_connection.get_client().describe_keyspace(db_connection.keyspace)
-        result = [cf_def.name for cf_def in ks_def.cf_defs]
-        return result
+        # Make sure that the keyspace exists
+        self.connection.db_connection
+        metadata = get_keyspace_metadata(self.connection)
+        return metadata.get_table_names() if metadata else []
     
     def table_names(self):
         # NonrelDatabaseIntrospection has an implementation of this that returns
@@ -0,0 +1,175 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Cache of the keyspace metadata (the column families, their column metadata
+and index types), so that introspection, the creation code and the query
+planner don't have to call describe_keyspace every time they need it. The
+cached metadata is checked again after CASSANDRA_METADATA_CACHE_TTL seconds:
+if the schema version of the cluster hasn't changed it's kept, otherwise the
+keyspace is described again. So the queries, which look up the indexes in the
+metadata, make at most a describe_schema_versions and a describe_keyspace call
+per TTL between them. Schema changes made by the backend invalidate it right
+away.
+"""
+
+import threading
+import time
+
+from cassandra import Cassandra
+from .utils import CassandraAccessError, CassandraTimeoutError, call_cassandra_with_reconnect
+
+DEFAULT_METADATA_CACHE_TTL = 60.0
+
+class KeyspaceMetadata(object):
+    """
+    Snapshot of the definition of a keyspace.
+    """
+
+    def __init__(self, keyspace_def, schema_version):
+        self.keyspace_def = keyspace_def
+        self.schema_version = schema_version
+        self.column_families = dict((cf_def.name, cf_def) for cf_def in keyspace_def.cf_defs)
+        self._indexed_columns = {}
+        for cf_def in keyspace_def.cf_defs:
+            self._indexed_columns[cf_def.name] = frozenset(
+                column_def.name for column_def in (cf_def.column_metadata or [])
+                if column_def.index_type is not None)
+
+    def get_table_names(self):
+        return self.column_families.keys()
+
+    def get_column_family(self, name):
+        return self.column_families.get(name)
+
+    def get_indexed_columns(self, column_family):
+        """
+        Returns the set of the names of the columns with a secondary index,
+        or None if the column family doesn't exist.
+        """
+        return self._indexed_columns.get(column_family)
+
+def _get_schema_version(db_connection):
+    # Returns the schema version of the cluster, or None if the nodes
+    # don't agree on it.
+    schema_versions = call_cassandra_with_reconnect(db_connection,
+        Cassandra.Client.describe_schema_versions)
+    versions = [version for version in schema_versions if version != 'UNREACHABLE']
+    return versions[0] if len(versions) == 1 else None
+
+class MetadataCache(object):
+    """
+    The metadata of each keyspace is checked at most once per TTL: the first
+    thread that finds it expired checks it, while the others keep using the
+    cached metadata. A keyspace that doesn't exist is cached too (as None).
+    While the nodes don't agree on the schema version the metadata is still
+    cached, but it's described again at the next check.
+    """
+
+    def __init__(self, ttl=DEFAULT_METADATA_CACHE_TTL):
+        self.ttl = ttl
+        # Maps the keyspace names to (metadata, check time) tuples
+        self._keyspaces = {}
+        self._lock = threading.Lock()
+
+    def get_keyspace_metadata(self, db_connection, keyspace_name):
+        """
+        Returns the metadata of the keyspace, or None if it doesn't exist.
+        """
+        entry = self._keyspaces.get(keyspace_name)
+        if entry is not None:
+            metadata, check_time = entry
+            if time.time() - check_time < self.ttl:
+                return metadata
+            # The check time is moved forward right away, so that the other
+            # threads don't check it too
+            self._lock.acquire()
+            try:
+                if self._keyspaces.get(keyspace_name) is not entry:
+                    return metadata
+                self._keyspaces[keyspace_name] = (metadata, time.time())
+            finally:
+                self._lock.release()
+
+            schema_version = _get_schema_version(db_connection)
+            if (metadata is not None) and (schema_version is not None) and \
+                (schema_version == metadata.schema_version):
+                return metadata
+        else:
+            schema_version = _get_schema_version(db_connection)
+
+        try:
+            keyspace_def = call_cassandra_with_reconnect(db_connection,
+                Cassandra.Client.describe_keyspace, keyspace_name)
+            metadata = KeyspaceMetadata(keyspace_def, schema_version)
+        except CassandraTimeoutError:
+            # Not cached, since the keyspace may well exist
+            return None
+        except CassandraAccessError:
+            metadata = None
+        self._lock.acquire()
+        try:
+            self._keyspaces[keyspace_name] = (metadata, time.time())
+        finally:
+            self._lock.release()
+        return metadata
+
+    def invalidate(self, keyspace_name=None):
+        self._lock.acquire()
+        try:
+            if keyspace_name is None:
+                self._keyspaces.clear()
+            else:
+                self._keyspaces.pop(keyspace_name, None)
+        finally:
+            self._lock.release()
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_metadata_cache(connection):
+    """
+    Returns the metadata cache of the database. It's shared by all of the
+    threads of the process.
+    """
+    cache = _caches.get(connection.alias)
+    if cache is None:
+        _caches_lock.acquire()
+        try:
+            cache = _caches.get(connection.alias)
+            if cache is None:
+                ttl = connection.settings_dict.get('CASSANDRA_METADATA_CACHE_TTL',
+                                                   DEFAULT_METADATA_CACHE_TTL)
+                cache = _caches[connection.alias] = MetadataCache(ttl)
+        finally:
+            _caches_lock.release()
+    return cache
+
+def get_keyspace_metadata(connection):
+    """
+    Returns the (possibly cached) metadata of the keyspace of the database,
+    or None if the keyspace doesn't exist.
+    """
+    db_connection = connection.get_db_connection(False, False)
+    return get_metadata_cache(connection).get_keyspace_metadata(db_connection,
+                                                                db_connection.keyspace)
+
+def invalidate_keyspace_metadata(connection, keyspace_name=None):
+    """
+    Discards the cached metadata of the keyspace (by default the keyspace of
+    the database) after a schema change.
+    """
+    if keyspace_name is None:
+        keyspace_name = connection.settings_dict.get('NAME') or 'django'
+    get_metadata_cache(connection).invalidate(keyspace_name)
@@ -0,0 +1,141 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Per-operation settings (consistency levels, timeouts and the TTL of the
+columns that are written). The settings that apply to an operation are
+resolved from, in order of precedence:
+- the overrides in effect in the current thread, which are set with the
+  cassandra_options context manager or the using_consistency/with_timeout/
+  with_ttl methods of CassandraQuerySet (the innermost override wins)
+- the CassandraSettings of the model (READ_CONSISTENCY_LEVEL,
+  WRITE_CONSISTENCY_LEVEL, TIMEOUT and TTL)
+- the database settings (CASSANDRA_READ_CONSISTENCY_LEVEL,
+  CASSANDRA_WRITE_CONSISTENCY_LEVEL and CASSANDRA_TIMEOUT)
+The full_write option can only be set with an override.
+"""
+
+import threading
+from contextlib import contextmanager
+
+from .utils import get_cassandra_setting
+
+# Maps the option names to the name of the setting in CassandraSettings
+MODEL_OPTION_SETTINGS = (
+    ('read_consistency_level', 'READ_CONSISTENCY_LEVEL'),
+    ('write_consistency_level', 'WRITE_CONSISTENCY_LEVEL'),
+    ('timeout', 'TIMEOUT'),
+    ('ttl', 'TTL'),
+)
+
+# Options that don't have a setting
+OVERRIDE_OPTION_NAMES = ('full_write',)
+
+OPTION_NAMES = tuple([option_name for option_name, setting_name in MODEL_OPTION_SETTINGS]) + \
+    OVERRIDE_OPTION_NAMES
+
+class OperationOptions(object):
+
+    __slots__ = OPTION_NAMES
+
+    def __init__(self, **options):
+        for option_name in OPTION_NAMES:
+            setattr(self, option_name, options.get(option_name))
+
+_local = threading.local()
+
+def get_option_overrides():
+    """
+    Returns the list of the option overrides in effect in the current thread,
+    from the outermost to the innermost one.
+    """
+    overrides = getattr(_local, 'overrides', None)
+    if overrides is None:
+        overrides = _local.overrides = []
+    return overrides
+
+def make_option_overrides(consistency_level=None, **options):
+    overrides = {}
+    if consistency_level is not None:
+        overrides['read_consistency_level'] = consistency_level
+        overrides['write_consistency_level'] = consistency_level
+    for option_name, value in options.iteritems():
+        if option_name not in OPTION_NAMES:
+            raise TypeError('Unknown Cassandra option: %s' % option_name)
+        if value is not None:
+            overrides[option_name] = value
+    return overrides
+
+def push_option_overrides(overrides):
+    get_option_overrides().append(overrides)
+
+def pop_option_overrides():
+    get_option_overrides().pop()
+
+@contextmanager
+def cassandra_options(consistency_level=None, **options):
+    """
+    Overrides the settings of the Cassandra operations in the with block:
+
+        with cassandra_options(read_consistency_level=ConsistencyLevel.QUORUM, timeout=0.5):
+            ...
+
+    consistency_level sets both the read and the write consistency level.
+    Options that are None aren't overridden. The ttl option (in seconds) is
+    set on the columns that are written, e.g. when saving a model instance:
+
+        with cassandra_options(ttl=3600):
+            session.save()
+
+    A ttl of 0 writes columns that never expire. With full_write=True a save
+    writes all of the fields of a model that uses dirty field tracking, not
+    just the ones that changed.
+    """
+    push_option_overrides(make_option_overrides(consistency_level, **options))
+    try:
+        yield
+    finally:
+        pop_option_overrides()
+
+def bind_option_overrides(fn):
+    """
+    Returns a function that calls fn with the option overrides that are in
+    effect now, for calls that are run later in a different thread.
+    """
+    overrides = list(get_option_overrides())
+    def _fn(*args, **kwargs):
+        saved_overrides = get_option_overrides()
+        _local.overrides = list(overrides)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.overrides = saved_overrides
+    return _fn
+
+def get_operation_options(connection, model):
+    options = {
+        'read_consistency_level': connection.read_consistency_level,
+        'write_consistency_level': connection.write_consistency_level,
+        'timeout': connection.timeout,
+        'ttl': None,
+        'full_write': False,
+    }
+    if model is not None:
+        for option_name, setting_name in MODEL_OPTION_SETTINGS:
+            value = get_cassandra_setting(model, setting_name)
+            if value is not None:
+                options[option_name] = value
+    for overrides in get_option_overrides():
+        options.update(overrides)
+    return OperationOptions(**options)
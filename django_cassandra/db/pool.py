@@ -0,0 +1,193 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Connection pools and the process-wide state that makes the first use of the
+database in a thread fast: the capabilities of each Cassandra server, which
+are determined from its API version, and a pool of connections that were
+opened, authenticated and bound to the keyspace in the background when the
+process started.
+"""
+
+import logging
+import threading
+
+from .utils import CassandraConnection, get_cassandra_hosts
+
+logger = logging.getLogger('django_cassandra')
+
+# The partitioners that keep the rows in the order of their keys, so that
+# a key range can be fetched with a get_range_slices call
+ORDER_PRESERVING_PARTITIONERS = (
+    'org.apache.cassandra.dht.OrderPreservingPartitioner',
+    'org.apache.cassandra.dht.ByteOrderedPartitioner',
+    'org.apache.cassandra.dht.CollatingOrderPreservingPartitioner',
+)
+
+class ServerCapabilities(object):
+    """
+    Features supported by a Cassandra server, based on its API version and
+    the partitioner of the cluster.
+    """
+
+    def __init__(self, major_version, minor_version, patch_version, partitioner=None):
+        self.version = (major_version, minor_version, patch_version)
+        self.partitioner = partitioner
+        self.preserves_key_order = partitioner in ORDER_PRESERVING_PARTITIONERS
+        self.supports_replication_factor_as_strategy_option = \
+            major_version >= 19 and minor_version >= 10
+        # Truncate corrupted the secondary indexes before the 0.7.0 release
+        # (API version 19.4.0)
+        self.supports_truncate = (major_version, minor_version) >= (19, 4)
+
+_server_capabilities = {}
+
+def get_server_capabilities(host, port):
+    """
+    Returns the capabilities of the server if they've already been determined
+    by a connection of this process, or None.
+    """
+    return _server_capabilities.get((host, port))
+
+def set_server_capabilities(host, port, capabilities):
+    _server_capabilities[(host, port)] = capabilities
+
+class HostConnectionPool(object):
+    """
+    Pool of connections to a single host. The connections aren't tied to a
+    thread: each call takes a connection from the pool and puts it back when
+    it's done (e.g. a hedged read can complete after the caller has moved on).
+    """
+
+    def __init__(self, host, port, keyspace, user, password, timeout=None):
+        self.host = host
+        self.port = port
+        self.keyspace = keyspace
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        self._lock.acquire()
+        try:
+            if self._connections:
+                return self._connections.pop()
+        finally:
+            self._lock.release()
+        return CassandraConnection(self.host, self.port, self.keyspace,
+                                   self.user, self.password, self.timeout)
+
+    def put(self, connection):
+        self._lock.acquire()
+        self._connections.append(connection)
+        self._lock.release()
+
+class WarmConnectionPool(object):
+    """
+    Connections that are ready to use (opened, logged in and with the keyspace
+    set). Each connection is handed to a single thread, which then keeps it.
+    """
+
+    def __init__(self):
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        self._lock.acquire()
+        try:
+            if self._connections:
+                return self._connections.pop()
+            return None
+        finally:
+            self._lock.release()
+
+    def put(self, db_connection):
+        self._lock.acquire()
+        self._connections.append(db_connection)
+        self._lock.release()
+
+    def __len__(self):
+        return len(self._connections)
+
+_pools = {}
+_pools_lock = threading.Lock()
+_prewarmed_aliases = set()
+
+def get_warm_connection_pool(alias, keyspace):
+    key = (alias, keyspace)
+    pool = _pools.get(key)
+    if pool is None:
+        _pools_lock.acquire()
+        try:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = WarmConnectionPool()
+        finally:
+            _pools_lock.release()
+    return pool
+
+def _open_connections(connection, pool, count):
+    # The connections are opened directly rather than with get_db_connection,
+    # which would take the connections back out of the pool. If the keyspace
+    # doesn't exist yet, it's left to the first thread that uses the database
+    # to create it.
+    settings_dict = connection.settings_dict
+    host, port = get_cassandra_hosts(settings_dict)[0]
+    keyspace = settings_dict.get('NAME') or 'django'
+    for i in range(count):
+        db_connection = CassandraConnection(host, port, keyspace, settings_dict.get('USER'),
+                                            settings_dict.get('PASSWORD'), connection.timeout)
+        try:
+            db_connection.open(True, True)
+        except Exception, e:
+            db_connection.close()
+            logger.warning('Error opening a connection to Cassandra in the background: %s', e)
+            return
+        pool.put(db_connection)
+
+def prewarm_connections(connection, count=None):
+    """
+    Opens count connections (by default CASSANDRA_PREWARM_CONNECTIONS from the
+    database settings) in a background thread and adds them to the warm
+    connection pool of the database. The first thread that uses the database
+    takes a connection from the pool instead of opening its own. Returns the
+    background thread, or None if no connections are opened.
+    """
+    if count is None:
+        count = connection.settings_dict.get('CASSANDRA_PREWARM_CONNECTIONS', 0)
+    if count <= 0:
+        return None
+    pool = get_warm_connection_pool(connection.alias, connection.settings_dict.get('NAME') or 'django')
+    thread = threading.Thread(target=_open_connections, args=(connection, pool, count))
+    thread.setDaemon(True)
+    thread.start()
+    return thread
+
+def prewarm_connections_once(connection):
+    """
+    Pre-warms the connections of the database the first time this is called
+    for it in the process.
+    """
+    if connection.alias in _prewarmed_aliases:
+        return
+    _pools_lock.acquire()
+    try:
+        if connection.alias in _prewarmed_aliases:
+            return
+        _prewarmed_aliases.add(connection.alias)
+    finally:
+        _pools_lock.release()
+    prewarm_connections(connection)
@@ -13,7 +13,9 @@
 #   limitations under the License.
 
 import re
+import time
 from .utils import combine_rows
+from .vectorized import RowPage, can_filter_vectorized
 
 SECONDARY_INDEX_SUPPORT_ENABLED = True
 
@@ -170,10 +172,76 @@ class RangePredicate(object):
         value = row.get(self.column, None)
         return self._matches_value(value)
     
+    evaluation_cost = 1
+    
+    def get_value_matcher(self):
+        """
+        Returns a function that tests a single column value against the range.
+        The comparisons that are needed are worked out once here instead of
+        for every value.
+        """
+        start = self.start
+        end = self.end
+        if self._is_exact():
+            return lambda value: value == start
+        
+        if start != None:
+            if self.start_inclusive:
+                start_matches = lambda value: value >= start
+            else:
+                start_matches = lambda value: value > start
+        else:
+            start_matches = None
+        if end != None:
+            if self.end_inclusive:
+                end_matches = lambda value: value <= end
+            else:
+                end_matches = lambda value: value < end
+        else:
+            end_matches = None
+        
+        if start_matches and end_matches:
+            return lambda value: (value != None) and start_matches(value) and end_matches(value)
+        elif start_matches:
+            return lambda value: (value != None) and start_matches(value)
+        elif end_matches:
+            return lambda value: (value != None) and end_matches(value)
+        else:
+            return lambda value: value != None
+    
+    def get_row_matcher(self):
+        column = self.column
+        value_matches = self.get_value_matcher()
+        return lambda row: value_matches(row.get(column))
+    
+    def get_mask(self, page):
+        return page.get_range_mask(self.column, self.start, self.start_inclusive,
+            self.end, self.end_inclusive, self.get_value_matcher())
+    
     def get_matching_rows(self, query):
         rows = query.get_row_range(self)
         return rows
     
+    def get_matching_row_pages(self, query):
+        return query.get_row_range_pages(self)
+    
+# Rough relative costs of evaluating the different operations for a row.
+# These are only used to order the children of a compound predicate so that
+# the cheap tests are evaluated (and can short-circuit) before the expensive ones.
+_OPERATION_EVALUATION_COSTS = {
+    'isnull': 1,
+    'in': 2,
+    'endswith': 3,
+    'contains': 4,
+    'istartswith': 5,
+    'iendswith': 5,
+    'iexact': 5,
+    'icontains': 6,
+    'regex': 10,
+    'iregex': 10,
+}
+_MAX_OPERATION_EVALUATION_COST = 10
+
 class OperationPredicate(object):
     def __init__(self, column, op, value=None):
         self.column = column
@@ -215,6 +283,59 @@ class OperationPredicate(object):
         else:
             raise InvalidPredicateOpException()
     
+    @property
+    def evaluation_cost(self):
+        return _OPERATION_EVALUATION_COSTS.get(self.op, _MAX_OPERATION_EVALUATION_COST)
+    
+    def get_value_matcher(self):
+        """
+        Returns a function that tests a single column value with the operation.
+        The lowered/compiled forms of the predicate value are computed once here
+        instead of for every value.
+        """
+        op = self.op
+        value = self.value
+        if op == 'isnull':
+            return lambda row_value: row_value == None
+        # FIXME: Not sure if the following test is correct in all cases
+        if value == None:
+            return lambda row_value: False
+        if op == 'in':
+            try:
+                values = frozenset(value)
+            except TypeError:
+                values = value
+            return lambda row_value: (row_value != None) and (row_value in values)
+        elif op == 'istartswith':
+            value = value.lower()
+            return lambda row_value: (row_value != None) and row_value.lower().startswith(value)
+        elif op == 'endswith':
+            return lambda row_value: (row_value != None) and row_value.endswith(value)
+        elif op == 'iendswith':
+            value = value.lower()
+            return lambda row_value: (row_value != None) and row_value.lower().endswith(value)
+        elif op == 'iexact':
+            value = value.lower()
+            return lambda row_value: (row_value != None) and (row_value.lower() == value)
+        elif op == 'contains':
+            return lambda row_value: (row_value != None) and (value in row_value)
+        elif op == 'icontains':
+            value = value.lower()
+            return lambda row_value: (row_value != None) and (value in row_value.lower())
+        elif op == 'regex' or op == 'iregex':
+            match = self.pattern.match
+            return lambda row_value: (row_value != None) and (match(row_value) != None)
+        else:
+            raise InvalidPredicateOpException()
+    
+    def get_row_matcher(self):
+        column = self.column
+        value_matches = self.get_value_matcher()
+        return lambda row: value_matches(row.get(column))
+    
+    def get_mask(self, page):
+        return page.get_operation_mask(self.column, self.op, self.value, self.get_value_matcher())
+    
     def incorporate_range_op(self, column, op, value, parent_compound_op):
         return False
     
@@ -223,6 +344,9 @@ class OperationPredicate(object):
         # be evaluated efficiently, which is not the case for OperationPredicate's
         raise NotImplementedError('get_matching_rows() called for inefficient predicate')
     
+    def get_matching_row_pages(self, query):
+        raise NotImplementedError('get_matching_row_pages() called for inefficient predicate')
+    
 class CompoundPredicate(object):
     def __init__(self, op, negated=False, children=None):
         self.op = op
@@ -230,6 +354,7 @@ class CompoundPredicate(object):
         self.children = children
         if self.children == None:
             self.children = []
+        self._row_matcher = None
     
     def __repr__(self):
         s = '('
@@ -266,36 +391,77 @@ class CompoundPredicate(object):
         else:
             raise InvalidPredicateOpException()
 
-    def row_matches_subset(self, row, subset):
+    def row_matches(self, row):
+        return self.get_row_matcher()(row)
+    
+    @property
+    def evaluation_cost(self):
+        return sum([child.evaluation_cost for child in self.children])
+    
+    def get_row_matcher(self, subset=None):
+        """
+        Compiles the predicate (or the given subset of its children) into a
+        single function that tests a row. The children are ordered so that the
+        cheapest ones are evaluated first and the evaluation short-circuits
+        as soon as the result is known.
+        """
+        if subset is None:
+            if self._row_matcher is None:
+                self._row_matcher = self._compile_row_matcher(self.children)
+            return self._row_matcher
+        return self._compile_row_matcher(subset)
+        
+    def _compile_row_matcher(self, predicates):
+        predicates = sorted(predicates, key=lambda predicate: predicate.evaluation_cost)
+        matchers = tuple([predicate.get_row_matcher() for predicate in predicates])
+        
         if self.op == COMPOUND_OP_AND:
-            for predicate in subset:
-                if not predicate.row_matches(row):
-                    matches = False
-                    break
+            if len(matchers) == 1:
+                matches = matchers[0]
             else:
-                matches = True
+                def matches(row):
+                    for matcher in matchers:
+                        if not matcher(row):
+                            return False
+                    return True
         elif self.op == COMPOUND_OP_OR:
-            for predicate in subset:
-                if predicate.row_matches(row):
-                    matches =  True
-                    break
+            if len(matchers) == 1:
+                matches = matchers[0]
             else:
-                matches = False
+                def matches(row):
+                    for matcher in matchers:
+                        if matcher(row):
+                            return True
+                    return False
         else:
             raise InvalidPredicateOpException()
         
         if self.negated:
-            matches = not matches
-            
+            return lambda row: not matches(row)
         return matches
-        
-    def row_matches(self, row):
-        return self.row_matches_subset(row, self.children)
+    
+    def get_mask(self, page, subset=None):
+        predicates = self.children if subset is None else subset
+        masks = [predicate.get_mask(page) for predicate in predicates]
+        return page.combine_masks(masks, self.op == COMPOUND_OP_AND, self.negated)
+    
+    def filter_rows(self, rows, subset):
+        """
+        Returns the rows that match the given subset of the child predicates.
+        Big pages are filtered column-wise using vector masks; otherwise
+        the compiled row matcher is evaluated for each row.
+        """
+        if can_filter_vectorized(len(rows)):
+            page = RowPage(rows)
+            return page.select(self.get_mask(page, subset))
+        matches = self.get_row_matcher(subset)
+        return [row for row in rows if matches(row)]
     
     def incorporate_range_op(self, column, op, value, parent_predicate):
         return False
     
     def add_filter(self, column, op, value):
+        self._row_matcher = None
         if op in ('lt', 'lte', 'gt', 'gte', 'exact', 'startswith'):
             for child in self.children:
                 if child.incorporate_range_op(column, op, value, self.op):
@@ -310,10 +476,11 @@ class CompoundPredicate(object):
             self.children.append(child)
     
     def add_child(self, child_query_node):
+        self._row_matcher = None
         self.children.append(child_query_node)
     
     def get_matching_rows(self, query):
-        pk_column = query.query.get_meta().pk.column
+        pk_column = query.pk_column
         #indexed_columns = query.indexed_columns
         
         # In the first pass we handle the query nodes that can be processed
@@ -331,7 +498,10 @@ class CompoundPredicate(object):
                     if result == None:
                         result = rows
                     else:
+                        start_time = time.time()
+                        row_count = len(result) + len(rows)
                         result = combine_rows(result, rows, self.op, pk_column)
+                        query.record_stage('merge', start_time, row_count, len(result))
                 else:
                     inefficient_predicates.append(predicate)
         else:
@@ -343,7 +513,178 @@ class CompoundPredicate(object):
             
         # Now 
         if len(inefficient_predicates) > 0:
-            result = [row for row in result if self.row_matches_subset(row, inefficient_predicates)]
+            start_time = time.time()
+            row_count = len(result)
+            result = self.filter_rows(result, inefficient_predicates)
+            query.record_stage('filter', start_time, row_count, len(result))
             
         return result
 
+    def _get_driving_predicate(self, pk_column, indexed_columns):
+        # Pick the child predicate that's used to fetch the rows for an AND
+        # predicate. Lookups on the primary key are preferred over lookups
+        # using a secondary index, and exact matches over ranges.
+        driving_predicate = None
+        for predicate in self.children:
+            if predicate.can_evaluate_efficiently(pk_column, indexed_columns):
+                if isinstance(predicate, RangePredicate) and predicate.column == pk_column:
+                    if predicate._is_exact():
+                        return predicate
+                    if (driving_predicate is None) or (driving_predicate.column != pk_column):
+                        driving_predicate = predicate
+                elif driving_predicate is None:
+                    driving_predicate = predicate
+        return driving_predicate
+    
+    def get_matching_row_pages(self, query):
+        """
+        Generator version of get_matching_rows that yields the matching rows
+        a page at a time. For an AND predicate the rows are fetched using a
+        single efficient child predicate and the other children (efficient or
+        not) are evaluated over each page, so nothing needs to be combined in
+        memory. An OR of efficient predicates needs the union of the rows, so
+        that case still goes through get_matching_rows.
+        """
+        pk_column = query.pk_column
+        indexed_columns = query.indexed_columns
+        
+        if not self.can_evaluate_efficiently(pk_column, indexed_columns):
+            pages = query.get_all_row_pages()
+            filter_predicates = self.children
+        elif self.op == COMPOUND_OP_AND:
+            driving_predicate = self._get_driving_predicate(pk_column, indexed_columns)
+            pages = driving_predicate.get_matching_row_pages(query)
+            filter_predicates = [predicate for predicate in self.children
+                                 if predicate is not driving_predicate]
+        else:
+            pages = [self.get_matching_rows(query)]
+            filter_predicates = []
+        
+        for rows in pages:
+            if len(filter_predicates) > 0:
+                start_time = time.time()
+                row_count = len(rows)
+                rows = self.filter_rows(rows, filter_predicates)
+                query.record_stage('filter', start_time, row_count, len(rows))
+            if rows:
+                yield rows
+
+def get_exact_key_values(predicate, pk_column):
+    """
+    Returns the list of the primary key values if the predicate only matches
+    the rows with those keys (e.g. pk=x, pk__in=[...] or an OR of exact pk
+    lookups) and doesn't test anything else, or None otherwise.
+    """
+    if isinstance(predicate, RangePredicate):
+        if (predicate.column == pk_column) and predicate._is_exact():
+            return [predicate.start]
+    elif isinstance(predicate, OperationPredicate):
+        if (predicate.column == pk_column) and (predicate.op == 'in'):
+            return list(predicate.value)
+    elif isinstance(predicate, CompoundPredicate) and not predicate.negated:
+        if len(predicate.children) == 1:
+            return get_exact_key_values(predicate.children[0], pk_column)
+        if predicate.op == COMPOUND_OP_OR:
+            key_values = []
+            for child in predicate.children:
+                child_key_values = get_exact_key_values(child, pk_column)
+                if child_key_values is None:
+                    return None
+                key_values.extend(child_key_values)
+            return key_values
+    return None
+
+# Greater than any byte of a UTF-8 encoded key, so a key range that ends with
+# a prefix followed by this includes all of the keys with that prefix
+_KEY_RANGE_HIGH = '\xff'
+
+def get_compound_key_range(predicate, pk_column, key_columns, separator,
+                           string_columns=None):
+    """
+    Returns a RangePredicate on the primary key that covers all of the rows
+    that match an AND predicate with exact lookups on a leading prefix of the
+    columns of a compound key, optionally followed by a range on the next
+    column (e.g. name='x' and slug__gte='m' for the key fields (name, slug)),
+    or None if the predicate has no such lookups. The range may include rows
+    that don't match, so the lookups are still evaluated for each row.
+    
+    string_columns is the list of the key columns that hold strings (all of
+    them if it's None). The stored values of the other columns don't sort
+    in the order of their values (e.g. '10' sorts before '6'), so a range on
+    one of them only narrows the key range to the exact prefix.
+    """
+    ranges = {}
+    for child in predicate.children:
+        if isinstance(child, RangePredicate):
+            ranges[child.column] = child
+    prefix = []
+    for column in key_columns:
+        child = ranges.get(column)
+        if (child is None) or not child._is_exact():
+            break
+        prefix.append(child.start)
+    
+    if len(prefix) == len(key_columns):
+        key = separator.join(prefix)
+        return RangePredicate(pk_column, key, True, key, True)
+    
+    next_column = key_columns[len(prefix)]
+    next_range = ranges.get(next_column)
+    if (string_columns is not None) and (next_column not in string_columns):
+        next_range = None
+    if not prefix and next_range is None:
+        return None
+    prefix_key = ''.join([value + separator for value in prefix])
+    start = end = None
+    if next_range is not None:
+        if next_range.start is not None:
+            start = prefix_key + next_range.start
+        if next_range.end is not None:
+            if len(prefix) + 1 == len(key_columns):
+                end = prefix_key + next_range.end
+            else:
+                # The next column is followed by the separator, so a value
+                # that's a prefix of the end value can sort after it
+                end_value = next_range.end
+                end = max([prefix_key + end_value[:i] + separator + _KEY_RANGE_HIGH
+                           for i in range(len(end_value) + 1)])
+    if (start is None) and prefix_key:
+        start = prefix_key
+    if (end is None) and prefix_key:
+        end = prefix_key + _KEY_RANGE_HIGH
+    if (start is None) and (end is None):
+        return None
+    return RangePredicate(pk_column, start, True, end, True)
+
+def add_compound_key_ranges(predicate, pk_column, key_columns, separator,
+                            string_columns=None):
+    """
+    Adds the primary key range that's implied by the lookups on the fields
+    of a compound key to each AND predicate in the predicate tree that doesn't
+    already look up the primary key, so that the rows can be fetched with a
+    key range slice instead of a scan of all of the rows.
+    """
+    if not isinstance(predicate, CompoundPredicate) or predicate.negated:
+        return
+    for child in predicate.children:
+        add_compound_key_ranges(child, pk_column, key_columns, separator, string_columns)
+    if predicate.op != COMPOUND_OP_AND:
+        return
+    for child in predicate.children:
+        if isinstance(child, RangePredicate) and (child.column == pk_column):
+            return
+    key_range = get_compound_key_range(predicate, pk_column, key_columns, separator,
+                                       string_columns)
+    if key_range is not None:
+        predicate.add_child(key_range)
+
+def get_predicate_columns(predicate):
+    """
+    Returns the set of the columns that the predicate tests.
+    """
+    if isinstance(predicate, CompoundPredicate):
+        columns = set()
+        for child in predicate.children:
+            columns.update(get_predicate_columns(child))
+        return columns
+    return set([predicate.column])
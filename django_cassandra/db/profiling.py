@@ -0,0 +1,150 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('django_cassandra.profiling')
+
+# The stages of the evaluation of a query, in pipeline order:
+# - fetch: the Thrift calls plus converting the returned columns to rows
+# - merge: combining the rows of the efficient children of an OR predicate
+# - filter: evaluating the predicates that couldn't be done by Cassandra
+# - aggregate: computing the aggregates of aggregate() and annotate() queries
+# - sort: sorting the rows for order_by
+# - convert: converting the rows to the field values of the results
+PROFILE_STAGES = ('fetch', 'merge', 'filter', 'aggregate', 'sort', 'convert')
+
+DEFAULT_PROFILE_THRESHOLD = 1.0
+
+class StageProfile(object):
+
+    __slots__ = ('time', 'calls', 'rows_in', 'rows_out')
+
+    def __init__(self):
+        self.time = 0.0
+        self.calls = 0
+        self.rows_in = 0
+        self.rows_out = 0
+
+class QueryProfile(object):
+    """
+    Time spent in (and number of rows going in and out of) each stage of the
+    evaluation of a query.
+    """
+
+    def __init__(self, description, threshold=None):
+        self.description = description
+        self.threshold = threshold
+        self.start_time = time.time()
+        self.elapsed_time = None
+        self.stages = dict((stage, StageProfile()) for stage in PROFILE_STAGES)
+
+    def record(self, stage, duration, rows_in, rows_out):
+        stage_profile = self.stages[stage]
+        stage_profile.time += duration
+        stage_profile.calls += 1
+        stage_profile.rows_in += rows_in
+        stage_profile.rows_out += rows_out
+
+    def finish(self):
+        if self.elapsed_time is None:
+            self.elapsed_time = time.time() - self.start_time
+
+    @property
+    def total_time(self):
+        return sum([stage_profile.time for stage_profile in self.stages.itervalues()])
+
+    def as_dict(self):
+        stages = {}
+        for stage, stage_profile in self.stages.iteritems():
+            stages[stage] = {'time': stage_profile.time, 'calls': stage_profile.calls,
+                             'rows_in': stage_profile.rows_in, 'rows_out': stage_profile.rows_out}
+        return {'query': self.description, 'elapsed_time': self.elapsed_time,
+                'total_time': self.total_time, 'stages': stages}
+
+    def format_report(self):
+        lines = ['%s: %.3fs in backend stages, %.3fs elapsed' %
+                 (self.description, self.total_time, self.elapsed_time or 0.0)]
+        for stage in PROFILE_STAGES:
+            stage_profile = self.stages[stage]
+            if stage_profile.calls:
+                lines.append('  %-9s %8.3fs %6d calls %9d rows in %9d rows out' %
+                             (stage, stage_profile.time, stage_profile.calls,
+                              stage_profile.rows_in, stage_profile.rows_out))
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.format_report()
+
+_local = threading.local()
+
+def _get_collectors():
+    collectors = getattr(_local, 'collectors', None)
+    if collectors is None:
+        collectors = _local.collectors = []
+    return collectors
+
+@contextmanager
+def profile_queries(threshold=None):
+    """
+    Profiles the queries that are evaluated in the current thread inside the
+    with block, whether or not profiling is enabled in the database settings.
+    The list of the QueryProfile objects of the queries is the value of the
+    with statement; the queries that take longer than the threshold (in
+    seconds) are also logged.
+    """
+    collector = ([], threshold)
+    collectors = _get_collectors()
+    collectors.append(collector)
+    try:
+        yield collector[0]
+    finally:
+        collectors.remove(collector)
+
+def start_query_profile(connection, query):
+    """
+    Returns a new QueryProfile for the query if profiling is enabled, either
+    by CASSANDRA_PROFILE_QUERIES in the database settings or by an enclosing
+    profile_queries block, or None if it isn't.
+    """
+    collectors = _get_collectors()
+    if collectors:
+        threshold = collectors[-1][1]
+    elif connection.settings_dict.get('CASSANDRA_PROFILE_QUERIES', False):
+        threshold = None
+    else:
+        return None
+
+    if threshold is None:
+        threshold = connection.settings_dict.get('CASSANDRA_PROFILE_THRESHOLD',
+                                                 DEFAULT_PROFILE_THRESHOLD)
+    opts = query.get_meta()
+    description = '%s.%s (%s)' % (opts.app_label, opts.object_name, opts.db_table)
+    profile = QueryProfile(description, threshold)
+    # Keep the report with the query so that it can be looked at after the
+    # queryset has been evaluated
+    query.cassandra_profile = profile
+    return profile
+
+def finish_query_profile(profile):
+    if (profile is None) or (profile.elapsed_time is not None):
+        return
+    profile.finish()
+    for collector in _get_collectors():
+        collector[0].append(profile)
+    if (profile.threshold is not None) and (profile.elapsed_time >= profile.threshold):
+        logger.warning('Slow Cassandra query: %s', profile.format_report())
@@ -0,0 +1,215 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+How the rows of a model are laid out in its column family. There are two
+storage formats, which are set with the STORAGE_FORMAT setting in the
+CassandraSettings of the model (or CASSANDRA_STORAGE_FORMAT in the database
+settings):
+- 'standard' (the default): every field is stored as a column, including the
+  primary key (which is also the row key) and the fields that are None.
+- 'compact': the primary key is only stored as the row key, and fields that
+  are None aren't stored at all (a missing column is read as None). The key
+  is still stored as a column if it has a secondary index, or if the row
+  wouldn't have any other columns (an empty row is a deleted row).
+Independently of the format, the COLUMN_NAMES setting maps field names to
+the (shorter) names of the columns they're stored in. The primary key column
+can't be renamed.
+
+Existing rows aren't converted when the settings change; they're rewritten
+in the new format with the cassandra_rewrite_storage management command.
+"""
+
+from django.db.utils import DatabaseError
+from cassandra import Cassandra
+from cassandra.ttypes import *
+
+from .utils import call_cassandra_with_reconnect, get_cassandra_setting, get_next_timestamp, \
+    is_wide_row_model
+from ..fields import is_counter_model
+
+STORAGE_FORMATS = ('standard', 'compact')
+
+class StorageFormat(object):
+
+    def __init__(self, model, format_name='standard', column_names=None):
+        if format_name not in STORAGE_FORMATS:
+            raise DatabaseError('Invalid storage format for %s: %s' %
+                                (model._meta.object_name, format_name))
+        opts = model._meta
+        self.format_name = format_name
+        self.pk_column = opts.pk.column
+
+        # Maps the field columns to the storage columns, and back
+        self.storage_columns = {}
+        self.field_columns = {}
+        fields = dict((field.name, field) for field in opts.local_fields)
+        for field_name, storage_column in (column_names or {}).items():
+            field = fields.get(field_name)
+            if field is None:
+                raise DatabaseError('COLUMN_NAMES of %s refers to an unknown field: %s' %
+                                    (opts.object_name, field_name))
+            if field.primary_key:
+                raise DatabaseError("The primary key column of %s can't be renamed" %
+                                    opts.object_name)
+            self.storage_columns[field.column] = str(storage_column)
+        names = [self.get_storage_column(field.column) for field in opts.local_fields]
+        if len(set(names)) != len(names):
+            raise DatabaseError('COLUMN_NAMES of %s maps several fields to the same column' %
+                                opts.object_name)
+        for field_column, storage_column in self.storage_columns.items():
+            self.field_columns[storage_column] = field_column
+
+        compact = format_name == 'compact'
+        # The key of a counter column family is never stored as a column
+        # (all of its columns have to be counters), and the key of a wide row
+        # model is derived from the row key and the column names.
+        if is_counter_model(model) or is_wide_row_model(model):
+            self.stores_pk_column = False
+        else:
+            self.stores_pk_column = (not compact) or opts.pk.db_index or \
+                (len(opts.local_fields) == 1)
+        # Every instance in a wide row has the same columns
+        self.stores_none_values = (not compact) or is_wide_row_model(model)
+
+    def get_storage_column(self, column):
+        """
+        Returns the name of the column that stores the field column.
+        """
+        return self.storage_columns.get(column, column)
+
+    def get_field_column(self, storage_column):
+        """
+        Returns the name of the field column that's stored in the column.
+        """
+        return self.field_columns.get(storage_column, storage_column)
+
+_storage_formats = {}
+
+def get_storage_format(connection, model):
+    """
+    Returns the storage format of the model in the database.
+    """
+    key = (connection.alias, model)
+    storage_format = _storage_formats.get(key)
+    if storage_format is None:
+        format_name = get_cassandra_setting(model, 'STORAGE_FORMAT',
+            connection.settings_dict.get('CASSANDRA_STORAGE_FORMAT', 'standard'))
+        column_names = get_cassandra_setting(model, 'COLUMN_NAMES')
+        storage_format = _storage_formats[key] = StorageFormat(model, format_name, column_names)
+    return storage_format
+
+def get_rewrite_mutations(storage_format, field_columns, key, columns, none_value):
+    """
+    Returns the mutations that convert the columns of a row (which may have
+    been written with any storage format and with or without the column name
+    mapping) to the current storage format of the model, or an empty list if
+    the row is already in that format. Columns that don't belong to a field
+    are left alone.
+    """
+    pk_column = storage_format.pk_column
+    # The newest value of each field (a field can be stored under both of its
+    # names if it was written after the column names were changed)
+    field_values = {}
+    existing_columns = {}
+    for column in columns:
+        field_column = storage_format.get_field_column(column.name)
+        if field_column not in field_columns:
+            continue
+        existing_columns[column.name] = column
+        current = field_values.get(field_column)
+        if (current is None) or (column.timestamp > current.timestamp):
+            field_values[field_column] = column
+
+    target_columns = {}
+    for field_column, column in field_values.items():
+        if field_column == pk_column:
+            continue
+        if (column.value == none_value) and not storage_format.stores_none_values:
+            continue
+        target_columns[storage_format.get_storage_column(field_column)] = column
+    if storage_format.stores_pk_column or not target_columns:
+        target_columns[pk_column] = existing_columns.get(pk_column) or \
+            Column(name=pk_column, value=key, timestamp=get_next_timestamp())
+
+    # The columns are rewritten with a timestamp just after the one of the
+    # value they're copied from, and the old columns are deleted with their
+    # own timestamp, so any value written concurrently by the application
+    # takes precedence.
+    mutation_list = []
+    for name, column in target_columns.items():
+        existing_column = existing_columns.get(name)
+        if (existing_column is not None) and (existing_column.value == column.value):
+            continue
+        timestamp = column.timestamp + 1 if column.name != name else column.timestamp
+        column = Column(name=name, value=column.value, timestamp=timestamp, ttl=column.ttl)
+        mutation_list.append(Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=column)))
+    for name, column in existing_columns.items():
+        if name not in target_columns:
+            mutation_list.append(Mutation(deletion=Deletion(timestamp=column.timestamp,
+                predicate=SlicePredicate(column_names=[name]))))
+    return mutation_list
+
+def rewrite_rows(connection, model, dry_run=False):
+    """
+    Rewrites the rows of the model that aren't stored in its current storage
+    format, a page of rows (and a single batch_mutate call) at a time. Returns
+    a tuple of the number of rows and the number of rows that were (or, for
+    a dry run, would be) rewritten.
+    """
+    from .compiler import SQLCompiler
+
+    if is_counter_model(model):
+        raise DatabaseError("The rows of %s can't be rewritten, because it's stored "
+                            "in a counter column family" % model._meta.object_name)
+    if is_wide_row_model(model):
+        raise DatabaseError("The rows of %s can't be rewritten, because it's stored "
+                            "in wide rows" % model._meta.object_name)
+    storage_format = get_storage_format(connection, model)
+    field_columns = set(field.column for field in model._meta.local_fields)
+    column_family = model._meta.db_table
+    db_connection = connection.db_connection
+
+    column_parent = ColumnParent(column_family=column_family)
+    slice_predicate = SlicePredicate(slice_range=SliceRange(start='', finish='',
+                                                            count=connection.max_column_count))
+    page_size = connection.fetch_page_size
+    row_count = rewritten_count = 0
+    start_key = ''
+    skip_key = None
+    while True:
+        key_range = KeyRange(start_key=start_key, end_key='', count=page_size)
+        key_slice = call_cassandra_with_reconnect(db_connection,
+            Cassandra.Client.get_range_slices, column_parent, slice_predicate,
+            key_range, connection.read_consistency_level)
+        mutation_map = {}
+        for element in key_slice:
+            # Consecutive pages overlap by one row, and deleted rows are
+            # returned without any columns
+            if (element.key == skip_key) or not element.columns:
+                continue
+            row_count += 1
+            columns = [column.column for column in element.columns]
+            mutation_list = get_rewrite_mutations(storage_format, field_columns,
+                element.key, columns, SQLCompiler.SPECIAL_NONE_VALUE)
+            if mutation_list:
+                mutation_map[element.key] = {column_family: mutation_list}
+        rewritten_count += len(mutation_map)
+        if mutation_map and not dry_run:
+            call_cassandra_with_reconnect(db_connection, Cassandra.Client.batch_mutate,
+                mutation_map, connection.write_consistency_level)
+        if len(key_slice) < page_size:
+            break
+        start_key = skip_key = key_slice[-1].key
+    return row_count, rewritten_count
@@ -0,0 +1,103 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Dirty field tracking, which is enabled with the DIRTY_FIELD_TRACKING setting
+in the CassandraSettings of the model (or CASSANDRA_DIRTY_FIELD_TRACKING in
+the database settings). With django-nonrel every save() of a model instance
+is an insert of all of its fields; when tracking is enabled the insert only
+writes the columns whose values differ from the ones the instance was loaded
+with (or last saved with). The values are kept in the format they're stored
+in, so changes made in place (e.g. to a list) are detected too.
+
+The model instance isn't available to the compilers, so the values are handed
+over through the current thread: the compiler records the values of each row
+it converts, and the post_init signal (which Django sends right after the
+compiler returns the row) attaches them to the instance that's constructed
+from it. The pre_save signal makes the instance that's being saved available
+to the insert compiler in the same way.
+"""
+
+import threading
+
+from django.db.models.signals import post_init, pre_save, post_save
+from django.utils.encoding import smart_str
+
+from .utils import get_cassandra_setting, is_wide_row_model
+from ..fields import is_counter_model
+
+LOADED_VALUES_ATTRIBUTE = '_cassandra_loaded_values'
+
+_local = threading.local()
+
+def is_tracking_enabled(connection, model):
+    """
+    Returns True if the changes of the instances of the model are tracked.
+    Counter models are never tracked, since saving them adds to the counters,
+    and neither are wide row models, which always write all of the columns of
+    an instance.
+    """
+    default = connection.settings_dict.get('CASSANDRA_DIRTY_FIELD_TRACKING', False)
+    return bool(get_cassandra_setting(model, 'DIRTY_FIELD_TRACKING', default)) and \
+        not is_counter_model(model) and not is_wide_row_model(model)
+
+def record_loaded_row(model, key, values):
+    """
+    Records the stored values (a dictionary of the field columns) of the row
+    that the next instance of the model is constructed from.
+    """
+    _local.loaded_row = (model, key, values)
+
+def get_loaded_values(instance):
+    """
+    Returns the stored values the instance was loaded or last saved with, or
+    None if they're not tracked.
+    """
+    return instance.__dict__.get(LOADED_VALUES_ATTRIBUTE)
+
+def set_loaded_values(instance, values):
+    instance.__dict__[LOADED_VALUES_ATTRIBUTE] = values
+
+def get_saved_instance(model, key):
+    """
+    Returns the instance whose save() is inserting the row with the key, or
+    None if it's not known.
+    """
+    instance = getattr(_local, 'saved_instance', None)
+    if (instance is None) or not isinstance(instance, model):
+        return None
+    if (instance.pk is not None) and (smart_str(instance.pk) != key):
+        return None
+    return instance
+
+def _attach_loaded_values(sender, instance, **kwargs):
+    loaded_row = getattr(_local, 'loaded_row', None)
+    if loaded_row is None:
+        return
+    _local.loaded_row = None
+    model, key, values = loaded_row
+    # The key is checked in case the row wasn't used to construct an
+    # instance (e.g. the iteration was abandoned)
+    if isinstance(instance, model) and (smart_str(instance.pk) == key):
+        set_loaded_values(instance, values)
+
+def _set_saved_instance(sender, instance, **kwargs):
+    _local.saved_instance = instance
+
+def _clear_saved_instance(sender, instance, **kwargs):
+    _local.saved_instance = None
+
+post_init.connect(_attach_loaded_values)
+pre_save.connect(_set_saved_instance)
+post_save.connect(_clear_saved_instance)
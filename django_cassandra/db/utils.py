@@ -12,6 +12,8 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import logging
+import socket
 import time
 from thrift import Thrift
 from thrift.transport import TTransport
@@ -21,43 +23,106 @@ from cassandra import Cassandra
 #from cassandra.ttypes import *
 from django.db.utils import DatabaseError
 
-def _cmp_to_key(comparison_function):
+logger = logging.getLogger('django_cassandra')
+
+class ColumnTable(object):
     """
-    Convert a cmp= function into a key= function.
-    This is built in to Python 2.7, but we define it ourselves
-    to work with older versions of Python
+    Table of the column names that occur in the rows fetched by a query.
+    It's shared by all of the rows of the query, so each row only needs to
+    store its column values positionally instead of in its own dict.
     """
-    class K(object):
-        def __init__(self, obj, *args):
-            self.obj = obj
-        def __lt__(self, other):
-            return comparison_function(self.obj, other.obj) < 0
-        def __gt__(self, other):
-            return comparison_function(self.obj, other.obj) > 0
-        def __eq__(self, other):
-            return comparison_function(self.obj, other.obj) == 0
-        def __le__(self, other):
-            return comparison_function(self.obj, other.obj) <= 0
-        def __ge__(self, other):
-            return comparison_function(self.obj, other.obj) >= 0
-        def __ne__(self, other):
-            return comparison_function(self.obj, other.obj) != 0
-    return K
-
-def _compare_rows(row1, row2, sort_spec_list):
-    for sort_spec in sort_spec_list:
-        column_name = sort_spec[0]
-        reverse = sort_spec[1] if len(sort_spec) > 1 else False
-        row1_value = row1.get(column_name, None)
-        row2_value = row2.get(column_name, None)
-        result = cmp(row1_value, row2_value)
-        if result != 0:
-            if reverse:
-                result = -result
-            break;
-    else:
-        result = 0
-    return result
+    
+    __slots__ = ('names', 'indexes')
+    
+    def __init__(self):
+        self.names = []
+        self.indexes = {}
+        
+    def get_index(self, name):
+        index = self.indexes.get(name)
+        if index is None:
+            index = len(self.names)
+            self.names.append(name)
+            self.indexes[name] = index
+        return index
+
+
+class CompactRow(object):
+    """
+    Compact representation of a row fetched from Cassandra. The values are
+    stored in a tuple that's indexed by the column table of the query. It
+    supports the subset of the dict interface that's used for rows by the
+    rest of the backend. A missing column is represented by a value of None.
+    """
+    
+    __slots__ = ('column_table', 'values')
+    
+    def __init__(self, column_table, values):
+        self.column_table = column_table
+        self.values = values
+    
+    def get(self, name, default=None):
+        index = self.column_table.indexes.get(name)
+        if (index is None) or (index >= len(self.values)):
+            return default
+        value = self.values[index]
+        return default if value is None else value
+    
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+    
+    def __setitem__(self, name, value):
+        index = self.column_table.get_index(name)
+        values = list(self.values)
+        if index >= len(values):
+            values.extend([None] * (index + 1 - len(values)))
+        values[index] = value
+        self.values = tuple(values)
+    
+    def __contains__(self, name):
+        return self.get(name) is not None
+    
+    def iteritems(self):
+        for name, value in zip(self.column_table.names, self.values):
+            if value is not None:
+                yield name, value
+    
+    def items(self):
+        return list(self.iteritems())
+    
+    def keys(self):
+        return [name for name, value in self.iteritems()]
+    
+    def __len__(self):
+        return len(self.keys())
+    
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+
+def convert_column_list_to_row(column_table, column_list, key_column=None, key=None):
+    """
+    Converts the list of ColumnOrSuperColumn objects returned by the Thrift
+    API for a row into a CompactRow that uses the given column table. If
+    key_column is given, the row key is set as the value of that column
+    (for rows that don't store their key as a column).
+    """
+    values = [None] * len(column_table.names)
+    for column in column_list:
+        column = column.column or column.counter_column
+        index = column_table.get_index(column.name)
+        if index >= len(values):
+            values.extend([None] * (index + 1 - len(values)))
+        values[index] = column.value
+    if key_column is not None:
+        index = column_table.get_index(key_column)
+        if index >= len(values):
+            values.extend([None] * (index + 1 - len(values)))
+        values[index] = key
+    return CompactRow(column_table, tuple(values))
 
 def sort_rows(rows, sort_spec):
     if sort_spec == None:
@@ -75,7 +140,53 @@ def sort_rows(rows, sort_spec):
     else:
         sort_spec_list = (sort_spec,)
     
-    rows.sort(key=_cmp_to_key(lambda row1, row2: _compare_rows(row1, row2, sort_spec_list)))
+    # Python's sort is stable, so sorting on each of the columns in turn,
+    # starting with the least significant one, gives the same result as a
+    # single sort that compares all of the columns, but without the overhead
+    # of calling a comparison function for every pair of rows.
+    for sort_spec in reversed(sort_spec_list):
+        column_name = sort_spec[0]
+        reverse = sort_spec[1] if len(sort_spec) > 1 else False
+        rows.sort(key=lambda row: row.get(column_name, None), reverse=reverse)
+
+def get_cassandra_setting(model, name, default=None):
+    """
+    Returns the value of a setting defined in the CassandraSettings class
+    nested in the model, or the default value if the model doesn't define it.
+    """
+    cassandra_settings = getattr(model, 'CassandraSettings', None)
+    return getattr(cassandra_settings, name, default)
+
+def is_wide_row_model(model):
+    """
+    Returns True if the instances of the model are stored in wide rows (see
+    widerow.py).
+    """
+    return get_cassandra_setting(model, 'PARTITION_KEY_FIELD') is not None
+
+def get_cassandra_hosts(settings_dict):
+    """
+    Returns the list of the (host, port) tuples of the Cassandra nodes that
+    are configured in the database settings. HOST can be a single host or a
+    comma-separated list of hosts, each of which can specify its own port
+    (e.g. "node1:9160,node2:9161"). PORT is the port of the hosts that don't.
+    """
+    default_port = settings_dict.get('PORT') or 9160
+    host_list = settings_dict.get('HOST') or 'localhost'
+    if isinstance(host_list, basestring):
+        host_list = host_list.split(',')
+    hosts = []
+    for host in host_list:
+        host = host.strip()
+        if not host:
+            continue
+        port = default_port
+        if ':' in host:
+            host, port = host.rsplit(':', 1)
+        hosts.append((host, int(port)))
+    if not hosts:
+        hosts.append(('localhost', int(default_port)))
+    return hosts
 
 COMBINE_INTERSECTION = 1
 COMBINE_UNION = 2
@@ -184,16 +295,21 @@ def convert_list_to_string(l):
 
 
 class CassandraConnection(object):
-    def __init__(self, host, port, keyspace, user, password):
+    def __init__(self, host, port, keyspace, user, password, timeout=None):
         self.host = host
         self.port = port
         self.keyspace = keyspace
         self.user = user
         self.password = password
+        # Socket timeout in seconds (None means no timeout)
+        self.timeout = timeout
+        self.socket = None
         self.transport = None
         self.client = None
         self.keyspace_set = False
         self.logged_in = False
+        # Set by the DatabaseWrapper to record the calls made with this connection
+        self.instrumentation = None
         
     def commit(self):
         pass
@@ -234,10 +350,13 @@ class CassandraConnection(object):
     def open(self, set_keyspace=False, login=False):
         if self.transport == None:
             # Create the client connection to the Cassandra daemon
-            socket = TSocket.TSocket(self.host, int(self.port))
-            transport = TTransport.TFramedTransport(TTransport.TBufferedTransport(socket))
+            thrift_socket = TSocket.TSocket(self.host, int(self.port))
+            if self.timeout is not None:
+                thrift_socket.setTimeout(self.timeout * 1000.0)
+            transport = TTransport.TFramedTransport(TTransport.TBufferedTransport(thrift_socket))
             protocol = TBinaryProtocol.TBinaryProtocolAccelerated(transport)
             transport.open()
+            self.socket = thrift_socket
             self.transport = transport
             self.client = Cassandra.Client(protocol)
             
@@ -253,11 +372,18 @@ class CassandraConnection(object):
                 self.transport.close()
             except Exception, e:
                 pass
+            self.socket = None
             self.transport = None
             self.client = None
             self.keyspace_set = False
             self.logged_in = False
             
+    def set_timeout(self, timeout):
+        if timeout != self.timeout:
+            self.timeout = timeout
+            if self.socket is not None:
+                self.socket.setTimeout(timeout * 1000.0 if timeout is not None else None)
+    
     def is_connected(self):
         return self.transport != None
     
@@ -287,13 +413,29 @@ class CassandraAccessError(DatabaseError):
         super(CassandraAccessError,self).__init__(msg)
 
 
-def call_cassandra_with_reconnect(connection, fn, *args, **kwargs):
+class CassandraTimeoutError(CassandraAccessError):
+    def __init__(self, message=None):
+        msg = 'Timed out waiting for Cassandra'
+        if message:
+            msg += '; ' + str(message)
+        DatabaseError.__init__(self, msg)
+
+
+def _call_cassandra(connection, fn, args, kwargs, reconnect, call_state):
     try:
         try:
             results = fn(connection.get_client(), *args, **kwargs)
         except TTransport.TTransportException:
+            if not reconnect:
+                raise
             connection.reopen()
+            call_state['reconnects'] += 1
             results = fn(connection.get_client(), *args, **kwargs)
+    except socket.timeout, e:
+        # The response may still arrive later, so the connection can't be
+        # used for any other calls.
+        connection.close()
+        raise CassandraTimeoutError(e)
     except TTransport.TTransportException, e:
         raise CassandraConnectionError(e)
     except Exception, e:
@@ -301,4 +443,59 @@ def call_cassandra_with_reconnect(connection, fn, *args, **kwargs):
 
     return results
 
+def record_cassandra_call(instrumentation, fn, args, results, duration, reconnects, error):
+    """
+    Records a call with the instrumentation. An error raised by a receiver of
+    the cassandra_call_completed signal or by the metrics sink is logged
+    rather than raised, so that the caller always gets the results or the
+    error of the call itself.
+    """
+    try:
+        instrumentation.record_call(fn, args, results, duration, reconnects, error)
+    except Exception:
+        logger.exception('Error recording the Cassandra call %s', fn.__name__)
+
+def _call_cassandra_instrumented(connection, fn, args, kwargs, reconnect):
+    call_state = {'reconnects': 0}
+    instrumentation = connection.instrumentation
+    if (instrumentation is None) or not instrumentation.is_active():
+        return _call_cassandra(connection, fn, args, kwargs, reconnect, call_state)
+    
+    results = error = None
+    start_time = time.time()
+    try:
+        results = _call_cassandra(connection, fn, args, kwargs, reconnect, call_state)
+        return results
+    except Exception, e:
+        error = e
+        raise
+    finally:
+        record_cassandra_call(instrumentation, fn, args, results, time.time() - start_time,
+                              call_state['reconnects'], error)
+
+def call_cassandra_with_reconnect(connection, fn, *args, **kwargs):
+    return _call_cassandra_instrumented(connection, fn, args, kwargs, True)
 
+def call_cassandra_with_timeout(connection, timeout, fn, *args, **kwargs):
+    """
+    Version of call_cassandra_with_reconnect that waits at most timeout seconds
+    for the results of the call (or as long as it takes if it's None). The
+    previous timeout of the connection is restored after the call.
+    """
+    previous_timeout = connection.timeout
+    if timeout == previous_timeout:
+        return _call_cassandra_instrumented(connection, fn, args, kwargs, True)
+    connection.set_timeout(timeout)
+    try:
+        return _call_cassandra_instrumented(connection, fn, args, kwargs, True)
+    finally:
+        connection.set_timeout(previous_timeout)
+
+def call_cassandra(connection, fn, *args, **kwargs):
+    """
+    Version of call_cassandra_with_reconnect that doesn't try to reopen the
+    connection if it fails. This is used for the calls that are made while
+    the connection is being configured, where reopening the connection (which
+    also logs in and sets the keyspace) isn't possible yet.
+    """
+    return _call_cassandra_instrumented(connection, fn, args, kwargs, False)
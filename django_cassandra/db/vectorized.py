@@ -0,0 +1,152 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from itertools import imap
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Pages of rows are filtered column-wise with NumPy masks when NumPy is
+# installed and the page is big enough for the array setup to pay off.
+# Otherwise the rows are filtered one at a time with the compiled row
+# matcher of the predicate.
+VECTORIZED_FILTERING_ENABLED = True
+MIN_VECTORIZED_ROW_COUNT = 256
+
+def can_filter_vectorized(row_count):
+    return (numpy is not None) and VECTORIZED_FILTERING_ENABLED and \
+        (row_count >= MIN_VECTORIZED_ROW_COUNT)
+
+class RowPage(object):
+    """
+    Columnar view of a page of rows used to evaluate predicates as boolean
+    masks. Each column that's referenced by a predicate is extracted from the
+    rows once and converted to a NumPy string array (plus a mask of the rows
+    where the column is present) the first time it's needed.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.row_count = len(rows)
+        self._values = {}
+        self._arrays = {}
+        self._lowered_arrays = {}
+
+    def get_values(self, column):
+        values = self._values.get(column)
+        if values is None:
+            values = [row.get(column) for row in self.rows]
+            self._values[column] = values
+        return values
+
+    def _get_array(self, column):
+        """
+        Returns a (array, present_mask) tuple for the column, or None if the
+        values can't be represented exactly as a NumPy byte string array
+        (e.g. they aren't all byte strings, or some of them end in NUL
+        characters, which NumPy strips).
+        """
+        if column in self._arrays:
+            return self._arrays[column]
+
+        values = self.get_values(column)
+        present = numpy.fromiter((value is not None for value in values), bool, self.row_count)
+        filled_values = [value if value is not None else '' for value in values]
+        result = None
+        try:
+            array = numpy.array(filled_values)
+            if array.dtype.kind == 'S':
+                lengths = numpy.fromiter(imap(len, filled_values), int, self.row_count)
+                if (numpy.char.str_len(array) == lengths).all():
+                    result = (array, present)
+        except Exception:
+            pass
+        self._arrays[column] = result
+        return result
+
+    def _get_lowered_array(self, column):
+        lowered_array = self._lowered_arrays.get(column)
+        if lowered_array is None:
+            array, present = self._get_array(column)
+            lowered_array = numpy.char.lower(array)
+            self._lowered_arrays[column] = lowered_array
+        return lowered_array
+
+    def get_value_mask(self, column, value_matches):
+        values = self.get_values(column)
+        return numpy.fromiter(imap(value_matches, values), bool, self.row_count)
+
+    def get_range_mask(self, column, start, start_inclusive, end, end_inclusive, value_matches):
+        column_array = self._get_array(column)
+        if (column_array is None) or \
+            ((start is not None) and (type(start) is not str)) or \
+            ((end is not None) and (type(end) is not str)):
+            return self.get_value_mask(column, value_matches)
+
+        array, mask = column_array
+        mask = mask.copy()
+        if start is not None:
+            mask &= (array >= start) if start_inclusive else (array > start)
+        if end is not None:
+            mask &= (array <= end) if end_inclusive else (array < end)
+        return mask
+
+    def get_operation_mask(self, column, op, value, value_matches):
+        column_array = self._get_array(column)
+        if column_array is None:
+            return self.get_value_mask(column, value_matches)
+        array, present = column_array
+
+        if op == 'isnull':
+            return ~present
+        if value is None:
+            return numpy.zeros(self.row_count, bool)
+
+        if op == 'in':
+            if (type(value) in (list, tuple)) and all([type(item) is str for item in value]):
+                return numpy.in1d(array, numpy.array(value, dtype=str)) & present
+        elif type(value) is str:
+            if op == 'endswith':
+                return numpy.char.endswith(array, value) & present
+            elif op == 'contains':
+                return (numpy.char.find(array, value) >= 0) & present
+            elif op == 'istartswith':
+                return numpy.char.startswith(self._get_lowered_array(column), value.lower()) & present
+            elif op == 'iendswith':
+                return numpy.char.endswith(self._get_lowered_array(column), value.lower()) & present
+            elif op == 'iexact':
+                return (self._get_lowered_array(column) == value.lower()) & present
+            elif op == 'icontains':
+                return (numpy.char.find(self._get_lowered_array(column), value.lower()) >= 0) & present
+
+        # The regex ops (and any values that aren't simple byte strings) are
+        # evaluated value by value.
+        return self.get_value_mask(column, value_matches)
+
+    def combine_masks(self, masks, conjunction, negated):
+        if len(masks) == 0:
+            mask = numpy.ones(self.row_count, bool) if conjunction else numpy.zeros(self.row_count, bool)
+        elif conjunction:
+            mask = numpy.logical_and.reduce(masks)
+        else:
+            mask = numpy.logical_or.reduce(masks)
+        if negated:
+            mask = ~mask
+        return mask
+
+    def select(self, mask):
+        rows = self.rows
+        return [rows[i] for i in numpy.flatnonzero(mask)]
@@ -0,0 +1,146 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Materialized views, i.e. denormalized copies of some of the fields of a model
+that are maintained by the backend. They're declared with the
+MATERIALIZED_VIEWS setting in the CassandraSettings of the model, a list of
+dictionaries with these keys:
+- COLUMN_FAMILY: the column family that stores the view
+- KEY_FIELD: the name of the field whose value is the row key of the view
+- FIELDS: the names of the fields that are copied to the view
+
+The view is stored in the wide row format (see widerow.py): the rows of the
+model with the same value of the key field are stored in the view row with
+that key, as groups of columns named <primary key>\\0<column>, plus a marker
+column named <primary key>\\0. The columns have the names of the columns of
+the fields in the model. So the view can be read with a wide row model whose
+PARTITION_KEY_FIELD is the key field and whose CLUSTERING_FIELD is a string
+field that holds the primary key of the model.
+
+The views are updated in the same batch_mutate call that writes or deletes
+the rows of the model, so they're updated atomically with the row (but
+Cassandra doesn't isolate the batch from concurrent reads).
+"""
+
+from django.db.utils import DatabaseError
+from cassandra.ttypes import *
+
+from .utils import get_cassandra_setting, is_wide_row_model
+from .widerow import COLUMN_NAME_SEPARATOR
+from ..fields import is_counter_model
+
+class MaterializedView(object):
+
+    def __init__(self, model, definition):
+        opts = model._meta
+        try:
+            self.column_family = str(definition['COLUMN_FAMILY'])
+            key_field_name = definition['KEY_FIELD']
+            field_names = definition.get('FIELDS', ())
+        except (KeyError, TypeError, AttributeError):
+            raise DatabaseError('Each of the MATERIALIZED_VIEWS of %s must be a dictionary '
+                                'with COLUMN_FAMILY, KEY_FIELD and FIELDS' % opts.object_name)
+        fields = dict((field.name, field) for field in opts.local_fields)
+        for field_name in (key_field_name,) + tuple(field_names):
+            if field_name not in fields:
+                raise DatabaseError('MATERIALIZED_VIEWS of %s refers to an unknown field: %s' %
+                                    (opts.object_name, field_name))
+        self.key_column = fields[key_field_name].column
+        # The key field and the primary key are part of the key of the
+        # entry, so they're not copied
+        self.columns = [fields[field_name].column for field_name in field_names
+                        if fields[field_name].column not in (self.key_column, opts.pk.column)]
+        # The columns of the model the view is built from
+        self.source_columns = [self.key_column] + self.columns
+
+    def get_column_names(self, key):
+        """
+        Returns the names of the columns of the entry of the row with the key.
+        """
+        prefix = key + COLUMN_NAME_SEPARATOR
+        return [prefix] + [prefix + column for column in self.columns]
+
+    def add_mutations(self, mutation_map, key, old_values, new_values, none_value,
+                      timestamp, ttl=None):
+        """
+        Adds the mutations that update the entry of the row with the key to
+        the mutation map of a batch_mutate call. The values are dictionaries
+        of the stored values of the field columns of the row before and after
+        the write; old_values is None if the row didn't exist, and new_values
+        is None if the row is deleted. An entry is moved to another view row
+        when the value of the key field changes, and there's no entry for the
+        rows whose key field is None.
+        """
+        old_key_value = old_values.get(self.key_column) if old_values else None
+        new_key_value = new_values.get(self.key_column) if new_values else None
+        if old_key_value == none_value:
+            old_key_value = None
+        if new_key_value == none_value:
+            new_key_value = None
+
+        if (old_key_value is not None) and (old_key_value != new_key_value):
+            deletion = Deletion(timestamp=timestamp,
+                                predicate=SlicePredicate(column_names=self.get_column_names(key)))
+            add_mutations(mutation_map, old_key_value, self.column_family,
+                          [Mutation(deletion=deletion)])
+        if new_key_value is None:
+            return
+        if (old_key_value == new_key_value) and \
+            all(old_values.get(column) == new_values.get(column) for column in self.columns):
+            return
+        prefix = key + COLUMN_NAME_SEPARATOR
+        columns = [Column(name=prefix, value='', timestamp=timestamp, ttl=ttl)]
+        for column in self.columns:
+            if column in new_values:
+                columns.append(Column(name=prefix + column, value=new_values[column],
+                                      timestamp=timestamp, ttl=ttl))
+        add_mutations(mutation_map, new_key_value, self.column_family,
+                      [Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=column))
+                       for column in columns])
+
+def add_mutations(mutation_map, key, column_family, mutation_list):
+    """
+    Adds the mutations of a row of a column family to the mutation map of a
+    batch_mutate call.
+    """
+    mutation_map.setdefault(key, {}).setdefault(column_family, []).extend(mutation_list)
+
+def get_source_columns(views):
+    """
+    Returns the list of the columns of the model that the views are built
+    from.
+    """
+    columns = []
+    for view in views:
+        for column in view.source_columns:
+            if column not in columns:
+                columns.append(column)
+    return columns
+
+_views = {}
+
+def get_materialized_views(model):
+    """
+    Returns the list of the materialized views of the model.
+    """
+    views = _views.get(model)
+    if views is None:
+        definitions = get_cassandra_setting(model, 'MATERIALIZED_VIEWS', ())
+        if definitions and (is_counter_model(model) or is_wide_row_model(model)):
+            raise DatabaseError("%s can't have materialized views, because it's stored in "
+                                "a counter column family or in wide rows" % model._meta.object_name)
+        views = _views[model] = [MaterializedView(model, definition)
+                                 for definition in definitions]
+    return views
@@ -0,0 +1,215 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Wide row storage of the instances of a model, for time series and other data
+that's queried by partition. The model declares a partition key field and a
+clustering field in its CassandraSettings:
+
+    class Reading(models.Model):
+        device = models.CharField(max_length=64)
+        timestamp = models.IntegerField()
+        value = models.FloatField()
+
+        class CassandraSettings:
+            PARTITION_KEY_FIELD = 'device'
+            CLUSTERING_FIELD = 'timestamp'
+
+All of the instances with the same value of the partition key field are
+stored in a single row, whose key is that value. Each instance is stored as
+a group of columns named <clustering value>\\0<column>, so the instances are
+ordered by the clustering field within the row, plus a marker column named
+<clustering value>\\0 (so an instance with no other columns still exists).
+The column family uses the BytesType comparator, and integer clustering
+values are encoded so that their byte order is their numeric order.
+
+The primary key of an instance is <partition key><separator><clustering
+value>, with the separator of compound keys, so the partition key and the
+clustering field identify the instance.
+"""
+
+from django.db.utils import DatabaseError
+
+from .utils import CompactRow, get_cassandra_setting, is_wide_row_model
+from .storage import get_storage_format
+from ..fields import is_counter_model
+
+# Separates the clustering value from the column name in the column names
+COLUMN_NAME_SEPARATOR = '\x00'
+
+# Integers are stored with this offset and zero-padded, so that negative
+# values sort before positive ones
+_INTEGER_OFFSET = 2 ** 63
+
+_INTEGER_DB_TYPES = ('int', 'long')
+_UNSUPPORTED_CLUSTERING_DB_TYPES = ('float', 'id')
+
+class WideRowLayout(object):
+
+    def __init__(self, connection, model):
+        opts = model._meta
+        fields = dict((field.name, field) for field in opts.local_fields)
+        partition_field = fields.get(get_cassandra_setting(model, 'PARTITION_KEY_FIELD'))
+        clustering_field = fields.get(get_cassandra_setting(model, 'CLUSTERING_FIELD'))
+        if (partition_field is None) or (clustering_field is None):
+            raise DatabaseError('PARTITION_KEY_FIELD and CLUSTERING_FIELD of %s must be '
+                                'the names of fields of the model' % opts.object_name)
+        if partition_field.primary_key or clustering_field.primary_key:
+            raise DatabaseError("The primary key of %s can't be its partition key or "
+                                "clustering field" % opts.object_name)
+        if get_cassandra_setting(model, 'COMPOUND_KEY_FIELDS') is not None:
+            raise DatabaseError("A wide row model can't have COMPOUND_KEY_FIELDS")
+        if is_counter_model(model):
+            raise DatabaseError("A model with counter fields can't be stored in wide rows")
+
+        clustering_db_type = clustering_field.db_type(connection=connection)
+        if (clustering_db_type in _UNSUPPORTED_CLUSTERING_DB_TYPES) or \
+            clustering_db_type.startswith('decimal') or clustering_db_type.startswith('ListField'):
+            raise DatabaseError('The clustering field of %s must be an integer, string '
+                                'or date/time field' % opts.object_name)
+        self.clustering_is_integer = clustering_db_type in _INTEGER_DB_TYPES
+
+        storage_format = get_storage_format(connection, model)
+        self.pk_column = opts.pk.column
+        self.partition_column = partition_field.column
+        self.clustering_column = clustering_field.column
+        key_columns = (self.pk_column, self.partition_column, self.clustering_column)
+        for column in key_columns:
+            if storage_format.get_storage_column(column) != column:
+                raise DatabaseError("The key fields of the wide row model %s can't be "
+                                    "renamed with COLUMN_NAMES" % opts.object_name)
+        self.value_columns = [storage_format.get_storage_column(field.column)
+                              for field in opts.local_fields if field.column not in key_columns]
+        # The marker column plus the value columns
+        self.columns_per_instance = len(self.value_columns) + 1
+
+        separator = get_cassandra_setting(model, 'COMPOUND_KEY_SEPARATOR',
+            connection.settings_dict.get('CASSANDRA_COMPOUND_KEY_SEPARATOR', '|'))
+        self.separator = str(separator)
+
+    def encode_clustering_value(self, value):
+        """
+        Returns the prefix of the column names of the instance with the
+        (stored) clustering value.
+        """
+        if self.clustering_is_integer:
+            try:
+                return '%020d' % (long(value) + _INTEGER_OFFSET)
+            except ValueError:
+                raise DatabaseError('Invalid clustering value: %s' % value)
+        if COLUMN_NAME_SEPARATOR in value:
+            raise DatabaseError("A clustering value can't contain a null character")
+        return value
+
+    def decode_clustering_value(self, encoded_value):
+        if self.clustering_is_integer:
+            return str(long(encoded_value) - _INTEGER_OFFSET)
+        return encoded_value
+
+    def get_column_name(self, encoded_value, column):
+        return encoded_value + COLUMN_NAME_SEPARATOR + column
+
+    def get_encoded_value(self, column_name):
+        return column_name.split(COLUMN_NAME_SEPARATOR, 1)[0]
+
+    def get_instance_column_names(self, encoded_value):
+        """
+        Returns the names of all of the columns of an instance.
+        """
+        return [self.get_column_name(encoded_value, column)
+                for column in [''] + self.value_columns]
+
+    def get_key(self, partition_value, clustering_value):
+        """
+        Returns the primary key of the instance.
+        """
+        if self.separator in partition_value:
+            raise DatabaseError("The partition key can't contain the separator %s" % self.separator)
+        return partition_value + self.separator + clustering_value
+
+    def split_key(self, key):
+        """
+        Returns the partition key and the clustering value of the instance with
+        the primary key, or None if it's not a valid key.
+        """
+        parts = key.split(self.separator, 1)
+        return tuple(parts) if len(parts) == 2 else None
+
+    def get_slice_bounds(self, clustering_range, reversed):
+        """
+        Returns the start and finish column names of the slice of a wide row
+        that contains the instances in the clustering range (a RangePredicate
+        on the clustering column, or None for all of the instances).
+        """
+        lower = upper = ''
+        if clustering_range is not None:
+            # No column name has a null character after the clustering value,
+            # so the value itself sorts before all of its columns and the value
+            # followed by '\x01' sorts after them.
+            if clustering_range.start is not None:
+                encoded_value = self.encode_clustering_value(clustering_range.start)
+                lower = encoded_value if clustering_range.start_inclusive else encoded_value + '\x01'
+            if clustering_range.end is not None:
+                encoded_value = self.encode_clustering_value(clustering_range.end)
+                upper = encoded_value + '\x01' if clustering_range.end_inclusive else encoded_value
+        return (upper, lower) if reversed else (lower, upper)
+
+    def convert_columns_to_rows(self, column_table, key, columns):
+        """
+        Converts the columns (Column objects, in the order of a slice) of the
+        wide row with the key into a list of rows, one per instance.
+        """
+        rows = []
+        encoded_value = None
+        values = None
+        for column in columns:
+            column_encoded_value, column_name = column.name.split(COLUMN_NAME_SEPARATOR, 1)
+            if column_encoded_value != encoded_value:
+                if values is not None:
+                    rows.append(self._make_row(column_table, key, encoded_value, values))
+                encoded_value = column_encoded_value
+                values = []
+            if column_name:
+                values.append((column_name, column.value))
+        if values is not None:
+            rows.append(self._make_row(column_table, key, encoded_value, values))
+        return rows
+
+    def _make_row(self, column_table, key, encoded_value, values):
+        clustering_value = self.decode_clustering_value(encoded_value)
+        values.append((self.partition_column, key))
+        values.append((self.clustering_column, clustering_value))
+        values.append((self.pk_column, key + self.separator + clustering_value))
+        row_values = [None] * len(column_table.names)
+        for name, value in values:
+            index = column_table.get_index(name)
+            if index >= len(row_values):
+                row_values.extend([None] * (index + 1 - len(row_values)))
+            row_values[index] = value
+        return CompactRow(column_table, tuple(row_values))
+
+_layouts = {}
+
+def get_wide_row_layout(connection, model):
+    """
+    Returns the wide row layout of the model, or None if it's not stored in
+    wide rows.
+    """
+    if not is_wide_row_model(model):
+        return None
+    key = (connection.alias, model)
+    layout = _layouts.get(key)
+    if layout is None:
+        layout = _layouts[key] = WideRowLayout(connection, model)
+    return layout
@@ -0,0 +1,630 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+In-process stand-in for a Cassandra node, used by the benchmarks (and handy
+for tests that need to control the latency of the server).
+
+It serves the subset of the Cassandra Thrift API that the backend uses from
+in-memory storage, over a real Thrift socket, so the whole client side of the
+backend (transport, protocol, reconnect logic) is exercised. Keys are ordered
+like they are with the ByteOrderedPartitioner. Several servers can share the
+same storage to simulate multiple coordinators of one cluster, each with its
+own injected latency.
+"""
+
+import bisect
+import random
+import socket
+import threading
+import time
+import uuid
+
+from thrift.transport import TSocket, TTransport
+from thrift.protocol import TBinaryProtocol
+from cassandra import Cassandra
+from cassandra.ttypes import *
+
+FAKE_API_VERSION = '19.20.0'
+FAKE_PARTITIONER = 'org.apache.cassandra.dht.ByteOrderedPartitioner'
+
+# How often (in seconds) the accept loop checks whether the server was stopped
+_ACCEPT_TIMEOUT = 0.1
+
+def _token_for_key(key):
+    # Tokens of the ByteOrderedPartitioner are the hex encoding of the key
+    return key.encode('hex')
+
+class _FakeRow(object):
+    """
+    The columns of a row, with the column names kept in sorted order.
+    Each column is stored as a (value, timestamp, expiration_time) tuple.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.columns = {}
+
+    def put(self, name, value, timestamp, ttl=None):
+        existing = self.columns.get(name)
+        if existing is not None and existing[1] > timestamp:
+            return
+        if existing is None:
+            bisect.insort(self.names, name)
+        expiration_time = (time.time() + ttl) if ttl else None
+        self.columns[name] = (value, timestamp, expiration_time)
+
+    def add(self, name, value):
+        existing = self.columns.get(name)
+        if existing is None:
+            bisect.insort(self.names, name)
+            current_value = 0
+        else:
+            current_value = existing[0]
+        self.columns[name] = (current_value + value, 0, None)
+
+    def delete(self, name, timestamp):
+        existing = self.columns.get(name)
+        if existing is not None and (timestamp is None or existing[1] <= timestamp):
+            del self.columns[name]
+            del self.names[bisect.bisect_left(self.names, name)]
+
+    def get(self, name, now):
+        column = self.columns.get(name)
+        if column is None:
+            return None
+        if column[2] is not None and column[2] <= now:
+            return None
+        return column
+
+    def live_names(self, now):
+        return [name for name in self.names if self.get(name, now) is not None]
+
+    def select(self, predicate, now):
+        """
+        Returns the (name, column) tuples selected by a SlicePredicate.
+        """
+        result = []
+        if predicate.column_names is not None:
+            for name in predicate.column_names:
+                column = self.get(name, now)
+                if column is not None:
+                    result.append((name, column))
+            return result
+
+        slice_range = predicate.slice_range
+        names = self.names
+        if not slice_range.reversed:
+            begin = bisect.bisect_left(names, slice_range.start) if slice_range.start else 0
+            end = bisect.bisect_right(names, slice_range.finish) if slice_range.finish else len(names)
+            indexes = xrange(begin, end)
+        else:
+            end = bisect.bisect_right(names, slice_range.start) if slice_range.start else len(names)
+            begin = bisect.bisect_left(names, slice_range.finish) if slice_range.finish else 0
+            indexes = xrange(end - 1, begin - 1, -1)
+        for index in indexes:
+            if len(result) >= slice_range.count:
+                break
+            name = names[index]
+            column = self.get(name, now)
+            if column is not None:
+                result.append((name, column))
+        return result
+
+    def is_empty(self):
+        return len(self.columns) == 0
+
+
+class _FakeColumnFamily(object):
+
+    def __init__(self, cf_def):
+        self.cf_def = cf_def
+        self.is_counter = (cf_def.default_validation_class or '').endswith('CounterColumnType')
+        self.keys = []
+        self.rows = {}
+
+    def get_row(self, key, create=False):
+        row = self.rows.get(key)
+        if row is None and create:
+            row = self.rows[key] = _FakeRow()
+            bisect.insort(self.keys, key)
+        return row
+
+    def remove_row_if_empty(self, key):
+        row = self.rows.get(key)
+        if row is not None and row.is_empty():
+            del self.rows[key]
+            del self.keys[bisect.bisect_left(self.keys, key)]
+
+    def iter_keys(self, start_key='', end_key=''):
+        begin = bisect.bisect_left(self.keys, start_key) if start_key else 0
+        end = bisect.bisect_right(self.keys, end_key) if end_key else len(self.keys)
+        return self.keys[begin:end]
+
+    def make_column(self, name, column):
+        if self.is_counter:
+            return ColumnOrSuperColumn(counter_column=CounterColumn(name=name, value=column[0]))
+        ttl = None
+        if column[2] is not None:
+            ttl = max(1, int(column[2] - time.time()))
+        return ColumnOrSuperColumn(column=Column(name=name, value=column[0],
+                                                 timestamp=column[1], ttl=ttl))
+
+
+class FakeCassandraStorage(object):
+    """
+    The in-memory keyspaces of a fake cluster. All access is serialized with
+    a single lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.keyspaces = {}
+        self.column_families = {}
+        self.schema_version = str(uuid.uuid1())
+
+    def update_schema_version(self):
+        self.schema_version = str(uuid.uuid1())
+        return self.schema_version
+
+
+class FakeCassandraHandler(Cassandra.Iface):
+    """
+    Implementation of the Thrift interface. The handler is shared by all of
+    the client connections of a server (each of which is served by its own
+    thread), so the per-connection state is kept in a thread local.
+    """
+
+    def __init__(self, storage, latency=0.0, latency_jitter=0.0, method_latencies=None,
+                 host='127.0.0.1'):
+        self.storage = storage
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.method_latencies = method_latencies or {}
+        self.host = host
+        self.call_counts = {}
+        self._local = threading.local()
+
+    def _begin_call(self, method):
+        self.call_counts[method] = self.call_counts.get(method, 0) + 1
+        latency = self.method_latencies.get(method, self.latency)
+        if self.latency_jitter:
+            latency += random.uniform(0, self.latency_jitter)
+        if latency > 0:
+            time.sleep(latency)
+
+    def _get_keyspace_name(self):
+        keyspace = getattr(self._local, 'keyspace', None)
+        if keyspace is None:
+            raise InvalidRequestException(why='You have not set a keyspace for this session')
+        return keyspace
+
+    def _get_column_family(self, name):
+        keyspace = self._get_keyspace_name()
+        column_family = self.storage.column_families.get((keyspace, name))
+        if column_family is None:
+            raise InvalidRequestException(why='unconfigured columnfamily %s' % name)
+        return column_family
+
+    def _select(self, column_family, row, predicate, now):
+        if row is None:
+            return []
+        return [column_family.make_column(name, column)
+                for name, column in row.select(predicate, now)]
+
+    # Connection & schema methods
+
+    def login(self, auth_request):
+        self._local.logged_in = True
+
+    def set_keyspace(self, keyspace):
+        self._begin_call('set_keyspace')
+        if keyspace not in self.storage.keyspaces:
+            raise InvalidRequestException(why='Keyspace %s does not exist' % keyspace)
+        self._local.keyspace = keyspace
+
+    def describe_version(self):
+        self._begin_call('describe_version')
+        return FAKE_API_VERSION
+
+    def describe_partitioner(self):
+        return FAKE_PARTITIONER
+
+    def describe_cluster_name(self):
+        return 'Fake Cluster'
+
+    def describe_snitch(self):
+        return 'org.apache.cassandra.locator.SimpleSnitch'
+
+    def describe_schema_versions(self):
+        self._begin_call('describe_schema_versions')
+        return {self.storage.schema_version: [self.host]}
+
+    def describe_keyspaces(self):
+        self._begin_call('describe_keyspaces')
+        return self.storage.keyspaces.values()
+
+    def describe_keyspace(self, keyspace):
+        self._begin_call('describe_keyspace')
+        ks_def = self.storage.keyspaces.get(keyspace)
+        if ks_def is None:
+            raise NotFoundException()
+        return ks_def
+
+    def describe_ring(self, keyspace):
+        return [TokenRange(start_token='', end_token='', endpoints=[self.host])]
+
+    def describe_splits(self, cfName, start_token, end_token, keys_per_split):
+        return [start_token, end_token]
+
+    def system_add_keyspace(self, ks_def):
+        self._begin_call('system_add_keyspace')
+        storage = self.storage
+        storage.lock.acquire()
+        try:
+            if ks_def.name in storage.keyspaces:
+                raise InvalidRequestException(why='Keyspace already exists.')
+            cf_defs = ks_def.cf_defs or []
+            ks_def.cf_defs = []
+            storage.keyspaces[ks_def.name] = ks_def
+            for cf_def in cf_defs:
+                cf_def.keyspace = ks_def.name
+                self._add_column_family(cf_def)
+            return storage.update_schema_version()
+        finally:
+            storage.lock.release()
+
+    def system_drop_keyspace(self, keyspace):
+        self._begin_call('system_drop_keyspace')
+        storage = self.storage
+        storage.lock.acquire()
+        try:
+            if keyspace not in storage.keyspaces:
+                raise InvalidRequestException(why='Keyspace does not exist.')
+            del storage.keyspaces[keyspace]
+            for key in storage.column_families.keys():
+                if key[0] == keyspace:
+                    del storage.column_families[key]
+            return storage.update_schema_version()
+        finally:
+            storage.lock.release()
+
+    def _add_column_family(self, cf_def):
+        storage = self.storage
+        ks_def = storage.keyspaces.get(cf_def.keyspace)
+        if ks_def is None:
+            raise InvalidRequestException(why='Keyspace does not exist.')
+        if (cf_def.keyspace, cf_def.name) in storage.column_families:
+            raise InvalidRequestException(why='%s already exists in keyspace %s' % (cf_def.name, cf_def.keyspace))
+        ks_def.cf_defs.append(cf_def)
+        storage.column_families[(cf_def.keyspace, cf_def.name)] = _FakeColumnFamily(cf_def)
+
+    def system_add_column_family(self, cf_def):
+        self._begin_call('system_add_column_family')
+        storage = self.storage
+        storage.lock.acquire()
+        try:
+            if not cf_def.keyspace:
+                cf_def.keyspace = self._get_keyspace_name()
+            self._add_column_family(cf_def)
+            return storage.update_schema_version()
+        finally:
+            storage.lock.release()
+
+    def system_drop_column_family(self, column_family):
+        self._begin_call('system_drop_column_family')
+        storage = self.storage
+        storage.lock.acquire()
+        try:
+            keyspace = self._get_keyspace_name()
+            self._get_column_family(column_family)
+            del storage.column_families[(keyspace, column_family)]
+            ks_def = storage.keyspaces[keyspace]
+            ks_def.cf_defs = [cf_def for cf_def in ks_def.cf_defs if cf_def.name != column_family]
+            return storage.update_schema_version()
+        finally:
+            storage.lock.release()
+
+    def truncate(self, cfname):
+        self._begin_call('truncate')
+        self.storage.lock.acquire()
+        try:
+            column_family = self._get_column_family(cfname)
+            column_family.keys = []
+            column_family.rows = {}
+        finally:
+            self.storage.lock.release()
+
+    # Read methods
+
+    def get_slice(self, key, column_parent, predicate, consistency_level):
+        self._begin_call('get_slice')
+        self.storage.lock.acquire()
+        try:
+            column_family = self._get_column_family(column_parent.column_family)
+            return self._select(column_family, column_family.get_row(key), predicate, time.time())
+        finally:
+            self.storage.lock.release()
+
+    def get_count(self, key, column_parent, predicate, consistency_level):
+        return len(self.get_slice(key, column_parent, predicate, consistency_level))
+
+    def multiget_slice(self, keys, column_parent, predicate, consistency_level):
+        self._begin_call('multiget_slice')
+        self.storage.lock.acquire()
+        try:
+            column_family = self._get_column_family(column_parent.column_family)
+            now = time.time()
+            result = {}
+            for key in keys:
+                result[key] = self._select(column_family, column_family.get_row(key), predicate, now)
+            return result
+        finally:
+            self.storage.lock.release()
+
+    def get_range_slices(self, column_parent, predicate, range, consistency_level):
+        self._begin_call('get_range_slices')
+        self.storage.lock.acquire()
+        try:
+            column_family = self._get_column_family(column_parent.column_family)
+            now = time.time()
+            if range.start_token is not None or range.end_token is not None:
+                keys = column_family.iter_keys()
+                start_token = range.start_token or ''
+                end_token = range.end_token or ''
+                if start_token != end_token:
+                    # Token ranges are (start, end]
+                    keys = [key for key in keys
+                            if (_token_for_key(key) > start_token) and
+                               ((not end_token) or (_token_for_key(key) <= end_token))]
+            else:
+                keys = column_family.iter_keys(range.start_key, range.end_key)
+            result = []
+            for key in keys:
+                if len(result) >= range.count:
+                    break
+                row = column_family.get_row(key)
+                if not row.live_names(now):
+                    continue
+                result.append(KeySlice(key=key, columns=self._select(column_family, row, predicate, now)))
+            return result
+        finally:
+            self.storage.lock.release()
+
+    def _matches_index_expression(self, row, expression, now):
+        column = row.get(expression.column_name, now)
+        if column is None:
+            return False
+        value = column[0]
+        op = expression.op
+        if op == IndexOperator.EQ:
+            return value == expression.value
+        elif op == IndexOperator.GTE:
+            return value >= expression.value
+        elif op == IndexOperator.GT:
+            return value > expression.value
+        elif op == IndexOperator.LTE:
+            return value <= expression.value
+        elif op == IndexOperator.LT:
+            return value < expression.value
+        return False
+
+    def get_indexed_slices(self, column_parent, index_clause, column_predicate, consistency_level):
+        self._begin_call('get_indexed_slices')
+        self.storage.lock.acquire()
+        try:
+            column_family = self._get_column_family(column_parent.column_family)
+            now = time.time()
+            result = []
+            for key in column_family.iter_keys(index_clause.start_key):
+                if len(result) >= index_clause.count:
+                    break
+                row = column_family.get_row(key)
+                for expression in index_clause.expressions:
+                    if not self._matches_index_expression(row, expression, now):
+                        break
+                else:
+                    result.append(KeySlice(key=key, columns=self._select(column_family, row, column_predicate, now)))
+            return result
+        finally:
+            self.storage.lock.release()
+
+    # Write methods
+
+    def _apply_deletion(self, column_family, key, deletion):
+        row = column_family.get_row(key)
+        if row is None:
+            return
+        timestamp = None if column_family.is_counter else deletion.timestamp
+        if deletion.predicate is None:
+            names = list(row.names)
+        elif deletion.predicate.column_names is not None:
+            names = deletion.predicate.column_names
+        else:
+            names = [name for name, column in row.select(deletion.predicate, time.time())]
+        for name in names:
+            row.delete(name, timestamp)
+        column_family.remove_row_if_empty(key)
+
+    def batch_mutate(self, mutation_map, consistency_level):
+        self._begin_call('batch_mutate')
+        self.storage.lock.acquire()
+        try:
+            for key, column_family_mutations in mutation_map.iteritems():
+                for column_family_name, mutations in column_family_mutations.iteritems():
+                    column_family = self._get_column_family(column_family_name)
+                    for mutation in mutations:
+                        if mutation.deletion is not None:
+                            self._apply_deletion(column_family, key, mutation.deletion)
+                            continue
+                        column_or_supercolumn = mutation.column_or_supercolumn
+                        if column_or_supercolumn.counter_column is not None:
+                            counter_column = column_or_supercolumn.counter_column
+                            column_family.get_row(key, True).add(counter_column.name, counter_column.value)
+                        else:
+                            column = column_or_supercolumn.column
+                            column_family.get_row(key, True).put(column.name, column.value,
+                                                                 column.timestamp, column.ttl)
+        finally:
+            self.storage.lock.release()
+
+    def insert(self, key, column_parent, column, consistency_level):
+        mutation = Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=column))
+        self.batch_mutate({key: {column_parent.column_family: [mutation]}}, consistency_level)
+
+    def add(self, key, column_parent, column, consistency_level):
+        mutation = Mutation(column_or_supercolumn=ColumnOrSuperColumn(counter_column=column))
+        self.batch_mutate({key: {column_parent.column_family: [mutation]}}, consistency_level)
+
+    def remove(self, key, column_path, timestamp, consistency_level):
+        predicate = None
+        if column_path.column is not None:
+            predicate = SlicePredicate(column_names=[column_path.column])
+        deletion = Deletion(timestamp=timestamp, predicate=predicate)
+        self.batch_mutate({key: {column_path.column_family: [Mutation(deletion=deletion)]}}, consistency_level)
+
+    def remove_counter(self, key, path, consistency_level):
+        self.remove(key, path, None, consistency_level)
+
+
+def _get_free_port(host):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+class FakeCassandraServer(object):
+    """
+    A fake Cassandra node serving the Thrift API from a background thread.
+
+    Usage:
+        server = FakeCassandraServer(latency=0.001)
+        server.start()
+        # point HOST/PORT of the database settings at server.host/server.port
+        ...
+        server.stop()
+
+    The injected latency (in seconds) can be changed while the server is
+    running, either for all calls (server.handler.latency) or per method
+    (server.handler.method_latencies).
+    """
+
+    def __init__(self, storage=None, host='127.0.0.1', port=None, latency=0.0,
+                 latency_jitter=0.0, method_latencies=None):
+        self.storage = storage if storage is not None else FakeCassandraStorage()
+        self.host = host
+        self.port = port
+        self.handler = FakeCassandraHandler(self.storage, latency, latency_jitter,
+                                            method_latencies, host)
+        self.server_transport = None
+        self.thread = None
+        self.stopped = None
+        self.clients = set()
+        self.clients_lock = threading.Lock()
+
+    def start(self):
+        if self.port is None:
+            self.port = _get_free_port(self.host)
+        processor = Cassandra.Processor(self.handler)
+        self.server_transport = TSocket.TServerSocket(host=self.host, port=self.port)
+        self.server_transport.listen()
+        # The accept loop checks the stop flag between connections
+        self.server_transport.handle.settimeout(_ACCEPT_TIMEOUT)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._serve, args=(processor,))
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self._wait_until_listening()
+        return self
+
+    def _serve(self, processor):
+        # Like TThreadedServer, with a thread per client connection, but the
+        # loop exits when the server is stopped
+        server_transport = self.server_transport
+        while not self.stopped.isSet():
+            try:
+                client = server_transport.accept()
+            except socket.timeout:
+                continue
+            except Exception:
+                if self.stopped.isSet():
+                    break
+                continue
+            if client is None:
+                continue
+            client.handle.settimeout(None)
+            self.clients_lock.acquire()
+            try:
+                self.clients.add(client)
+            finally:
+                self.clients_lock.release()
+            thread = threading.Thread(target=self._handle_client, args=(processor, client))
+            thread.setDaemon(True)
+            thread.start()
+        server_transport.close()
+
+    def _handle_client(self, processor, client):
+        transport = TTransport.TFramedTransport(client)
+        protocol = TBinaryProtocol.TBinaryProtocolAccelerated(transport)
+        try:
+            while not self.stopped.isSet():
+                processor.process(protocol, protocol)
+        except Exception:
+            # The client closed the connection, or the server was stopped
+            pass
+        transport.close()
+        self.clients_lock.acquire()
+        try:
+            self.clients.discard(client)
+        finally:
+            self.clients_lock.release()
+
+    def _wait_until_listening(self, timeout=5.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                s.connect((self.host, self.port))
+                return
+            except socket.error:
+                time.sleep(0.01)
+            finally:
+                s.close()
+        raise RuntimeError('The fake Cassandra server did not start listening')
+
+    def stop(self, timeout=5.0):
+        """
+        Stops accepting connections, closes the client connections and waits
+        for the accept loop to exit.
+        """
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.clients_lock.acquire()
+        try:
+            clients = list(self.clients)
+        finally:
+            self.clients_lock.release()
+        for client in clients:
+            # Shutting down the socket wakes up the thread that's reading it
+            try:
+                client.handle.shutdown(socket.SHUT_RDWR)
+            except (socket.error, AttributeError):
+                pass
+        self.thread.join(timeout)
+        self.thread = None
+        self.server_transport = None
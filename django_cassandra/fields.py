@@ -0,0 +1,51 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from django.db import models
+
+class CounterField(models.BigIntegerField):
+    """
+    Integer field that's stored as a Cassandra counter column. Counters are
+    changed with increments, which are applied by Cassandra without reading
+    the row first, so concurrent increments are never lost:
+
+        PageViews.objects.filter(pk=url).update(views=F('views') + 1)
+
+    A counter column family can only contain counter columns, so all of the
+    fields of a model with counter fields (except for the primary key, which
+    is only stored as the row key) must be counter fields. Counters can't be
+    set to an absolute value once the row exists.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('default', 0)
+        super(CounterField, self).__init__(*args, **kwargs)
+
+    def get_internal_type(self):
+        return 'CounterField'
+
+def get_counter_fields(model):
+    """
+    Returns the list of the counter fields of the model.
+    """
+    return [field for field in model._meta.local_fields if isinstance(field, CounterField)]
+
+def is_counter_model(model):
+    """
+    Returns True if the column family of the model is a counter column family.
+    """
+    is_counter = model.__dict__.get('_cassandra_is_counter_model')
+    if is_counter is None:
+        is_counter = model._cassandra_is_counter_model = len(get_counter_fields(model)) > 0
+    return is_counter
@@ -0,0 +1,151 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Key/value storage in a column family, used by the cache and session backends.
+The calls are made directly with the Thrift API (not through the ORM) on a
+pool of connections that can be used by any thread.
+"""
+
+import threading
+
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.utils.encoding import smart_str
+from cassandra import Cassandra
+from cassandra.ttypes import *
+
+from .db.pool import HostConnectionPool
+from .db.utils import call_cassandra_with_reconnect, get_cassandra_hosts, \
+    get_next_timestamp
+
+class KeyValueStore(object):
+    """
+    Stores each value in a single column of the row with the key of the value.
+    Values can be written with a TTL (in seconds), after which Cassandra
+    expires them. The column family is created the first time the store is
+    used if it doesn't exist yet.
+    """
+
+    VALUE_COLUMN = 'value'
+
+    def __init__(self, column_family, database=DEFAULT_DB_ALIAS,
+                 read_consistency_level=None, write_consistency_level=None):
+        self.column_family = column_family
+        self.database = database
+        self.read_consistency_level = read_consistency_level
+        self.write_consistency_level = write_consistency_level
+        self._pool = None
+        self._lock = threading.Lock()
+        self._column_parent = ColumnParent(column_family=column_family)
+        self._slice_predicate = SlicePredicate(column_names=[self.VALUE_COLUMN])
+
+    def _get_pool(self):
+        # The connection settings (and the default consistency levels) are
+        # determined the first time the store is used
+        if self._pool is None:
+            self._lock.acquire()
+            try:
+                if self._pool is None:
+                    connection = connections[self.database]
+                    connection.creation.create_column_family(self.column_family)
+                    if self.read_consistency_level is None:
+                        self.read_consistency_level = connection.read_consistency_level
+                    if self.write_consistency_level is None:
+                        self.write_consistency_level = connection.write_consistency_level
+                    settings_dict = connection.settings_dict
+                    host, port = get_cassandra_hosts(settings_dict)[0]
+                    self._pool = HostConnectionPool(host, port,
+                        settings_dict.get('NAME') or 'django',
+                        settings_dict.get('USER'), settings_dict.get('PASSWORD'),
+                        connection.timeout)
+            finally:
+                self._lock.release()
+        return self._pool
+
+    def _call(self, pool, fn, *args):
+        db_connection = pool.get()
+        try:
+            return call_cassandra_with_reconnect(db_connection, fn, *args)
+        finally:
+            pool.put(db_connection)
+
+    def _make_mutation(self, value, timestamp, ttl):
+        column = Column(name=self.VALUE_COLUMN, value=value, timestamp=timestamp, ttl=ttl or None)
+        return Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=column))
+
+    def get(self, key):
+        """
+        Returns the value stored for the key, or None if there isn't one.
+        """
+        pool = self._get_pool()
+        column_list = self._call(pool, Cassandra.Client.get_slice, smart_str(key),
+            self._column_parent, self._slice_predicate, self.read_consistency_level)
+        return column_list[0].column.value if column_list else None
+
+    def get_many(self, keys):
+        """
+        Returns a dictionary of the values of the keys that have one, fetched
+        with a single call.
+        """
+        keys = [smart_str(key) for key in keys]
+        if not keys:
+            return {}
+        pool = self._get_pool()
+        results = self._call(pool, Cassandra.Client.multiget_slice, keys,
+            self._column_parent, self._slice_predicate, self.read_consistency_level)
+        values = {}
+        for key, column_list in results.iteritems():
+            if column_list:
+                values[key] = column_list[0].column.value
+        return values
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, items, ttl=None):
+        """
+        Stores the values of a dictionary, with a single batch_mutate call.
+        """
+        if not items:
+            return
+        pool = self._get_pool()
+        timestamp = get_next_timestamp()
+        mutation_map = {}
+        for key, value in items.iteritems():
+            mutation_map[smart_str(key)] = {self.column_family:
+                                            [self._make_mutation(value, timestamp, ttl)]}
+        self._call(pool, Cassandra.Client.batch_mutate, mutation_map, self.write_consistency_level)
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        """
+        Deletes the values of the keys, with a single batch_mutate call.
+        """
+        if not keys:
+            return
+        pool = self._get_pool()
+        deletion = Deletion(timestamp=get_next_timestamp())
+        mutation_map = {}
+        for key in keys:
+            mutation_map[smart_str(key)] = {self.column_family: [Mutation(deletion=deletion)]}
+        self._call(pool, Cassandra.Client.batch_mutate, mutation_map, self.write_consistency_level)
+
+    def clear(self):
+        """
+        Deletes all of the values, by truncating the column family.
+        """
+        pool = self._get_pool()
+        self._call(pool, Cassandra.Client.truncate, self.column_family)
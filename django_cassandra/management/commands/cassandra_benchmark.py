@@ -0,0 +1,167 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import platform
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import simplejson
+
+from django_cassandra.benchmark import BenchmarkRunner, compare_results, \
+    DEFAULT_BENCHMARK_KEYSPACE, DEFAULT_SAMPLE_SIZE, DEFAULT_SCAN_REPEAT, DEFAULT_SCENARIOS
+
+class Command(BaseCommand):
+    help = ('Runs the benchmarks of the Cassandra backend, either against an '
+            'in-process fake Cassandra server or against the configured cluster.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database', default='default',
+            help='The database to run the benchmarks against. Defaults to the "default" database.'),
+        make_option('--keyspace', action='store', dest='keyspace', default=DEFAULT_BENCHMARK_KEYSPACE,
+            help='The keyspace to use for the benchmarks. It is dropped and recreated for each row count.'),
+        make_option('--sizes', action='store', dest='sizes', default='1000,10000',
+            help='Comma-separated list of the row counts to run the benchmarks with.'),
+        make_option('--scenarios', action='store', dest='scenarios', default=','.join(DEFAULT_SCENARIOS),
+            help='Comma-separated list of the scenarios to run.'),
+        make_option('--sample-size', action='store', type='int', dest='sample_size',
+            default=DEFAULT_SAMPLE_SIZE,
+            help='Number of operations timed for the single-row scenarios.'),
+        make_option('--scan-repeat', action='store', type='int', dest='scan_repeat',
+            default=DEFAULT_SCAN_REPEAT,
+            help='Number of times the full-scan scenarios are repeated.'),
+        make_option('--live', action='store_true', dest='live', default=False,
+            help='Run against the configured Cassandra cluster instead of the fake server.'),
+        make_option('--latency', action='store', type='float', dest='latency', default=0.0,
+            help='Latency in milliseconds that the fake server adds to each call.'),
+        make_option('--latency-jitter', action='store', type='float', dest='latency_jitter', default=0.0,
+            help='Maximum random latency in milliseconds that the fake server adds to each call.'),
+        make_option('--output', action='store', dest='output', default=None,
+            help='File to save the results to (as JSON).'),
+        make_option('--compare', action='store', dest='compare', default=None,
+            help='File with saved results to compare the results of this run against.'),
+        make_option('--threshold', action='store', type='float', dest='threshold', default=10.0,
+            help='Percent change that is reported as a regression when comparing results.'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('The --sizes option must be a comma-separated list of integers')
+        scenarios = [scenario.strip() for scenario in options['scenarios'].split(',')]
+        for scenario in scenarios:
+            if scenario not in DEFAULT_SCENARIOS:
+                raise CommandError('Unknown benchmark scenario: %s' % scenario)
+
+        baseline = None
+        if options['compare']:
+            try:
+                baseline = simplejson.load(open(options['compare']))
+            except Exception, e:
+                raise CommandError('Error loading the results to compare against: %s' % e)
+
+        connection = connections[options['database']]
+        settings_dict = connection.settings_dict
+        original_settings = settings_dict.copy()
+        # Keep the query log from growing (and skewing the peak RSS) while
+        # the benchmarks run
+        debug = settings.DEBUG
+        settings.DEBUG = False
+        server = None
+        try:
+            if not options['live']:
+                from django_cassandra.fake_server import FakeCassandraServer
+                server = FakeCassandraServer(latency=options['latency'] / 1000.0,
+                                             latency_jitter=options['latency_jitter'] / 1000.0)
+                server.start()
+                settings_dict['HOST'] = server.host
+                settings_dict['PORT'] = server.port
+            settings_dict['NAME'] = options['keyspace']
+
+            runner = BenchmarkRunner(connection, options['sample_size'],
+                                     options['scan_repeat'], scenarios)
+            results = {}
+            for size in sizes:
+                self.stdout.write('Running benchmarks with %d rows...\n' % size)
+                results[str(size)] = runner.run(size)
+                self._write_results(size, results[str(size)])
+            connection.creation.drop_keyspace(options['keyspace'])
+        finally:
+            settings.DEBUG = debug
+            settings_dict.clear()
+            settings_dict.update(original_settings)
+            if connection._db_connection is not None:
+                connection._db_connection.close()
+                connection._db_connection = None
+            if server is not None:
+                server.stop()
+
+        output = {
+            'meta': {
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'server': 'live' if options['live'] else 'fake',
+                'latency_ms': options['latency'],
+                'latency_jitter_ms': options['latency_jitter'],
+                'sample_size': options['sample_size'],
+                'scan_repeat': options['scan_repeat'],
+            },
+            'results': results,
+        }
+        if options['output']:
+            output_file = open(options['output'], 'w')
+            try:
+                simplejson.dump(output, output_file, indent=2, sort_keys=True)
+            finally:
+                output_file.close()
+
+        if baseline is not None:
+            comparisons = compare_results(baseline, output, options['threshold'] / 100.0)
+            regressions = self._write_comparisons(comparisons)
+            if regressions:
+                raise CommandError('%d benchmark regression(s) compared to %s' %
+                                   (regressions, options['compare']))
+
+    def _write_results(self, size, results):
+        self.stdout.write('%-15s %10s %12s %10s %10s %14s %16s\n' %
+                          ('scenario', 'ops', 'ops/s', 'p50 ms', 'p99 ms', 'peak growth kB',
+                           'process peak kB'))
+        for scenario in DEFAULT_SCENARIOS:
+            result = results.get(scenario)
+            if result is None:
+                continue
+            self.stdout.write('%-15s %10d %12.1f %10.3f %10.3f %14d %16d\n' %
+                              (scenario, result['operations'], result['ops_per_second'],
+                               result['p50_ms'], result['p99_ms'], result['peak_rss_growth_kb'],
+                               result['process_peak_rss_kb']))
+
+    def _write_comparisons(self, comparisons):
+        regressions = 0
+        self.stdout.write('\n%-8s %-15s %-15s %12s %12s %9s\n' %
+                          ('rows', 'scenario', 'metric', 'baseline', 'current', 'change'))
+        for size, scenario, metric, baseline_value, current_value, is_regression in comparisons:
+            if baseline_value:
+                change = '%+.1f%%' % ((current_value - baseline_value) * 100.0 / baseline_value)
+            else:
+                change = 'n/a'
+            self.stdout.write('%-8s %-15s %-15s %12.3f %12.3f %9s%s\n' %
+                              (size, scenario, metric, baseline_value, current_value, change,
+                               '  REGRESSION' if is_regression else ''))
+            if is_regression:
+                regressions += 1
+        return regressions
@@ -0,0 +1,62 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import get_model
+
+from django_cassandra.db.storage import rewrite_rows
+from django_cassandra.db.utils import is_wide_row_model
+from django_cassandra.fields import is_counter_model
+
+class Command(BaseCommand):
+    help = ('Rewrites the existing rows of the given models (by default all of the '
+            'models of the database) in the storage format and with the column '
+            'names that are currently configured for them.')
+    args = '[app_label.ModelName ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database', default='default',
+            help='The database to rewrite the rows of. Defaults to the "default" database.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only report how many rows would be rewritten.'),
+    )
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        if args:
+            models = []
+            for name in args:
+                try:
+                    app_label, model_name = name.split('.')
+                except ValueError:
+                    raise CommandError('Models must be given as app_label.ModelName: %s' % name)
+                model = get_model(app_label, model_name)
+                if model is None:
+                    raise CommandError('Unknown model: %s' % name)
+                models.append(model)
+        else:
+            models = [model for model in connection.creation.get_syncdb_models()
+                      if not is_counter_model(model) and not is_wide_row_model(model)]
+
+        for model in models:
+            try:
+                row_count, rewritten_count = rewrite_rows(connection, model, options['dry_run'])
+            except Exception, e:
+                raise CommandError('Error rewriting the rows of %s: %s' % (model._meta.object_name, e))
+            self.stdout.write('%s: %d of %d rows %s\n' % (model._meta.object_name,
+                rewritten_count, row_count,
+                'would be rewritten' if options['dry_run'] else 'rewritten'))
@@ -0,0 +1,328 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from itertools import islice
+
+from django.core.exceptions import FieldError
+from django.db import connections, models
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import QuerySet, ValuesQuerySet, DateQuerySet
+from django.db.models.sql.constants import LOOKUP_SEP
+
+from .db.concurrent import get_query_executor
+from .db.options import make_option_overrides, push_option_overrides, \
+    pop_option_overrides, bind_option_overrides
+
+class CassandraQuerySet(QuerySet):
+    """
+    QuerySet with support for the Cassandra-specific features of the backend.
+
+    The consistency levels and the timeout of the Cassandra calls made for
+    the queryset can be set with the using_consistency, with_timeout and
+    cassandra_options methods:
+
+        hosts = Host.objects.filter(slice=slice).using_consistency(ConsistencyLevel.QUORUM)
+
+    The submit methods run the query in the background, so that several
+    independent queries can be waiting on Cassandra at the same time. Each of
+    them returns a future whose result() method waits for and returns the
+    result:
+
+        hosts = Host.objects.filter(slice=slice).submit()
+        tag_count = Tag.objects.filter(name='color').submit_count()
+        ...
+        for host in hosts.result():
+            ...
+
+    The objects that are referred to by the foreign keys of the results can
+    be fetched in bulk with prefetch_related (or select_related, which is
+    emulated in the same way), instead of with a query per result when the
+    foreign keys are accessed:
+
+        for tag in Tag.objects.filter(name='color').prefetch_related('host__slice'):
+            print tag.host.slice.name
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CassandraQuerySet, self).__init__(*args, **kwargs)
+        self._cassandra_options = {}
+        self._prefetch_related_paths = ()
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        if klass is not None:
+            klass = _get_cassandra_queryset_class(klass)
+        kwargs.setdefault('_cassandra_options', self._cassandra_options)
+        kwargs.setdefault('_prefetch_related_paths', self._prefetch_related_paths)
+        return super(CassandraQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def cassandra_options(self, consistency_level=None, **options):
+        """
+        Returns a copy of the queryset whose Cassandra calls use the given
+        options (see django_cassandra.db.options.cassandra_options).
+        """
+        overrides = dict(self._cassandra_options)
+        overrides.update(make_option_overrides(consistency_level, **options))
+        return self._clone(_cassandra_options=overrides)
+
+    def using_consistency(self, consistency_level=None, read=None, write=None):
+        return self.cassandra_options(consistency_level, read_consistency_level=read,
+                                      write_consistency_level=write)
+
+    def with_timeout(self, timeout):
+        return self.cassandra_options(timeout=timeout)
+
+    def with_ttl(self, ttl):
+        """
+        Returns a copy of the queryset whose updates write columns that expire
+        after ttl seconds.
+        """
+        return self.cassandra_options(ttl=ttl)
+
+    def prefetch_related(self, *field_paths):
+        """
+        Returns a copy of the queryset that fetches the objects referred to
+        by the foreign keys along the given paths of field names (e.g. 'host'
+        or 'host__slice') for each page of results, with one query by primary
+        key per field. prefetch_related(None) clears the paths.
+        """
+        if field_paths == (None,):
+            return self._clone(_prefetch_related_paths=())
+        return self._clone(_prefetch_related_paths=self._prefetch_related_paths + field_paths)
+
+    def _get_related_paths(self):
+        # select_related is emulated with the same bulk queries; with no
+        # field names it follows the foreign keys that can't be null (one
+        # level deep). The values() and dates() querysets don't return
+        # instances, so they don't have related objects.
+        if isinstance(self, (ValuesQuerySet, DateQuerySet)):
+            return []
+        paths = list(self._prefetch_related_paths)
+        select_related = self.query.select_related
+        if isinstance(select_related, dict):
+            paths.extend(_get_field_paths(select_related))
+        elif select_related:
+            paths.extend(field.name for field in self.model._meta.fields
+                         if isinstance(field, models.ForeignKey) and not field.null)
+        return paths
+
+    def _iterate_with_related(self, iterator, field_paths):
+        page_size = connections[self.db].fetch_page_size
+        while True:
+            instances = list(islice(iterator, page_size))
+            if not instances:
+                return
+            self._call_with_options(prefetch_related_objects, instances, field_paths, self.db)
+            for instance in instances:
+                yield instance
+
+    def _call_with_options(self, fn, *args, **kwargs):
+        if not self._cassandra_options:
+            return fn(*args, **kwargs)
+        push_option_overrides(self._cassandra_options)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            pop_option_overrides()
+
+    def _iterate_with_options(self, iterator):
+        # The rows are fetched lazily, so the options are only in effect
+        # while the next result is being produced.
+        while True:
+            push_option_overrides(self._cassandra_options)
+            try:
+                try:
+                    result = iterator.next()
+                except StopIteration:
+                    return
+            finally:
+                pop_option_overrides()
+            yield result
+
+    def iterator(self):
+        field_paths = self._get_related_paths()
+        queryset = self
+        if self.query.select_related:
+            # The backend doesn't return the columns of joined tables, so the
+            # related objects must only be cached by the bulk fetch
+            queryset = self._clone()
+            queryset.query.select_related = False
+        iterator = super(CassandraQuerySet, queryset).iterator()
+        if self._cassandra_options:
+            iterator = self._iterate_with_options(iterator)
+        if field_paths:
+            iterator = self._iterate_with_related(iterator, field_paths)
+        return iterator
+
+    def count(self):
+        return self._call_with_options(super(CassandraQuerySet, self).count)
+
+    def exists(self):
+        return self._call_with_options(super(CassandraQuerySet, self).exists)
+
+    def aggregate(self, *args, **kwargs):
+        return self._call_with_options(super(CassandraQuerySet, self).aggregate, *args, **kwargs)
+
+    def delete(self):
+        return self._call_with_options(super(CassandraQuerySet, self).delete)
+    delete.alters_data = True
+
+    def update(self, **kwargs):
+        return self._call_with_options(super(CassandraQuerySet, self).update, **kwargs)
+    update.alters_data = True
+
+    def _update(self, values):
+        return self._call_with_options(super(CassandraQuerySet, self)._update, values)
+    _update.alters_data = True
+
+    def _submit(self, fn, *args, **kwargs):
+        # The options that are in effect in this thread also apply to
+        # the query that runs in the background
+        executor = get_query_executor(connections[self.db])
+        return executor.submit(bind_option_overrides(fn), *args, **kwargs)
+
+    def submit(self):
+        """
+        Evaluates the queryset in the background. The result of the future is
+        the list of the results of the queryset.
+        """
+        return self._submit(list, self._clone())
+
+    def submit_count(self):
+        return self._submit(self._clone().count)
+
+    def submit_get(self, *args, **kwargs):
+        return self._submit(self._clone().get, *args, **kwargs)
+
+    def submit_exists(self):
+        return self._submit(self._clone().exists)
+
+_queryset_classes = {}
+
+def _get_cassandra_queryset_class(klass):
+    # values(), values_list() and dates() clone the queryset into other
+    # QuerySet subclasses, which are combined with CassandraQuerySet so that
+    # the options still apply to them
+    if issubclass(klass, CassandraQuerySet) or not issubclass(klass, QuerySet):
+        return klass
+    cassandra_klass = _queryset_classes.get(klass)
+    if cassandra_klass is None:
+        cassandra_klass = _queryset_classes[klass] = \
+            type('Cassandra%s' % klass.__name__, (CassandraQuerySet, klass), {})
+    return cassandra_klass
+
+def _get_field_paths(related_fields, prefix=''):
+    # Converts the nested dictionary of the field names given to
+    # select_related to a list of paths
+    paths = []
+    for field_name, nested_fields in related_fields.items():
+        path = prefix + field_name
+        nested_paths = _get_field_paths(nested_fields, path + LOOKUP_SEP) if nested_fields else []
+        paths.extend(nested_paths or [path])
+    return paths
+
+def prefetch_related_objects(instances, field_paths, using=None):
+    """
+    Fetches the objects that are referred to by the foreign keys of the
+    instances (of the same model) along the paths of field names (e.g. 'host'
+    or 'host__slice'), and caches them in the instances so that accessing the
+    foreign keys doesn't query the database. The objects of each field are
+    fetched with a single query by primary key (which is a multiget_slice call
+    per page of keys).
+    """
+    tree = {}
+    for path in field_paths:
+        node = tree
+        for field_name in path.split(LOOKUP_SEP):
+            node = node.setdefault(field_name, {})
+    _prefetch_related_tree(instances, tree, using)
+
+def _prefetch_related_tree(instances, tree, using):
+    if not instances:
+        return
+    opts = instances[0]._meta
+    for field_name, subtree in tree.items():
+        try:
+            field = opts.get_field(field_name)
+        except FieldDoesNotExist:
+            field = None
+        if not isinstance(field, models.ForeignKey):
+            raise FieldError("'%s' isn't a foreign key of %s" % (field_name, opts.object_name))
+        cache_name = field.get_cache_name()
+        related_field = field.rel.get_related_field()
+        
+        # The objects that are already cached aren't fetched again
+        values = set()
+        for instance in instances:
+            value = getattr(instance, field.attname)
+            if (value is not None) and not hasattr(instance, cache_name):
+                values.add(value)
+        related_objects = {}
+        if values:
+            queryset = field.rel.to._default_manager.using(using).filter(
+                **{'%s__in' % related_field.name: list(values)})
+            for related_object in queryset:
+                related_objects[getattr(related_object, related_field.attname)] = related_object
+        
+        # A foreign key whose object doesn't exist is left alone, so that
+        # accessing it raises DoesNotExist as usual
+        related_instances = {}
+        for instance in instances:
+            if hasattr(instance, cache_name):
+                related_object = getattr(instance, cache_name)
+            else:
+                value = getattr(instance, field.attname)
+                if value is None:
+                    related_object = None
+                elif value in related_objects:
+                    related_object = related_objects[value]
+                else:
+                    continue
+                setattr(instance, cache_name, related_object)
+            if related_object is not None:
+                related_instances[id(related_object)] = related_object
+        if subtree:
+            _prefetch_related_tree(related_instances.values(), subtree, using)
+
+class CassandraManager(models.Manager):
+    """
+    Manager whose querysets support the Cassandra-specific methods of
+    CassandraQuerySet.
+    """
+
+    def get_query_set(self):
+        return CassandraQuerySet(self.model, using=self._db)
+
+    def cassandra_options(self, consistency_level=None, **options):
+        return self.get_query_set().cassandra_options(consistency_level, **options)
+
+    def using_consistency(self, consistency_level=None, read=None, write=None):
+        return self.get_query_set().using_consistency(consistency_level, read, write)
+
+    def with_timeout(self, timeout):
+        return self.get_query_set().with_timeout(timeout)
+
+    def with_ttl(self, ttl):
+        return self.get_query_set().with_ttl(ttl)
+
+    def prefetch_related(self, *field_paths):
+        return self.get_query_set().prefetch_related(*field_paths)
+
+    def submit(self):
+        return self.get_query_set().submit()
+
+    def submit_count(self):
+        return self.get_query_set().submit_count()
+
+    def submit_get(self, *args, **kwargs):
+        return self.get_query_set().submit_get(*args, **kwargs)
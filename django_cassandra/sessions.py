@@ -0,0 +1,81 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Session engine that stores the sessions in a Cassandra column family. Enable
+it with SESSION_ENGINE = 'django_cassandra.sessions'. The sessions are stored
+in the keyspace of the CASSANDRA_SESSION_DATABASE database ('default' by
+default) in the CASSANDRA_SESSION_COLUMN_FAMILY column family ('DjangoSessions'
+by default) and Cassandra expires them when they expire.
+"""
+
+from django.conf import settings
+from django.contrib.sessions.backends.base import SessionBase, CreateError
+from django.db import DEFAULT_DB_ALIAS
+
+from .kvstore import KeyValueStore
+
+DEFAULT_SESSION_COLUMN_FAMILY = 'DjangoSessions'
+
+_store = None
+
+def get_session_store():
+    global _store
+    if _store is None:
+        _store = KeyValueStore(
+            getattr(settings, 'CASSANDRA_SESSION_COLUMN_FAMILY', DEFAULT_SESSION_COLUMN_FAMILY),
+            getattr(settings, 'CASSANDRA_SESSION_DATABASE', DEFAULT_DB_ALIAS))
+    return _store
+
+class SessionStore(SessionBase):
+
+    def __init__(self, session_key=None):
+        self._store = get_session_store()
+        super(SessionStore, self).__init__(session_key)
+
+    def load(self):
+        session_data = self._store.get(self.session_key)
+        if session_data is not None:
+            return self.decode(session_data)
+        self.create()
+        return {}
+
+    def create(self):
+        for i in xrange(10000):
+            self.session_key = self._get_new_session_key()
+            try:
+                self.save(must_create=True)
+            except CreateError:
+                continue
+            self.modified = True
+            return
+        raise RuntimeError("Unable to create a new session key.")
+
+    def save(self, must_create=False):
+        # Creating a session isn't atomic, but with random session keys
+        # a collision is very unlikely
+        if must_create and self.exists(self.session_key):
+            raise CreateError
+        session_data = self.encode(self._get_session(no_load=must_create))
+        self._store.set(self.session_key, session_data, self.get_expiry_age())
+
+    def exists(self, session_key):
+        return self._store.get(session_key) is not None
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self._session_key is None:
+                return
+            session_key = self._session_key
+        self._store.delete(session_key)
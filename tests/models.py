@@ -1,5 +1,7 @@
 from django.db import models
 from djangotoolbox.fields import ListField
+from django_cassandra.manager import CassandraManager
+from django_cassandra.fields import CounterField
 
 class Slice(models.Model):
     name = models.CharField(max_length=64)
@@ -13,6 +15,8 @@ class Host(models.Model):
     ip = models.CharField(max_length=20, db_index = True)
     slice = models.ForeignKey(Slice, db_index=True)
     
+    objects = CassandraManager()
+    
     class Meta:
         db_table = 'Host'
         ordering = ['id']
@@ -22,6 +26,8 @@ class Tag(models.Model):
     value = models.CharField(max_length=256)
     host = models.ForeignKey(Host, db_index=True)
     
+    objects = CassandraManager()
+    
     class Meta:
         db_table = 'Tag'
         ordering = ['id']
@@ -38,6 +44,19 @@ class Test(models.Model):
         db_table = 'Test'
         ordering = ['id']
 
+class LazyTest(models.Model):
+    test_date = models.DateField(null=True)
+    test_datetime = models.DateTimeField(null=True)
+    test_decimal = models.DecimalField(null=True, max_digits=10, decimal_places=3)
+    test_text = models.TextField(null=True)
+    slice = models.ForeignKey(Slice, null=True)
+    
+    class Meta:
+        db_table = 'LazyTest'
+        ordering = ['id']
+        
+    class CassandraSettings:
+        LAZY_FIELD_DECODING = True
 
 
 class CompoundKeyModel(models.Model):
@@ -64,3 +83,84 @@ class CompoundKeyModel3(models.Model):
 
     class CassandraSettings:
         COMPOUND_KEY_FIELDS = ('name')
+
+class PageViews(models.Model):
+    id = models.CharField(max_length=255, primary_key=True)
+    views = CounterField()
+    unique_views = CounterField()
+    
+    class Meta:
+        db_table = 'PageViews'
+
+class ExpiringEvent(models.Model):
+    name = models.CharField(max_length=64)
+    
+    objects = CassandraManager()
+    
+    class Meta:
+        db_table = 'ExpiringEvent'
+    
+    class CassandraSettings:
+        TTL = 3600
+
+class CompactItem(models.Model):
+    name = models.CharField(max_length=64)
+    description = models.TextField(null=True)
+    rank = models.IntegerField(default=0)
+    
+    class Meta:
+        db_table = 'CompactItem'
+    
+    class CassandraSettings:
+        STORAGE_FORMAT = 'compact'
+        COLUMN_NAMES = {'description': 'd', 'rank': 'r'}
+
+class TrackedItem(models.Model):
+    name = models.CharField(max_length=64)
+    body = models.TextField(null=True)
+    
+    class Meta:
+        db_table = 'TrackedItem'
+    
+    class CassandraSettings:
+        DIRTY_FIELD_TRACKING = True
+
+class Reading(models.Model):
+    device = models.CharField(max_length=64)
+    timestamp = models.IntegerField()
+    value = models.FloatField(null=True)
+    
+    class Meta:
+        db_table = 'Reading'
+    
+    class CassandraSettings:
+        PARTITION_KEY_FIELD = 'device'
+        CLUSTERING_FIELD = 'timestamp'
+
+class Article(models.Model):
+    title = models.CharField(max_length=64)
+    author = models.CharField(max_length=64, null=True)
+    rank = models.IntegerField(default=0)
+    body = models.TextField(null=True)
+    
+    class Meta:
+        db_table = 'Article'
+    
+    class CassandraSettings:
+        MATERIALIZED_VIEWS = (
+            {'COLUMN_FAMILY': 'ArticleByAuthor', 'KEY_FIELD': 'author', 'FIELDS': ('title', 'rank')},
+        )
+
+# The materialized view of the articles by author
+class ArticleByAuthor(models.Model):
+    author = models.CharField(max_length=64)
+    article_id = models.CharField(max_length=64)
+    title = models.CharField(max_length=64)
+    rank = models.IntegerField(default=0)
+    
+    class Meta:
+        db_table = 'ArticleByAuthor'
+    
+    class CassandraSettings:
+        PARTITION_KEY_FIELD = 'author'
+        CLUSTERING_FIELD = 'article_id'
@@ -16,6 +16,8 @@ from django.test import TestCase
 from .models import *
 import datetime
 import decimal
+import time
+from django.db import connection
 from django.db.models.query import Q
 from django.db.utils import DatabaseError
 
@@ -58,6 +60,50 @@ class FieldsTest(TestCase):
         self.assertEqual(test1.test_datetime, self.TEST_DATETIME2)
         self.assertEqual(test1.test_text, self.TEST_TEXT2)
         
+class LazyFieldDecodingTest(TestCase):
+    
+    TEST_DATE = datetime.date(2011,7,5)
+    TEST_DATETIME = datetime.datetime(2011,5,4,9,34,25)
+    TEST_DECIMAL = decimal.Decimal('2.125')
+    TEST_TEXT = "Lazy"
+    
+    def setUp(self):
+        self.slice = Slice(id='key1', name='slice1')
+        self.slice.save()
+        self.test = LazyTest(id='key1',
+                             test_date=self.TEST_DATE,
+                             test_datetime=self.TEST_DATETIME,
+                             test_decimal=self.TEST_DECIMAL,
+                             test_text=self.TEST_TEXT,
+                             slice=self.slice)
+        self.test.save()
+        
+    def test_lazy_fields(self):
+        test1 = LazyTest.objects.get(id='key1')
+        # Nothing has been decoded yet
+        self.assertEqual(type(test1.__dict__['test_datetime']).__name__, 'LazyFieldValue')
+        # The undecoded values don't keep the compiler of the query alive
+        import gc
+        from django_cassandra.db.compiler import SQLCompiler
+        lazy_value = test1.__dict__['test_date']
+        referents = gc.get_referents(lazy_value) + gc.get_referents(lazy_value.converter)
+        self.assertFalse([r for r in referents if isinstance(r, SQLCompiler)])
+        self.assertEqual(test1.test_datetime, self.TEST_DATETIME)
+        self.assertEqual(test1.__dict__['test_datetime'], self.TEST_DATETIME)
+        self.assertEqual(test1.test_date, self.TEST_DATE)
+        self.assertEqual(test1.test_decimal, self.TEST_DECIMAL)
+        self.assertEqual(test1.test_text, self.TEST_TEXT)
+        self.assertEqual(test1.slice.id, 'key1')
+        
+        test1.test_text = None
+        test1.save()
+        test1 = LazyTest.objects.get(id='key1')
+        self.assertEqual(test1.test_text, None)
+        self.assertEqual(test1.test_date, self.TEST_DATE)
+        
+        values = LazyTest.objects.values('test_decimal')[0]
+        self.assertEqual(values['test_decimal'], self.TEST_DECIMAL)
+        
 class BasicFunctionalityTest(TestCase):
     
     HOST_COUNT = 5
@@ -393,6 +439,40 @@ class QueryTest(TestCase):
         # self.assertEqual(h7.id, 'key7')
         #=======================================================================
 
+    def test_iterator(self):
+        # Use a small page size so that the results span several pages
+        page_size = connection.fetch_page_size
+        connection.fetch_page_size = 2
+        try:
+            hqs = Host.objects.all().order_by()
+            host_ids = sorted([h.id for h in hqs.iterator()])
+            self.assertEqual(host_ids, ['key1', 'key2', 'key3', 'key4', 'key5', 'key6', 'key7'])
+            self.assertEqual(hqs.count(), 7)
+            
+            hqs = Host.objects.filter(ip__startswith='10').order_by()
+            self.assertEqual(len(list(hqs.iterator())), 4)
+            
+            hqs = Host.objects.filter(id__gte='key3', id__lt='key7').order_by()
+            host_ids = [h.id for h in hqs.iterator()]
+            self.assertEqual(host_ids, ['key3', 'key4', 'key5', 'key6'])
+            
+            hqs = Host.objects.all().order_by()[1:4]
+            self.assertEqual(len(list(hqs)), 3)
+        finally:
+            connection.fetch_page_size = page_size
+
+    def test_submit(self):
+        hosts_future = Host.objects.filter(ip__startswith='10').submit()
+        count_future = Host.objects.filter(slice='key1').submit_count()
+        get_future = Host.objects.submit_get(id='key3')
+        missing_future = Host.objects.submit_get(id='key9')
+
+        self.assertEqual([h.id for h in hosts_future.result()], ['key1', 'key4', 'key5', 'key6'])
+        self.assertEqual(count_future.result(), 4)
+        self.check_host_data(get_future.result(), HOST_DATA_3)
+        self.failUnlessRaises(Host.DoesNotExist, missing_future.result)
+
+
 
 class OperationTest(TestCase):
 
@@ -579,6 +659,997 @@ class EmptyModelTest(TestCase):
         em2 = qs[0]
         self.assertEqual(em.id, em2.id)
 
+class InstrumentationTest(TestCase):
+    
+    def test_call_records(self):
+        from django_cassandra.db.instrumentation import cassandra_call_completed
+        records = []
+        def receiver(sender, connection, record, **kwargs):
+            records.append(record)
+        cassandra_call_completed.connect(receiver)
+        try:
+            create_slices((SLICE_DATA_1, SLICE_DATA_2))
+            s = Slice.objects.get(id='key1')
+            self.assertEqual(s.name, 'PCI')
+        finally:
+            cassandra_call_completed.disconnect(receiver)
+        
+        methods = [record.method for record in records]
+        self.assertEqual(methods.count('batch_mutate'), 2)
+        self.assertEqual(methods[-1], 'get_slice')
+        record = records[-1]
+        self.assertEqual(record.column_family, 'Slice')
+        self.assertEqual(record.rows, 1)
+        self.assertEqual(record.columns, 2)
+        self.assertTrue(record.bytes > 0)
+        self.assertTrue(record.duration >= 0)
+        self.assertEqual(record.error, None)
+        
+    def test_failing_receiver(self):
+        # An error in a receiver doesn't affect the calls themselves
+        from django_cassandra.db.instrumentation import cassandra_call_completed
+        def receiver(sender, connection, record, **kwargs):
+            raise ValueError('receiver error')
+        cassandra_call_completed.connect(receiver)
+        try:
+            create_slices((SLICE_DATA_1,))
+            self.assertEqual(Slice.objects.get(id='key1').name, 'PCI')
+        finally:
+            cassandra_call_completed.disconnect(receiver)
+        
+    def test_debug_queries(self):
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            query_count = len(connection.queries)
+            Slice.objects.filter(name__startswith='P').count()
+            queries = connection.queries[query_count:]
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+        timed_queries = [query for query in queries if 'time' in query]
+        self.assertTrue(len(timed_queries) > 0)
+        self.assertTrue(timed_queries[0]['sql'].startswith('get_range_slices Slice'))
+
+class ProfilingTest(TestCase):
+
+    def test_stage_breakdown(self):
+        from django_cassandra.db.profiling import profile_queries
+        create_slices((SLICE_DATA_1, SLICE_DATA_2))
+        qs = Slice.objects.filter(name__startswith='P')
+        with profile_queries() as profiles:
+            slices = list(qs)
+            count = Slice.objects.count()
+        self.assertEqual(len(slices), 1)
+        self.assertEqual(count, 2)
+        self.assertEqual(len(profiles), 2)
+
+        profile = qs.query.cassandra_profile
+        self.assertTrue(profile is profiles[0])
+        self.assertEqual(profile.stages['fetch'].rows_out, 2)
+        self.assertEqual(profile.stages['filter'].rows_in, 2)
+        self.assertEqual(profile.stages['filter'].rows_out, 1)
+        self.assertEqual(profile.stages['sort'].rows_in, 1)
+        self.assertEqual(profile.stages['convert'].rows_out, 1)
+        self.assertEqual(profiles[1].stages['convert'].calls, 0)
+        self.assertTrue('fetch' in profile.format_report())
+
+class OptionsTest(TestCase):
+
+    def test_option_precedence(self):
+        from cassandra.ttypes import ConsistencyLevel
+        from django_cassandra.db.options import cassandra_options, get_operation_options
+
+        class QuorumModel(object):
+            class CassandraSettings:
+                WRITE_CONSISTENCY_LEVEL = ConsistencyLevel.QUORUM
+                TIMEOUT = 10
+
+        options = get_operation_options(connection, Host)
+        self.assertEqual(options.read_consistency_level, connection.read_consistency_level)
+        self.assertEqual(options.write_consistency_level, connection.write_consistency_level)
+        self.assertEqual(options.timeout, connection.timeout)
+
+        options = get_operation_options(connection, QuorumModel)
+        self.assertEqual(options.read_consistency_level, connection.read_consistency_level)
+        self.assertEqual(options.write_consistency_level, ConsistencyLevel.QUORUM)
+        self.assertEqual(options.timeout, 10)
+
+        with cassandra_options(consistency_level=ConsistencyLevel.ALL, timeout=5):
+            options = get_operation_options(connection, QuorumModel)
+            self.assertEqual(options.read_consistency_level, ConsistencyLevel.ALL)
+            self.assertEqual(options.write_consistency_level, ConsistencyLevel.ALL)
+            self.assertEqual(options.timeout, 5)
+            with cassandra_options(read_consistency_level=ConsistencyLevel.ONE):
+                options = get_operation_options(connection, QuorumModel)
+                self.assertEqual(options.read_consistency_level, ConsistencyLevel.ONE)
+                self.assertEqual(options.write_consistency_level, ConsistencyLevel.ALL)
+
+        options = get_operation_options(connection, QuorumModel)
+        self.assertEqual(options.write_consistency_level, ConsistencyLevel.QUORUM)
+
+    def test_queryset_options(self):
+        from cassandra.ttypes import ConsistencyLevel
+        create_slices((SLICE_DATA_1, SLICE_DATA_2))
+        create_hosts((HOST_DATA_1, HOST_DATA_2, HOST_DATA_5))
+
+        hqs = Host.objects.using_consistency(ConsistencyLevel.QUORUM).with_timeout(30)
+        hqs = hqs.filter(slice='key1')
+        self.assertEqual(hqs._cassandra_options, {
+            'read_consistency_level': ConsistencyLevel.QUORUM,
+            'write_consistency_level': ConsistencyLevel.QUORUM,
+            'timeout': 30})
+        self.assertEqual([h.id for h in hqs], ['key1', 'key5'])
+        self.assertEqual(hqs.count(), 2)
+        self.assertEqual(hqs.update(ip='10.0.0.9'), 2)
+        hqs.delete()
+        self.assertEqual(Host.objects.count(), 1)
+
+    def test_values_options(self):
+        from cassandra.ttypes import ConsistencyLevel
+        from django_cassandra.db import compiler
+        create_slices((SLICE_DATA_1, SLICE_DATA_2))
+        create_hosts((HOST_DATA_1, HOST_DATA_2))
+        
+        # Records the options of the queries
+        read_consistency_levels = []
+        original_get_operation_options = compiler.get_operation_options
+        def get_operation_options(connection, model):
+            options = original_get_operation_options(connection, model)
+            read_consistency_levels.append(options.read_consistency_level)
+            return options
+        compiler.get_operation_options = get_operation_options
+        try:
+            qs = Host.objects.using_consistency(ConsistencyLevel.QUORUM)
+            self.assertEqual(sorted(qs.values_list('id', flat=True)), ['key1', 'key2'])
+            self.assertEqual(sorted(row['id'] for row in qs.values('id')), ['key1', 'key2'])
+            self.assertEqual(qs.values_list('id')._cassandra_options['read_consistency_level'],
+                             ConsistencyLevel.QUORUM)
+        finally:
+            compiler.get_operation_options = original_get_operation_options
+        self.assertTrue(read_consistency_levels)
+        self.assertEqual(set(read_consistency_levels), set([ConsistencyLevel.QUORUM]))
+
+class FlushTest(TestCase):
+
+    def check_flush(self, flush_strategy):
+        create_slices((SLICE_DATA_1, SLICE_DATA_2, SLICE_DATA_3, SLICE_DATA_4, SLICE_DATA_5))
+        page_size = connection.fetch_page_size
+        saved_flush_strategy = connection.flush_strategy
+        # Use a small page size so that the keys span several pages
+        connection.fetch_page_size = 2
+        connection.flush_strategy = flush_strategy
+        try:
+            connection.creation.flush_table('Slice')
+        finally:
+            connection.fetch_page_size = page_size
+            connection.flush_strategy = saved_flush_strategy
+        self.assertEqual(Slice.objects.count(), 0)
+
+    def test_delete_flush(self):
+        self.check_flush('delete')
+
+    def test_auto_flush(self):
+        self.check_flush('auto')
+
+    def test_truncate_flush(self):
+        self.check_flush('truncate')
+
+    def test_parallel_flush(self):
+        create_slices((SLICE_DATA_1, SLICE_DATA_2))
+        create_hosts((HOST_DATA_1, HOST_DATA_2))
+        connection.ops.sql_flush(None, ['Slice', 'Host', 'Tag'], [])
+        self.assertEqual(Slice.objects.count(), 0)
+        self.assertEqual(Host.objects.count(), 0)
+        self.assertEqual(Tag.objects.count(), 0)
+
+class TestSetupTest(TestCase):
+
+    def test_keyspace_def(self):
+        creation = connection.creation
+        keyspace_def = creation.get_keyspace_def()
+        self.assertEqual(keyspace_def.name, connection.settings_dict['NAME'])
+        cf_defs = dict((cf_def.name, cf_def) for cf_def in keyspace_def.cf_defs)
+        self.assertTrue('Slice' in cf_defs)
+        self.assertTrue('Host' in cf_defs)
+        index_names = [column_def.name for column_def in cf_defs['Host'].column_metadata]
+        self.assertTrue('slice_id' in index_names)
+        
+        fingerprint = creation.get_schema_fingerprint(keyspace_def)
+        self.assertEqual(creation.get_schema_fingerprint(creation.get_keyspace_def()), fingerprint)
+        cf_defs['Host'].column_metadata = []
+        self.assertNotEqual(creation.get_schema_fingerprint(keyspace_def), fingerprint)
+        
+    def test_keyspace_def_without_connection(self):
+        # The keyspace is created after create_test_db closes the connection
+        from django_cassandra.db.base import DatabaseWrapper
+        new_connection = DatabaseWrapper(dict(connection.settings_dict), connection.alias)
+        self.assertEqual(new_connection._db_connection, None)
+        keyspace_def = new_connection.creation.get_keyspace_def()
+        self.assertEqual(keyspace_def.name, connection.settings_dict['NAME'])
+        new_connection.creation._close_db_connection()
+        
+    def test_schema_agreement(self):
+        db_connection = connection.get_db_connection(False, False)
+        connection.creation.wait_for_schema_agreement(db_connection, 5.0)
+
+class MetadataTest(TestCase):
+
+    def test_metadata_cache(self):
+        from django_cassandra.db.metadata import get_metadata_cache, \
+            get_keyspace_metadata, invalidate_keyspace_metadata
+        
+        cache = get_metadata_cache(connection)
+        invalidate_keyspace_metadata(connection)
+        metadata = get_keyspace_metadata(connection)
+        self.assertTrue('Host' in metadata.get_table_names())
+        self.assertTrue('slice_id' in metadata.get_indexed_columns('Host'))
+        self.assertEqual(metadata.get_indexed_columns('NoSuchTable'), None)
+        self.assertTrue(get_keyspace_metadata(connection) is metadata)
+        
+        # After the TTL the metadata is kept if the schema hasn't changed
+        ttl = cache.ttl
+        cache.ttl = 0
+        try:
+            self.assertTrue(get_keyspace_metadata(connection) is metadata)
+        finally:
+            cache.ttl = ttl
+        
+        invalidate_keyspace_metadata(connection)
+        self.assertFalse(get_keyspace_metadata(connection) is metadata)
+        self.assertTrue('Host' in connection.introspection.table_names())
+    
+    def test_schema_disagreement(self):
+        from cassandra.ttypes import KsDef
+        from django_cassandra.fake_server import FakeCassandraServer
+        from django_cassandra.db.metadata import MetadataCache
+        from django_cassandra.db.utils import CassandraConnection
+        
+        server = FakeCassandraServer().start()
+        db_connection = CassandraConnection(server.host, server.port, 'Metadata', None, None)
+        try:
+            db_connection.open()
+            db_connection.client.system_add_keyspace(KsDef(name='Metadata',
+                strategy_class='org.apache.cassandra.locator.SimpleStrategy',
+                strategy_options={'replication_factor': '1'}, cf_defs=[]))
+            # The nodes don't agree on the schema version
+            server.handler.describe_schema_versions = \
+                lambda: {'version1': ['10.0.0.1'], 'version2': ['10.0.0.2']}
+            call_counts = server.handler.call_counts
+            
+            cache = MetadataCache(ttl=60)
+            metadata = cache.get_keyspace_metadata(db_connection, 'Metadata')
+            self.assertEqual(metadata.keyspace_def.name, 'Metadata')
+            for i in range(3):
+                self.assertTrue(cache.get_keyspace_metadata(db_connection, 'Metadata') is metadata)
+            self.assertEqual(call_counts.get('describe_keyspace'), 1)
+            
+            # A keyspace that doesn't exist is cached too
+            for i in range(3):
+                self.assertEqual(cache.get_keyspace_metadata(db_connection, 'Missing'), None)
+            self.assertEqual(call_counts.get('describe_keyspace'), 2)
+            
+            # After the TTL the metadata is described again
+            cache.ttl = 0
+            self.assertFalse(cache.get_keyspace_metadata(db_connection, 'Metadata') is metadata)
+            self.assertEqual(call_counts.get('describe_keyspace'), 3)
+        finally:
+            db_connection.close()
+            server.stop()
+
+class WarmConnectionTest(TestCase):
+
+    def test_prewarm_connections(self):
+        from django_cassandra.db.pool import prewarm_connections, \
+            get_warm_connection_pool, get_server_capabilities
+        
+        db_connection = connection.db_connection
+        capabilities = get_server_capabilities(db_connection.host, db_connection.port)
+        self.assertTrue(capabilities is not None)
+        self.assertEqual(connection.supports_truncate, capabilities.supports_truncate)
+        
+        pool = get_warm_connection_pool(connection.alias, connection.settings_dict['NAME'])
+        prewarm_connections(connection, 2).join()
+        self.assertEqual(len(pool), 2)
+        
+        connection._db_connection = None
+        try:
+            warm_connection = connection.db_connection
+            self.assertEqual(len(pool), 1)
+            self.assertTrue(warm_connection.keyspace_set)
+            self.assertTrue(warm_connection.instrumentation is connection.instrumentation)
+            self.assertEqual(warm_connection.keyspace, db_connection.keyspace)
+            warm_connection.close()
+        finally:
+            connection._db_connection = db_connection
+        while len(pool) > 0:
+            pool.get().close()
+
+class FakeServerTest(TestCase):
+
+    def test_start_stop(self):
+        import socket
+        from django_cassandra.fake_server import FakeCassandraServer, FAKE_API_VERSION
+        from django_cassandra.db.utils import CassandraConnection
+        
+        server = FakeCassandraServer().start()
+        client_connection = CassandraConnection(server.host, server.port, 'Fake', None, None)
+        client_connection.open()
+        self.assertEqual(client_connection.client.describe_version(), FAKE_API_VERSION)
+        
+        # Stopping the server closes the client connections and ends the
+        # accept loop
+        server.stop()
+        self.assertEqual(server.thread, None)
+        self.assertRaises(Exception, client_connection.client.describe_version)
+        client_connection.close()
+        self.assertRaises(socket.error, socket.create_connection, (server.host, server.port))
+
+class BenchmarkTest(TestCase):
+
+    def test_summarize_durations(self):
+        from django_cassandra.benchmark import summarize_durations, get_peak_rss
+        start_peak_rss = get_peak_rss()
+        result = summarize_durations([0.002, 0.001, 0.003, 0.004], 0.01, start_peak_rss)
+        self.assertEqual(result['operations'], 4)
+        self.assertAlmostEqual(result['ops_per_second'], 400.0)
+        self.assertAlmostEqual(result['p50_ms'], 3.0)
+        self.assertAlmostEqual(result['p99_ms'], 4.0)
+        self.assertTrue(result['process_peak_rss_kb'] >= start_peak_rss)
+        self.assertEqual(result['peak_rss_growth_kb'],
+                         result['process_peak_rss_kb'] - start_peak_rss)
+    
+    def test_compare_results(self):
+        from django_cassandra.benchmark import compare_results
+        baseline = {'results': {'100': {'get_pk': {'ops_per_second': 100.0, 'p99_ms': 10.0}}}}
+        current = {'results': {'100': {'get_pk': {'ops_per_second': 80.0, 'p99_ms': 10.5}},
+                               '1000': {'get_pk': {'ops_per_second': 50.0, 'p99_ms': 20.0}}}}
+        self.assertEqual(compare_results(baseline, current, 0.1),
+                         [('100', 'get_pk', 'ops_per_second', 100.0, 80.0, True),
+                          ('100', 'get_pk', 'p99_ms', 10.0, 10.5, False)])
+
+class HedgedReadTest(TestCase):
+
+    def test_slow_host_is_hedged(self):
+        from cassandra import Cassandra
+        from cassandra.ttypes import KsDef, CfDef, ColumnParent, SlicePredicate, \
+            SliceRange, ConsistencyLevel, Mutation, ColumnOrSuperColumn, Column
+        from django_cassandra.fake_server import FakeCassandraServer, FakeCassandraStorage
+        from django_cassandra.db.hedging import HedgedReader
+        from django_cassandra.db.utils import CassandraConnection
+
+        storage = FakeCassandraStorage()
+        slow_server = FakeCassandraServer(storage, method_latencies={'get_slice': 1.0}).start()
+        fast_server = FakeCassandraServer(storage).start()
+        reader = None
+        try:
+            setup_connection = CassandraConnection(fast_server.host, fast_server.port, 'Hedged', None, None)
+            setup_connection.open()
+            client = setup_connection.client
+            client.system_add_keyspace(KsDef(name='Hedged',
+                strategy_class='org.apache.cassandra.locator.SimpleStrategy',
+                strategy_options={'replication_factor': '1'},
+                cf_defs=[CfDef(keyspace='Hedged', name='Data')]))
+            client.set_keyspace('Hedged')
+            column = Column(name='name', value='value', timestamp=1)
+            client.batch_mutate({'key1': {'Data': [Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=column))]}},
+                                ConsistencyLevel.ONE)
+            setup_connection.close()
+
+            hosts = [(slow_server.host, slow_server.port), (fast_server.host, fast_server.port)]
+            reader = HedgedReader(hosts, 'Hedged', min_delay=0.05)
+            args = ('key1', ColumnParent(column_family='Data'),
+                    SlicePredicate(slice_range=SliceRange(start='', finish='', count=100)),
+                    ConsistencyLevel.ONE)
+
+            # The first read goes to the slow host and is hedged
+            start_time = time.time()
+            columns = reader.call(Cassandra.Client.get_slice, args)
+            self.assertTrue(time.time() - start_time < 0.5)
+            self.assertEqual([c.column.value for c in columns], ['value'])
+            self.assertEqual(reader.hedged_count, 1)
+
+            # The second one goes to the fast host
+            columns = reader.call(Cassandra.Client.get_slice, args)
+            self.assertEqual(reader.hedged_count, 1)
+
+            # With no budget left a slow read isn't hedged
+            reader.budget.tokens = 0.0
+            start_time = time.time()
+            columns = reader.call(Cassandra.Client.get_slice, args)
+            self.assertTrue(time.time() - start_time >= 1.0)
+            self.assertEqual([c.column.value for c in columns], ['value'])
+            self.assertEqual(reader.hedged_count, 1)
+
+            # The reads themselves run on the calling thread, so only the
+            # hedge needed an executor thread
+            self.assertEqual(len(reader.executor._threads), 1)
+        finally:
+            if reader is not None:
+                reader.close()
+            slow_server.stop()
+            fast_server.stop()
+
+class CounterTest(TestCase):
+
+    def test_increment(self):
+        from django.db.models import F
+        PageViews.objects.filter(pk='/home').update(views=F('views') + 1)
+        PageViews.objects.filter(pk='/home').update(views=F('views') + 2,
+                                                    unique_views=F('unique_views') + 1)
+        PageViews.objects.filter(pk__in=['/home', '/about']).update(views=F('views') - 1)
+        
+        page_views = PageViews.objects.get(pk='/home')
+        self.assertEqual(page_views.views, 2)
+        self.assertEqual(page_views.unique_views, 1)
+        page_views = PageViews.objects.get(pk='/about')
+        self.assertEqual(page_views.views, -1)
+        self.assertEqual(PageViews.objects.filter(views__gt=0).count(), 1)
+    
+    def test_create(self):
+        from django.db.models import F
+        PageViews.objects.create(id='/new', views=5)
+        PageViews.objects.filter(pk='/new').update(views=F('views') + 1)
+        self.assertEqual(PageViews.objects.get(pk='/new').views, 6)
+        self.assertRaises(DatabaseError, PageViews.objects.filter(pk='/new').update, views=10)
+    
+    def test_save(self):
+        from django.db.models import F
+        PageViews.objects.create(id='/home', views=5, unique_views=2)
+        page_views = PageViews.objects.get(pk='/home')
+        page_views.save()
+        page_views = PageViews.objects.get(pk='/home')
+        self.assertEqual((page_views.views, page_views.unique_views), (5, 2))
+        
+        # The difference from the loaded value is added, so a concurrent
+        # increment isn't lost
+        PageViews.objects.filter(pk='/home').update(views=F('views') + 10)
+        page_views.views += 1
+        page_views.save()
+        page_views.save()
+        page_views = PageViews.objects.get(pk='/home')
+        self.assertEqual((page_views.views, page_views.unique_views), (16, 2))
+        
+        self.assertRaises(DatabaseError, PageViews(id='/home', views=1).save)
+    
+    def test_create_defaults(self):
+        # A new row whose counters are all 0 is still created
+        PageViews.objects.create(id='/zero')
+        page_views = PageViews.objects.get(pk='/zero')
+        self.assertEqual((page_views.views, page_views.unique_views), (0, 0))
+
+class TTLTest(TestCase):
+
+    def test_ttl(self):
+        from django_cassandra.db.options import cassandra_options, get_operation_options
+        self.assertEqual(get_operation_options(connection, ExpiringEvent).ttl, 3600)
+        self.assertEqual(get_operation_options(connection, Slice).ttl, None)
+        
+        ExpiringEvent.objects.create(id='lasting', name='lasting')
+        with cassandra_options(ttl=1):
+            ExpiringEvent.objects.create(id='expiring', name='expiring')
+        ExpiringEvent.objects.create(id='updated', name='updated')
+        ExpiringEvent.objects.filter(id='updated').with_ttl(1).update(name='changed')
+        self.assertEqual(ExpiringEvent.objects.count(), 3)
+        
+        # TTLs have a resolution of one second
+        time.sleep(2.1)
+        self.assertEqual(sorted(event.id for event in ExpiringEvent.objects.all()), ['lasting', 'updated'])
+        # Only the updated column expired
+        self.assertEqual(ExpiringEvent.objects.get(id='updated').name, '')
+
+class CacheTest(TestCase):
+
+    def test_cache(self):
+        from django_cassandra.cache import CassandraCache
+        cache = CassandraCache('TestCache', {'TIMEOUT': 60})
+        cache.clear()
+        
+        cache.set('a', {'x': 1})
+        self.assertEqual(cache.get('a'), {'x': 1})
+        self.assertEqual(cache.get('b', 'missing'), 'missing')
+        self.assertFalse(cache.add('a', 2))
+        self.assertTrue(cache.add('b', 2))
+        self.assertEqual(cache.incr('b'), 3)
+        
+        cache.set_many({'c': 'C', 'd': 'D'})
+        self.assertEqual(cache.get_many(['a', 'c', 'd', 'e']),
+                         {'a': {'x': 1}, 'c': 'C', 'd': 'D'})
+        cache.delete_many(['c', 'd'])
+        cache.delete('a')
+        self.assertEqual(cache.get_many(['a', 'b', 'c', 'd']), {'b': 3})
+        
+        cache.set('expiring', 1, 1)
+        time.sleep(2.1)
+        self.assertEqual(cache.get('expiring'), None)
+        cache.clear()
+        self.assertEqual(cache.get('b'), None)
+
+class SessionTest(TestCase):
+
+    def test_session(self):
+        from django_cassandra.sessions import SessionStore
+        session = SessionStore()
+        session['user'] = 'alice'
+        session.save()
+        session_key = session.session_key
+        self.assertTrue(session.exists(session_key))
+        
+        session = SessionStore(session_key)
+        self.assertEqual(session['user'], 'alice')
+        session.delete()
+        self.assertFalse(session.exists(session_key))
+        
+        # A session that doesn't exist is replaced with a new one
+        session = SessionStore(session_key)
+        self.assertEqual(session.get('user'), None)
+        self.assertNotEqual(session.session_key, session_key)
+
+class StorageFormatTest(TestCase):
+    
+    def _get_columns(self, key):
+        from cassandra import Cassandra
+        from cassandra.ttypes import ColumnParent, SlicePredicate, SliceRange
+        from django_cassandra.db.utils import call_cassandra
+        column_list = call_cassandra(connection.db_connection, Cassandra.Client.get_slice,
+            key, ColumnParent(column_family='CompactItem'),
+            SlicePredicate(slice_range=SliceRange(start='', finish='', count=100)),
+            connection.read_consistency_level)
+        return dict((column.column.name, column.column.value) for column in column_list)
+    
+    def test_compact_storage(self):
+        item = CompactItem.objects.create(name='first', rank=3)
+        self.assertEqual(self._get_columns(item.pk), {'name': 'first', 'r': '3'})
+        
+        item = CompactItem.objects.get(pk=item.pk)
+        self.assertEqual((item.name, item.description, item.rank), ('first', None, 3))
+        self.assertEqual(CompactItem.objects.filter(rank=3).count(), 1)
+        self.assertEqual(CompactItem.objects.filter(description__isnull=True).count(), 1)
+        
+        CompactItem.objects.filter(pk=item.pk).update(description='text')
+        self.assertEqual(self._get_columns(item.pk)['d'], 'text')
+        CompactItem.objects.filter(pk=item.pk).update(description=None)
+        self.assertFalse('d' in self._get_columns(item.pk))
+        self.assertEqual(CompactItem.objects.get(pk=item.pk).description, None)
+        
+        # Saving an existing row deletes the columns of the fields that are None
+        item.description = 'saved'
+        item.save()
+        self.assertEqual(self._get_columns(item.pk)['d'], 'saved')
+        item.description = None
+        item.save()
+        self.assertFalse('d' in self._get_columns(item.pk))
+    
+    def test_rewrite(self):
+        from cassandra import Cassandra
+        from cassandra.ttypes import Column, ColumnOrSuperColumn, Mutation
+        from django_cassandra.db.storage import rewrite_rows
+        from django_cassandra.db.utils import call_cassandra, get_next_timestamp
+        
+        # A row in the standard format, without the column name mapping
+        timestamp = get_next_timestamp()
+        mutation_list = [Mutation(column_or_supercolumn=ColumnOrSuperColumn(
+                            column=Column(name=name, value=value, timestamp=timestamp)))
+                         for name, value in (('id', 'old'), ('name', 'old item'),
+                                             ('description', '\b'), ('rank', '7'))]
+        call_cassandra(connection.db_connection, Cassandra.Client.batch_mutate,
+            {'old': {'CompactItem': mutation_list}}, connection.write_consistency_level)
+        CompactItem.objects.create(name='new')
+        
+        self.assertEqual(rewrite_rows(connection, CompactItem, True), (2, 1))
+        self.assertEqual(rewrite_rows(connection, CompactItem), (2, 1))
+        self.assertEqual(self._get_columns('old'), {'name': 'old item', 'r': '7'})
+        self.assertEqual(rewrite_rows(connection, CompactItem), (2, 0))
+        item = CompactItem.objects.get(rank=7)
+        self.assertEqual((item.pk, item.description), ('old', None))
+
+class DirtyFieldTrackingTest(TestCase):
+    
+    def _get_timestamps(self, key):
+        from cassandra import Cassandra
+        from cassandra.ttypes import ColumnParent, SlicePredicate, SliceRange
+        from django_cassandra.db.utils import call_cassandra
+        column_list = call_cassandra(connection.db_connection, Cassandra.Client.get_slice,
+            key, ColumnParent(column_family='TrackedItem'),
+            SlicePredicate(slice_range=SliceRange(start='', finish='', count=100)),
+            connection.read_consistency_level)
+        return dict((column.column.name, column.column.timestamp) for column in column_list)
+    
+    def _count_writes(self, fn):
+        from django_cassandra.db.instrumentation import cassandra_call_completed
+        methods = []
+        def receiver(sender, connection, record, **kwargs):
+            methods.append(record.method)
+        cassandra_call_completed.connect(receiver)
+        try:
+            fn()
+        finally:
+            cassandra_call_completed.disconnect(receiver)
+        return methods.count('batch_mutate')
+    
+    def test_tracking(self):
+        from django_cassandra.db.options import cassandra_options
+        item = TrackedItem.objects.create(name='item', body='x' * 1000)
+        timestamps = self._get_timestamps(item.pk)
+        
+        # Saving an unchanged instance doesn't write anything
+        item = TrackedItem.objects.get(pk=item.pk)
+        self.assertEqual(self._count_writes(item.save), 0)
+        
+        item.name = 'renamed'
+        self.assertEqual(self._count_writes(item.save), 1)
+        new_timestamps = self._get_timestamps(item.pk)
+        self.assertEqual(new_timestamps['body'], timestamps['body'])
+        self.assertTrue(new_timestamps['name'] > timestamps['name'])
+        self.assertEqual(TrackedItem.objects.get(pk=item.pk).name, 'renamed')
+        # The saved values are tracked too
+        self.assertEqual(self._count_writes(item.save), 0)
+        
+        with cassandra_options(full_write=True):
+            item.save()
+        self.assertTrue(self._get_timestamps(item.pk)['body'] > timestamps['body'])
+
+class WideRowTest(TestCase):
+    
+    def setUp(self):
+        for device in ('a', 'b'):
+            for timestamp in (-5, 3, 10, 25, 100):
+                Reading.objects.create(device=device, timestamp=timestamp, value=timestamp / 2.0)
+    
+    def _get_methods(self, fn):
+        from django_cassandra.db.instrumentation import cassandra_call_completed
+        methods = []
+        def receiver(sender, connection, record, **kwargs):
+            methods.append(record.method)
+        cassandra_call_completed.connect(receiver)
+        try:
+            fn()
+        finally:
+            cassandra_call_completed.disconnect(receiver)
+        return methods
+    
+    def test_key(self):
+        reading = Reading.objects.get(pk='a|25')
+        self.assertEqual(reading.device, 'a')
+        self.assertEqual(reading.timestamp, 25)
+        self.assertEqual(reading.value, 12.5)
+        self.failUnlessRaises(Reading.DoesNotExist, Reading.objects.get, pk='a|26')
+        reading = Reading(id='a|7', device='a', timestamp=8)
+        self.failUnlessRaises(DatabaseError, reading.save)
+    
+    def test_partition_slice(self):
+        qs = Reading.objects.filter(device='a', timestamp__gte=3).order_by('-timestamp')[:3]
+        results = []
+        methods = self._get_methods(lambda: results.extend(qs))
+        self.assertEqual([reading.timestamp for reading in results], [100, 25, 10])
+        self.assertEqual(methods, ['get_slice'])
+        
+        qs = Reading.objects.filter(device='b', timestamp__gt=-5, timestamp__lt=100).order_by('timestamp')
+        self.assertEqual([reading.timestamp for reading in qs], [3, 10, 25])
+        self.assertEqual(Reading.objects.filter(device='b').count(), 5)
+    
+    def test_scan(self):
+        qs = Reading.objects.filter(timestamp__lte=3).order_by('timestamp', 'device')
+        self.assertEqual([reading.pk for reading in qs], ['a|-5', 'b|-5', 'a|3', 'b|3'])
+        self.assertEqual(Reading.objects.count(), 10)
+    
+    def test_update_and_delete(self):
+        reading = Reading.objects.get(pk='b|10')
+        reading.value = None
+        reading.save()
+        self.assertEqual(Reading.objects.get(pk='b|10').value, None)
+        Reading.objects.filter(device='a', timestamp__gte=25).update(value=1.0)
+        self.assertEqual([reading.value for reading in Reading.objects.filter(device='a')],
+                         [-2.5, 1.5, 5.0, 1.0, 1.0])
+        self.failUnlessRaises(DatabaseError, Reading.objects.filter(device='a').update, timestamp=1)
+        
+        Reading.objects.get(pk='a|3').delete()
+        Reading.objects.filter(device='b', timestamp__lt=10).delete()
+        self.assertEqual([reading.pk for reading in Reading.objects.filter(timestamp__lte=10).order_by('pk')],
+                         ['a|-5', 'a|10', 'b|10'])
+
+class MaterializedViewTest(TestCase):
+    
+    def _get_view(self, author):
+        return [(entry.article_id, entry.title, entry.rank)
+                for entry in ArticleByAuthor.objects.filter(author=author)]
+    
+    def test_view(self):
+        from django_cassandra.db.instrumentation import cassandra_call_completed
+        first = Article.objects.create(title='first', author='ann', rank=1, body='...')
+        second = Article.objects.create(title='second', author='ann', rank=2)
+        Article.objects.create(title='third', author=None)
+        self.assertEqual(sorted(self._get_view('ann')),
+                         sorted([(first.pk, 'first', 1), (second.pk, 'second', 2)]))
+        self.assertEqual(ArticleByAuthor.objects.count(), 2)
+        
+        # The view is written in the same batch as the row
+        methods = []
+        def receiver(sender, connection, record, **kwargs):
+            methods.append(record.method)
+        cassandra_call_completed.connect(receiver)
+        try:
+            first.author = 'bob'
+            first.save()
+        finally:
+            cassandra_call_completed.disconnect(receiver)
+        self.assertEqual(methods.count('batch_mutate'), 1)
+        self.assertEqual(self._get_view('ann'), [(second.pk, 'second', 2)])
+        self.assertEqual(self._get_view('bob'), [(first.pk, 'first', 1)])
+        
+        Article.objects.filter(pk=second.pk).update(rank=5)
+        self.assertEqual(self._get_view('ann'), [(second.pk, 'second', 5)])
+        Article.objects.filter(pk=second.pk).update(author=None)
+        self.assertEqual(self._get_view('ann'), [])
+        
+        first.delete()
+        self.assertEqual(self._get_view('bob'), [])
+        self.assertEqual(ArticleByAuthor.objects.count(), 0)
+
+class PrefetchRelatedTest(TestCase):
+    
+    def setUp(self):
+        self.slices = [Slice.objects.create(name='slice%d' % i) for i in range(2)]
+        self.hosts = [Host.objects.create(mac='mac%d' % i, ip='10.0.0.%d' % i,
+                                          slice=self.slices[i % 2]) for i in range(3)]
+        for host in self.hosts:
+            for name in ('color', 'size'):
+                Tag.objects.create(name=name, value=host.mac, host=host)
+    
+    def _get_methods(self, fn):
+        from django_cassandra.db.instrumentation import cassandra_call_completed
+        methods = []
+        def receiver(sender, connection, record, **kwargs):
+            methods.append(record.method)
+        cassandra_call_completed.connect(receiver)
+        try:
+            fn()
+        finally:
+            cassandra_call_completed.disconnect(receiver)
+        return methods
+    
+    def test_pk_in(self):
+        keys = [self.hosts[0].pk, self.hosts[2].pk, 'missing']
+        results = []
+        methods = self._get_methods(lambda: results.extend(Host.objects.filter(pk__in=keys)))
+        self.assertEqual(methods, ['multiget_slice'])
+        self.assertEqual(sorted(host.mac for host in results), ['mac0', 'mac2'])
+        self.assertEqual([host.mac for host in Host.objects.filter(pk__in=keys, mac='mac2')],
+                         ['mac2'])
+    
+    def test_prefetch_related(self):
+        tags = []
+        def fetch():
+            for tag in Tag.objects.filter(name='color').prefetch_related('host__slice'):
+                tags.append((tag.value, tag.host.mac, tag.host.slice.name))
+        methods = self._get_methods(fetch)
+        self.assertEqual(len(methods), 3)
+        self.assertEqual(methods[1:], ['multiget_slice', 'multiget_slice'])
+        self.assertEqual(sorted(tags), [('mac0', 'mac0', 'slice0'), ('mac1', 'mac1', 'slice1'),
+                                        ('mac2', 'mac2', 'slice0')])
+    
+    def test_select_related(self):
+        tags = []
+        def fetch():
+            for tag in Tag.objects.select_related('host'):
+                tags.append((tag.host.pk, tag.host.mac, tag.host.ip))
+        methods = self._get_methods(fetch)
+        self.assertEqual(methods.count('multiget_slice'), 1)
+        self.assertEqual(methods.count('get_slice'), 0)
+        self.assertEqual(sorted(tags), sorted([(host.pk, host.mac, host.ip)
+                                               for host in self.hosts] * 2))
+
+class AggregationTest(TestCase):
+    
+    def setUp(self):
+        for author, rank in (('ann', 1), ('ann', 5), ('bob', 3), (None, 2)):
+            Article.objects.create(title='article%d' % rank, author=author, rank=rank)
+    
+    def test_aggregate(self):
+        from django.db.models import Avg, Count, Max, Min, Sum
+        result = Article.objects.aggregate(Max('rank'), Min('rank'), Sum('rank'),
+                                           Avg('rank'), Count('author'))
+        self.assertEqual(result, {'rank__max': 5, 'rank__min': 1, 'rank__sum': 11,
+                                  'rank__avg': 2.75, 'author__count': 3})
+        self.assertEqual(Article.objects.filter(author='ann').aggregate(Sum('rank')),
+                         {'rank__sum': 6})
+        self.assertEqual(Article.objects.filter(author='nobody').aggregate(Max('rank'), Count('id')),
+                         {'rank__max': None, 'id__count': 0})
+        self.assertEqual(Article.objects.aggregate(Count('author', distinct=True)),
+                         {'author__count': 2})
+        
+        for timestamp in (10, 20, 30):
+            Reading.objects.create(device='a', timestamp=timestamp, value=timestamp * 2.0)
+        self.assertEqual(Reading.objects.filter(device='a', timestamp__gte=20).aggregate(
+                            Max('timestamp'), Avg('value')),
+                         {'timestamp__max': 30, 'value__avg': 50.0})
+    
+    def test_annotate(self):
+        from django.db.models import Count, Max
+        results = Article.objects.values('author').annotate(count=Count('id'), top=Max('rank'))
+        self.assertEqual(list(results.order_by('-count', 'author')),
+                         [{'author': u'ann', 'count': 2, 'top': 5},
+                          {'author': None, 'count': 1, 'top': 2},
+                          {'author': u'bob', 'count': 1, 'top': 3}])
+        self.assertEqual(list(results.filter(rank__gte=2).order_by('author')[1:]),
+                         [{'author': u'ann', 'count': 1, 'top': 5},
+                          {'author': u'bob', 'count': 1, 'top': 3}])
+    
+    def test_profile_aggregate(self):
+        from django.db.models import Sum
+        from django_cassandra.db.profiling import profile_queries
+        with profile_queries() as profiles:
+            result = Article.objects.aggregate(Sum('rank'))
+        self.assertEqual(result, {'rank__sum': 11})
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0].stages['aggregate'].rows_in, 4)
+        self.assertEqual(profiles[0].stages['aggregate'].rows_out, 1)
+        self.assertTrue('\n  aggregate ' in profiles[0].format_report())
+
+PREDICATE_TEST_ROWS = [{'name': value} for value in
+                       (None, '', 'abc', 'ABCdef', 'xyz', 'zabc', 'key1', 'Key10', 'key2')]
+
+PREDICATE_TEST_FILTERS = [
+    ('isnull', True), ('in', ['abc', 'key1', 'nope']), ('endswith', 'c'),
+    ('iendswith', 'DEF'), ('contains', 'ab'), ('icontains', 'AB'),
+    ('istartswith', 'KEY'), ('iexact', 'abcdef'), ('regex', '^key[0-9]$'),
+    ('iregex', '^key1'), ('contains', None), ('exact', 'key1'), ('gte', 'key'),
+    ('lt', 'key2'), ('startswith', 'key1')]
+
+class PredicateTest(TestCase):
+    
+    def _evaluate(self, predicate, row):
+        # Evaluates the predicate tree directly, with row_matches
+        from django_cassandra.db.predicate import CompoundPredicate, COMPOUND_OP_AND
+        if not isinstance(predicate, CompoundPredicate):
+            return predicate.row_matches(row)
+        results = [self._evaluate(child, row) for child in predicate.children]
+        matches = all(results) if predicate.op == COMPOUND_OP_AND else any(results)
+        return not matches if predicate.negated else matches
+    
+    def _check_matches(self, predicate, rows):
+        matches = predicate.get_row_matcher()
+        for row in rows:
+            self.assertEqual(matches(row), self._evaluate(predicate, row),
+                             '%r for %r' % (predicate, row))
+    
+    def test_row_matchers(self):
+        from django_cassandra.db.predicate import CompoundPredicate, \
+            COMPOUND_OP_AND, COMPOUND_OP_OR
+        for op, value in PREDICATE_TEST_FILTERS:
+            predicate = CompoundPredicate(COMPOUND_OP_AND)
+            predicate.add_filter('name', op, value)
+            self._check_matches(predicate.children[0], PREDICATE_TEST_ROWS)
+            self._check_matches(predicate, PREDICATE_TEST_ROWS)
+        
+        for op in (COMPOUND_OP_AND, COMPOUND_OP_OR):
+            for negated in (False, True):
+                predicate = CompoundPredicate(op, negated)
+                predicate.add_filter('name', 'regex', '^k')
+                predicate.add_filter('name', 'isnull', False)
+                predicate.add_filter('name', 'contains', '1')
+                self._check_matches(predicate, PREDICATE_TEST_ROWS)
+                predicate.add_child(CompoundPredicate(COMPOUND_OP_OR, True))
+                self._check_matches(predicate, PREDICATE_TEST_ROWS)
+    
+    def test_row_matcher_cache(self):
+        from django_cassandra.db.predicate import CompoundPredicate, COMPOUND_OP_AND
+        predicate = CompoundPredicate(COMPOUND_OP_AND)
+        predicate.add_filter('name', 'startswith', 'key')
+        matches = predicate.get_row_matcher()
+        self.assertTrue(predicate.get_row_matcher() is matches)
+        self.assertEqual([row['name'] for row in PREDICATE_TEST_ROWS if matches(row)],
+                         ['key1', 'key2'])
+        # Adding a filter compiles the matcher again
+        predicate.add_filter('name', 'endswith', '2')
+        matches = predicate.get_row_matcher()
+        self.assertEqual([row['name'] for row in PREDICATE_TEST_ROWS if matches(row)],
+                         ['key2'])
+
+class VectorizedFilterTest(TestCase):
+    
+    def _get_rows(self):
+        from django_cassandra.db.compiler import SQLCompiler
+        rows = PREDICATE_TEST_ROWS + [{}, {'name': SQLCompiler.SPECIAL_NONE_VALUE},
+                                      {'name': 'abc\b'}, {'name': u'unicode key1'}]
+        # Enough rows for filter_rows to use the vectorized masks
+        return rows * 30
+    
+    def _check_filter(self, predicate, rows):
+        from django_cassandra.db.vectorized import RowPage
+        matches = predicate.get_row_matcher()
+        expected = [row for row in rows if matches(row)]
+        page = RowPage(rows)
+        self.assertEqual(page.select(predicate.get_mask(page)), expected, repr(predicate))
+        self.assertEqual(predicate.filter_rows(rows, predicate.children), expected, repr(predicate))
+    
+    def test_vectorized_filters(self):
+        from django_cassandra.db import vectorized
+        from django_cassandra.db.predicate import CompoundPredicate, \
+            COMPOUND_OP_AND, COMPOUND_OP_OR
+        if vectorized.numpy is None:
+            return
+        rows = self._get_rows()
+        self.assertTrue(vectorized.can_filter_vectorized(len(rows)))
+        for op, value in PREDICATE_TEST_FILTERS + [('in', ['abc', u'unicode key1']),
+                                                   ('in', ['abc', None]), ('iexact', u'ABC')]:
+            predicate = CompoundPredicate(COMPOUND_OP_AND)
+            predicate.add_filter('name', op, value)
+            self._check_filter(predicate, rows)
+        
+        for op in (COMPOUND_OP_AND, COMPOUND_OP_OR):
+            for negated in (False, True):
+                predicate = CompoundPredicate(op, negated)
+                predicate.add_filter('name', 'icontains', 'AB')
+                predicate.add_filter('name', 'isnull', False)
+                predicate.add_filter('name', 'lte', 'key1')
+                self._check_filter(predicate, rows)
+    
+    def test_row_page(self):
+        from django_cassandra.db import vectorized
+        from django_cassandra.db.utils import ColumnTable, CompactRow
+        if vectorized.numpy is None:
+            return
+        table = ColumnTable()
+        table.get_index('name')
+        rows = [CompactRow(table, ('a',)), CompactRow(table, ()), CompactRow(table, ('b\x00',))]
+        page = vectorized.RowPage(rows)
+        self.assertEqual(page.get_values('name'), ['a', None, 'b\x00'])
+        self.assertEqual(page.get_values('other'), [None, None, None])
+        # NumPy strips trailing NUL characters, so the column isn't converted
+        self.assertEqual(page._get_array('name'), None)
+        mask = page.get_operation_mask('name', 'isnull', True, lambda value: value is None)
+        self.assertEqual(page.select(mask), [rows[1]])
+
+class CompactRowTest(TestCase):
+    
+    def test_compact_row(self):
+        from django_cassandra.db.utils import ColumnTable, CompactRow
+        table = ColumnTable()
+        self.assertEqual(table.get_index('a'), 0)
+        self.assertEqual(table.get_index('b'), 1)
+        self.assertEqual(table.get_index('a'), 0)
+        row = CompactRow(table, ('1', None))
+        self.assertEqual(row.get('a'), '1')
+        self.assertEqual(row.get('b'), None)
+        self.assertEqual(row.get('b', 'default'), 'default')
+        self.assertEqual(row.get('unknown', 'default'), 'default')
+        self.assertRaises(KeyError, lambda: row['b'])
+        self.assertEqual(list(row.iteritems()), [('a', '1')])
+        self.assertEqual((row.keys(), len(row)), (['a'], 1))
+        self.assertTrue('a' in row)
+        self.assertFalse('b' in row)
+        
+        # A column that's added to the table after the row was created is
+        # missing from the row, until it's set
+        other_row = CompactRow(table, ('2', '3'))
+        table.get_index('c')
+        self.assertEqual(other_row.get('c'), None)
+        other_row['c'] = '4'
+        self.assertEqual(other_row.values, ('2', '3', '4'))
+        self.assertEqual(sorted(other_row.items()), [('a', '2'), ('b', '3'), ('c', '4')])
+        row['d'] = '5'
+        self.assertEqual(row.values, ('1', None, None, '5'))
+        self.assertEqual(table.names, ['a', 'b', 'c', 'd'])
+    
+    def test_convert_column_list_to_row(self):
+        from cassandra.ttypes import ColumnOrSuperColumn, Column, CounterColumn
+        from django_cassandra.db.utils import ColumnTable, convert_column_list_to_row
+        table = ColumnTable()
+        table.get_index('name')
+        column_list = [ColumnOrSuperColumn(column=Column(name='value', value='v', timestamp=1)),
+                       ColumnOrSuperColumn(column=Column(name='name', value='n', timestamp=1))]
+        row = convert_column_list_to_row(table, column_list)
+        self.assertEqual(sorted(row.items()), [('name', 'n'), ('value', 'v')])
+        self.assertEqual(table.names, ['name', 'value'])
+        
+        # The key is set as the value of the key column
+        row = convert_column_list_to_row(table, column_list, 'id', 'key1')
+        self.assertEqual(row['id'], 'key1')
+        self.assertEqual(table.names, ['name', 'value', 'id'])
+        counter_list = [ColumnOrSuperColumn(counter_column=CounterColumn(name='count', value=5))]
+        row = convert_column_list_to_row(table, counter_list, 'id', 'key2')
+        self.assertEqual(sorted(row.items()), [('count', 5), ('id', 'key2')])
+
 class CompoundKeyTest(TestCase):
     
     def test_construct_with_no_id(self):
@@ -649,4 +1720,36 @@ class CompoundKeyTest(TestCase):
         ckm.save();
         ckm = CompoundKeyModel2.objects.all()[0]
         self.assertEqual(ckm.id, 'default#foo#6')
-        
\ No newline at end of file
+        
+    def test_key_prefix_lookups(self):
+        for name, index in (('foo', 5), ('foo', 6), ('foo', 7), ('foo', 10), ('food', 1), ('bar', 6)):
+            CompoundKeyModel(name=name, index=index, extra='hello').save()
+        self.assertEqual(sorted(ckm.id for ckm in CompoundKeyModel.objects.filter(name='foo')),
+                         ['foo|10', 'foo|5', 'foo|6', 'foo|7'])
+        self.assertEqual(sorted(ckm.id for ckm in CompoundKeyModel.objects.filter(name='foo', index__gte=6)),
+                         ['foo|10', 'foo|6', 'foo|7'])
+        self.assertEqual(sorted(ckm.id for ckm in CompoundKeyModel.objects.filter(name='foo', index__lt=10)),
+                         ['foo|5', 'foo|6', 'foo|7'])
+        self.assertEqual(CompoundKeyModel.objects.get(name='foo', index=5).id, 'foo|5')
+        
+    def test_key_prefix_range(self):
+        from django_cassandra.db.predicate import CompoundPredicate, COMPOUND_OP_AND, \
+            get_compound_key_range
+        predicate = CompoundPredicate(COMPOUND_OP_AND)
+        predicate.add_filter('name', 'exact', 'foo')
+        key_range = get_compound_key_range(predicate, 'id', ['name', 'index'], '|')
+        self.assertEqual((key_range.start, key_range.end), ('foo|', 'foo|\xff'))
+        predicate.add_filter('index', 'gte', '6')
+        key_range = get_compound_key_range(predicate, 'id', ['name', 'index'], '|')
+        self.assertEqual((key_range.start, key_range.end), ('foo|6', 'foo|\xff'))
+        # A range on a column that isn't a string only selects the prefix
+        key_range = get_compound_key_range(predicate, 'id', ['name', 'index'], '|', ['name'])
+        self.assertEqual((key_range.start, key_range.end), ('foo|', 'foo|\xff'))
+        predicate.add_filter('index', 'lte', '6')
+        key_range = get_compound_key_range(predicate, 'id', ['name', 'index'], '|')
+        self.assertTrue(key_range._is_exact())
+        self.assertEqual(key_range.start, 'foo|6')
+        
+        predicate = CompoundPredicate(COMPOUND_OP_AND)
+        predicate.add_filter('extra', 'exact', 'hello')
+        self.assertEqual(get_compound_key_range(predicate, 'id', ['name', 'index'], '|'), None)